@@ -0,0 +1,681 @@
+# benchmark.py
+"""Banco de pruebas reproducible del bot de Telegram para WebDAV.
+
+Ejecuta los manejadores reales del bot (handle_document, handle_video,
+handle_photo, handle_audio, handle_direct_file...) contra un servidor falso de la
+Bot API y un servidor WebDAV local en memoria, ambos en un proceso aparte para no
+contaminar las mediciones. Inyecta una ráfaga sintética de archivos de distintos
+tipos y tamaños repartidos entre varios canales (y opcionalmente enviados en
+privado por usuarios autorizados) y, al terminar, informa de archivos/s, MB/s,
+latencia extremo a extremo (p50/p99), memoria residente máxima y uso máximo de
+disco temporal.
+
+Ejemplos:
+    python benchmark.py
+    python benchmark.py --files 500 --channels 20 --transfer-mode disk
+    python benchmark.py --mix photo:200K:60,video:64M:40 --env TRANSFER_MAX_CONCURRENT=8
+    python benchmark.py --local
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import shutil
+import resource
+import tempfile
+import threading
+import importlib.util
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, unquote, urlparse
+
+BOT_TOKEN = '123456:benchmark'
+WEBDAV_USER = 'bench'
+DAV_PREFIX = '/remote.php/dav'
+BLOCK_SIZE = 1024 * 1024
+DEFAULT_MIX = 'photo:200K:50,document:1M:25,audio:4M:15,video:16M:10'
+# Directorio de trabajo de un servidor local de la Bot API (--local), tal como lo ve el
+# servidor; en el banco de pruebas se monta en un directorio temporal
+LOCAL_SERVER_ROOT = '/var/lib/telegram-bot-api'
+
+# --- Servidores falsos (se ejecutan en un proceso aparte) ---
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=b'', content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self, keep=True):
+        """Lee el cuerpo (con Content-Length o chunked); devuelve (bytes, tamaño)"""
+        data = bytearray()
+        size = 0
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                length = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if length == 0:
+                    self.rfile.readline()
+                    break
+                remaining = length
+                while remaining:
+                    chunk = self.rfile.read(min(remaining, BLOCK_SIZE))
+                    remaining -= len(chunk)
+                    size += len(chunk)
+                    if keep:
+                        data += chunk
+                self.rfile.readline()
+        else:
+            remaining = int(self.headers.get('Content-Length') or 0)
+            while remaining:
+                chunk = self.rfile.read(min(remaining, BLOCK_SIZE))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                size += len(chunk)
+                if keep:
+                    data += chunk
+        return bytes(data), size
+
+
+def parse_file_id(file_id):
+    """Los file_id sintéticos tienen el formato bench-<índice>-<tamaño>-<id único>"""
+    _, index, size, unique = file_id.split('-', 3)
+    return int(size), unique
+
+
+def file_content(file_id, size, block):
+    """Contenido sintético de un archivo, por bloques; distinto por archivo para que
+    no coincidan sus SHA-256"""
+    header = file_id.encode().ljust(64, b'\0')
+    sent = 0
+    while sent < size:
+        chunk = (header + block)[:min(BLOCK_SIZE, size - sent)] if sent == 0 else block[:min(BLOCK_SIZE, size - sent)]
+        yield chunk
+        sent += len(chunk)
+
+
+class FakeBotAPIHandler(QuietHandler):
+    """Bot API mínima: getMe, getFile, envío/edición de mensajes y descarga de archivos.
+
+    Con `local_volume` imita un servidor local de la Bot API (--local): getFile deja
+    el archivo en ese directorio y devuelve su ruta absoluta bajo LOCAL_SERVER_ROOT,
+    en lugar de una ruta relativa que se descarga por HTTP.
+    """
+
+    block = random.Random(0).randbytes(BLOCK_SIZE)
+    local_volume = None
+
+    def local_file(self, file_id, size):
+        relative = f"{BOT_TOKEN}/documents/{file_id}"
+        path = os.path.join(self.local_volume, relative)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f"{path}.part", 'wb') as f:
+                for chunk in file_content(file_id, size, self.block):
+                    f.write(chunk)
+            os.replace(f"{path}.part", path)
+        return f"{LOCAL_SERVER_ROOT}/{relative}"
+
+    def do_POST(self):
+        method = urlparse(self.path).path.rsplit('/', 1)[-1]
+        body, _ = self.read_body()
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(body or b'{}')
+        else:
+            params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        if method == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        elif method == 'getFile':
+            file_id = params['file_id']
+            size, unique = parse_file_id(file_id)
+            file_path = self.local_file(file_id, size) if self.local_volume else f"files/{file_id}"
+            result = {'file_id': file_id, 'file_unique_id': unique, 'file_size': size, 'file_path': file_path}
+        elif method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id') or 0)
+            result = {
+                'message_id': int(params.get('message_id') or random.randint(1, 2 ** 30)),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        self.reply(200, json.dumps({'ok': True, 'result': result}).encode(), 'application/json')
+
+    def do_GET(self):
+        file_id = unquote(urlparse(self.path).path).rsplit('/', 1)[-1]
+        try:
+            size, _ = parse_file_id(file_id)
+        except ValueError:
+            return self.reply(404)
+        with FakeWebDAVHandler.state.lock:
+            FakeWebDAVHandler.state.telegram_downloads += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        for chunk in file_content(file_id, size, self.block):
+            self.wfile.write(chunk)
+
+
+class FakeWebDAVState:
+    """Árbol WebDAV en memoria: solo guarda tamaños, el contenido se descarta"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirs = {'/', '/files', f'/files/{WEBDAV_USER}', '/uploads', f'/uploads/{WEBDAV_USER}'}
+        self.files = {}
+        self.completed = {}
+        self.bytes_received = 0
+        self.requests = 0
+        # Descargas por HTTP de la Bot API falsa (que comparte este proceso)
+        self.telegram_downloads = 0
+        self.version = 0
+
+    def children(self, path):
+        prefix = path.rstrip('/') + '/'
+        direct = lambda p: p.startswith(prefix) and '/' not in p[len(prefix):]
+        return sorted(p for p in self.dirs if direct(p)), sorted(p for p in self.files if direct(p))
+
+    def complete(self, path):
+        name = path.rsplit('/', 1)[-1]
+        # Los nombres ocultos son subidas temporales del bot, aún sin terminar
+        if path.startswith('/files/') and not name.startswith('.'):
+            self.completed[name] = time.time()
+
+
+class FakeWebDAVHandler(QuietHandler):
+    """Servidor WebDAV con PROPFIND, MKCOL, PUT, MOVE, COPY, DELETE y subida por
+    fragmentos de Nextcloud (colección uploads + MOVE de .file)"""
+
+    state = None
+
+    def fs_path(self, url):
+        path = unquote(urlparse(url).path)
+        if not path.startswith(DAV_PREFIX):
+            return None
+        return '/' + path[len(DAV_PREFIX):].strip('/')
+
+    def do_GET(self):
+        if self.path == '/__stats':
+            with self.state.lock:
+                stats = {
+                    'completed': self.state.completed,
+                    'bytes_received': self.state.bytes_received,
+                    'requests': self.state.requests,
+                    'telegram_downloads': self.state.telegram_downloads,
+                }
+                body = json.dumps(stats).encode()
+            return self.reply(200, body, 'application/json')
+        self.reply(404)
+
+    def do_PROPFIND(self):
+        self.read_body()
+        path = self.fs_path(self.path)
+        state = self.state
+        with state.lock:
+            state.requests += 1
+            if path in state.dirs:
+                entries = [(path, True, 0)]
+                if self.headers.get('Depth', '1') != '0':
+                    dirs, files = state.children(path)
+                    entries += [(d, True, 0) for d in dirs] + [(f, False, state.files[f]) for f in files]
+            elif path in state.files:
+                entries = [(path, False, state.files[path])]
+            else:
+                return self.reply(404)
+            etag = state.version
+        parts = ['<?xml version="1.0"?><d:multistatus xmlns:d="DAV:">']
+        for entry, is_dir, size in entries:
+            href = DAV_PREFIX + entry.rstrip('/') + ('/' if is_dir else '')
+            parts.append(
+                f'<d:response><d:href>{href}</d:href><d:propstat><d:prop>'
+                f'<d:resourcetype>{"<d:collection/>" if is_dir else ""}</d:resourcetype>'
+                f'{"" if is_dir else f"<d:getcontentlength>{size}</d:getcontentlength>"}'
+                f'<d:getetag>"{etag}"</d:getetag>'
+                '</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>'
+            )
+        parts.append('</d:multistatus>')
+        self.reply(207, ''.join(parts).encode(), 'application/xml')
+
+    def do_MKCOL(self):
+        self.read_body()
+        path = self.fs_path(self.path)
+        state = self.state
+        with state.lock:
+            state.requests += 1
+            if path in state.dirs or path in state.files:
+                return self.reply(405)
+            if (path.rsplit('/', 1)[0] or '/') not in state.dirs:
+                return self.reply(409)
+            state.dirs.add(path)
+            state.version += 1
+        self.reply(201)
+
+    def do_PUT(self):
+        _, size = self.read_body(keep=False)
+        path = self.fs_path(self.path)
+        state = self.state
+        with state.lock:
+            state.requests += 1
+            state.bytes_received += size
+            if (path.rsplit('/', 1)[0] or '/') not in state.dirs:
+                return self.reply(409)
+            existed = path in state.files
+            state.files[path] = size
+            state.version += 1
+            state.complete(path)
+        self.reply(204 if existed else 201)
+
+    def do_DELETE(self):
+        path = self.fs_path(self.path)
+        state = self.state
+        with state.lock:
+            state.requests += 1
+            if path in state.files:
+                del state.files[path]
+            elif path in state.dirs:
+                prefix = path + '/'
+                state.dirs = {d for d in state.dirs if d != path and not d.startswith(prefix)}
+                state.files = {f: s for f, s in state.files.items() if not f.startswith(prefix)}
+            else:
+                return self.reply(404)
+            state.version += 1
+        self.reply(204)
+
+    def _transfer(self, move):
+        self.read_body()
+        source = self.fs_path(self.path)
+        target = self.fs_path(self.headers.get('Destination', ''))
+        overwrite = self.headers.get('Overwrite', 'T').upper() != 'F'
+        state = self.state
+        with state.lock:
+            state.requests += 1
+            existed = target in state.files or target in state.dirs
+            if existed and not overwrite:
+                return self.reply(412)
+            if (target.rsplit('/', 1)[0] or '/') not in state.dirs:
+                return self.reply(409)
+            if move and source.endswith('/.file'):
+                # Ensamblado de una subida por fragmentos
+                upload_dir = source[:-len('/.file')]
+                if upload_dir not in state.dirs:
+                    return self.reply(404)
+                prefix = upload_dir + '/'
+                chunks = [f for f in state.files if f.startswith(prefix)]
+                state.files[target] = sum(state.files.pop(f) for f in chunks)
+                state.dirs.discard(upload_dir)
+            elif source in state.files:
+                state.files[target] = state.files[source]
+                if move:
+                    del state.files[source]
+            elif source in state.dirs:
+                prefix = source + '/'
+                state.dirs.add(target)
+                for d in [d for d in state.dirs if d.startswith(prefix)]:
+                    state.dirs.add(target + d[len(source):])
+                    if move:
+                        state.dirs.discard(d)
+                for f in [f for f in state.files if f.startswith(prefix)]:
+                    state.files[target + f[len(source):]] = state.files[f]
+                    if move:
+                        del state.files[f]
+                if move:
+                    state.dirs.discard(source)
+            else:
+                return self.reply(404)
+            state.version += 1
+            state.complete(target)
+        self.reply(204 if existed else 201)
+
+    def do_MOVE(self):
+        self._transfer(move=True)
+
+    def do_COPY(self):
+        self._transfer(move=False)
+
+
+def serve_fake_servers(conn, local_volume=None):
+    FakeWebDAVHandler.state = FakeWebDAVState()
+    FakeBotAPIHandler.local_volume = local_volume
+    api = ThreadingHTTPServer(('127.0.0.1', 0), FakeBotAPIHandler)
+    dav = ThreadingHTTPServer(('127.0.0.1', 0), FakeWebDAVHandler)
+    api.daemon_threads = dav.daemon_threads = True
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    conn.send((api.server_address[1], dav.server_address[1]))
+    dav.serve_forever()
+
+# --- Carga de trabajo ---
+
+def parse_size(text):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def parse_mix(text):
+    mix = []
+    for item in text.split(','):
+        media_type, size, weight = item.split(':')
+        if media_type not in ('photo', 'document', 'video', 'audio'):
+            raise argparse.ArgumentTypeError(f"Tipo de archivo no válido: {media_type}")
+        mix.append((media_type, parse_size(size), float(weight)))
+    return mix
+
+
+def media_payload(media_type, file_id, unique, size, index):
+    """Parte del mensaje de Telegram con el archivo y el nombre con el que el bot lo guarda"""
+    base = {'file_id': file_id, 'file_unique_id': unique, 'file_size': size}
+    if media_type == 'photo':
+        return {'photo': [dict(base, width=1280, height=960)]}, f"photo_{file_id}.jpg"
+    if media_type == 'video':
+        name = f"video_{index}.mp4"
+        return {'video': dict(base, width=1280, height=720, duration=60, file_name=name)}, name
+    if media_type == 'audio':
+        name = f"audio_{index}.mp3"
+        return {'audio': dict(base, duration=180, file_name=name)}, name
+    name = f"document_{index}.bin"
+    return {'document': dict(base, file_name=name)}, name
+
+
+def build_workload(args):
+    """Genera las actualizaciones sintéticas (reproducibles con --seed)"""
+    rng = random.Random(args.seed)
+    channels = [-1001000000000 - i for i in range(args.channels)]
+    users = [1000 + i for i in range(max(args.private_files, 1))]
+    types, sizes, weights = zip(*((t, s, w) for t, s, w in args.mix))
+    published = []
+    workload = []
+    total = args.files + args.private_files
+    for index in range(total):
+        private = index >= args.files
+        if published and not private and rng.random() < args.repost_ratio:
+            # Reenvío del mismo archivo a otro canal: mismo file_unique_id
+            media_type, size, unique = rng.choice(published)
+        else:
+            choice = rng.choices(range(len(types)), weights)[0]
+            media_type, size, unique = types[choice], sizes[choice], f"u{index}"
+            published.append((media_type, size, unique))
+        file_id = f"bench-{index}-{size}-{unique}"
+        payload, file_name = media_payload(media_type, file_id, unique, size, index)
+        message = {'message_id': index + 1, 'date': int(time.time())}
+        message.update(payload)
+        if private:
+            user = {'id': users[index - args.files], 'is_bot': False, 'first_name': 'Bench'}
+            message['chat'] = {'id': user['id'], 'type': 'private'}
+            message['from'] = user
+            update = {'update_id': index + 1, 'message': message}
+        else:
+            message['chat'] = {'id': rng.choice(channels), 'type': 'channel', 'title': 'Bench'}
+            update = {'update_id': index + 1, 'channel_post': message}
+        workload.append({'update': update, 'file_name': file_name, 'size': size, 'private': private})
+    return channels, users, workload
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def current_rss():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+# --- Ejecución ---
+
+def load_bot():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telegram-webdav-bot.py')
+    spec = importlib.util.spec_from_file_location('telegram_webdav_bot', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+async def fetch_stats(client, dav_port):
+    response = await client.get(f"http://127.0.0.1:{dav_port}/__stats")
+    return response.json()
+
+
+async def run(args, api_port, dav_port, workdir):
+    import httpx
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    bot = load_bot()
+    if not args.verbose:
+        logging.getLogger('telegram_webdav_bot').setLevel(logging.WARNING)
+    channels, users, workload = build_workload(args)
+
+    application = bot.build_application()
+    # Las actualizaciones entran por update_queue, como las del sondeo o el webhook, y
+    # se anota cuándo terminan sus manejadores (este grupo se atiende después del de
+    # los manejadores del bot)
+    enqueued = {}
+    handled = {}
+
+    async def mark_handled(update, context):
+        handled[update.update_id] = time.time()
+
+    application.add_handler(TypeHandler(Update, mark_handled), group=1000)
+    await application.initialize()
+    await bot.post_init(application)
+    await application.start()
+
+    samples = {'rss': current_rss(), 'temp': 0}
+    baseline_rss = samples['rss']
+    sampling = True
+
+    async def sample():
+        while sampling:
+            samples['rss'] = max(samples['rss'], current_rss())
+            samples['temp'] = max(samples['temp'], directory_size(bot.TEMP_DIR))
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.create_task(sample())
+    submitted = {}
+    stats_client = httpx.AsyncClient()
+    started = time.time()
+
+    async def put(data):
+        enqueued[data['update_id']] = time.time()
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    for item in workload:
+        submitted[item['file_name']] = time.time()
+        await put(item['update'])
+        if item['private']:
+            # El usuario elige enseguida el primer directorio propuesto
+            message = item['update']['message']
+            callback = {
+                'update_id': message['message_id'] + 10 ** 6,
+                'callback_query': {
+                    'id': str(message['message_id']),
+                    'from': message['from'],
+                    'chat_instance': 'bench',
+                    'data': f"dir:{bot.CHANNEL_MAPPING[channels[0]]}",
+                    'message': {
+                        'message_id': message['message_id'] + 10 ** 6,
+                        'date': int(time.time()),
+                        'chat': message['chat'],
+                        'text': 'Selecciona directorio',
+                    },
+                },
+            }
+            await put(callback)
+        if args.rate:
+            await asyncio.sleep(1 / args.rate)
+
+    # Esperar a que se hayan atendido todas las actualizaciones y el servidor WebDAV
+    # haya recibido todos los archivos
+    deadline = time.time() + args.timeout
+    while True:
+        stats = await fetch_stats(stats_client, dav_port)
+        pending = [name for name in submitted if name not in stats['completed']]
+        idle = not bot.transfer_scheduler.queued and not bot.transfer_scheduler.in_flight
+        if (not pending and idle and len(handled) == len(enqueued)) or time.time() > deadline:
+            break
+        await asyncio.sleep(0.1)
+    finished = time.time()
+
+    sampling = False
+    await sampler
+    await stats_client.aclose()
+    await application.stop()
+    await bot.post_shutdown(application)
+    await application.shutdown()
+
+    completed = stats['completed']
+    latencies = [completed[name] - submitted[name] for name in submitted if name in completed]
+    dispatch = [handled[update_id] - enqueued[update_id] for update_id in enqueued if update_id in handled]
+    total_bytes = sum(item['size'] for item in workload if item['file_name'] in completed)
+    last = max(completed.values(), default=finished)
+    elapsed = max(last - started, 1e-9)
+    return {
+        'files': len(workload),
+        'completed': len(latencies),
+        'missing': len(workload) - len(latencies),
+        'channels': args.channels,
+        'private_files': args.private_files,
+        'transfer_mode': bot.TRANSFER_MODE,
+        'local_bot_api': bot.TELEGRAM_LOCAL_MODE,
+        'total_mb': total_bytes / 1024 ** 2,
+        'dispatch_p50_seconds': percentile(dispatch, 0.50),
+        'dispatch_p99_seconds': percentile(dispatch, 0.99),
+        'dispatch_max_seconds': max(dispatch, default=float('nan')),
+        'elapsed_seconds': elapsed,
+        'files_per_second': len(latencies) / elapsed,
+        'mb_per_second': total_bytes / 1024 ** 2 / elapsed,
+        'latency_p50_seconds': percentile(latencies, 0.50),
+        'latency_p99_seconds': percentile(latencies, 0.99),
+        'peak_rss_mb': max(samples['rss'], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024) / 1024 ** 2,
+        'baseline_rss_mb': baseline_rss / 1024 ** 2,
+        'peak_temp_mb': samples['temp'] / 1024 ** 2,
+        'webdav_requests': stats['requests'],
+        'webdav_bytes_received_mb': stats['bytes_received'] / 1024 ** 2,
+        'telegram_downloads': stats['telegram_downloads'],
+    }
+
+
+def print_report(report):
+    print(f"Archivos:                {report['completed']}/{report['files']} "
+          f"({report['private_files']} privados, {report['channels']} canales, modo {report['transfer_mode']}"
+          f"{', Bot API local' if report['local_bot_api'] else ''})")
+    if report['missing']:
+        print(f"Sin completar:           {report['missing']}")
+    print(f"Volumen:                 {report['total_mb']:.1f} MB")
+    print(f"Tiempo total:            {report['elapsed_seconds']:.2f} s")
+    print(f"Rendimiento:             {report['files_per_second']:.2f} archivos/s, {report['mb_per_second']:.1f} MB/s")
+    print(f"Latencia p50 / p99:      {report['latency_p50_seconds']:.3f} s / {report['latency_p99_seconds']:.3f} s")
+    print(f"Despacho p50 / p99:      {report['dispatch_p50_seconds']:.3f} s / "
+          f"{report['dispatch_p99_seconds']:.3f} s (máx. {report['dispatch_max_seconds']:.3f} s)")
+    print(f"Memoria residente máx.:  {report['peak_rss_mb']:.1f} MB (inicial {report['baseline_rss_mb']:.1f} MB)")
+    print(f"Disco temporal máx.:     {report['peak_temp_mb']:.1f} MB")
+    print(f"Peticiones WebDAV:       {report['webdav_requests']} "
+          f"({report['webdav_bytes_received_mb']:.1f} MB recibidos)")
+    print(f"Descargas de Telegram:   {report['telegram_downloads']} por HTTP")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Banco de pruebas del bot de Telegram para WebDAV")
+    parser.add_argument('--files', type=int, default=200, help="archivos publicados en canales")
+    parser.add_argument('--channels', type=int, default=10, help="canales mapeados")
+    parser.add_argument('--private-files', type=int, default=0, help="archivos enviados en privado por usuarios autorizados")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"tipos, tamaños y pesos (por defecto {DEFAULT_MIX})")
+    parser.add_argument('--repost-ratio', type=float, default=0.0, help="fracción de archivos reenviados desde otro canal")
+    parser.add_argument('--rate', type=float, default=0.0, help="actualizaciones por segundo (0: ráfaga)")
+    parser.add_argument('--transfer-mode', choices=['stream', 'disk'], default='stream')
+    parser.add_argument('--nextcloud', action='store_true', help="activar la subida por fragmentos de Nextcloud")
+    parser.add_argument('--local', action='store_true',
+                        help="simular un servidor local de la Bot API: getFile devuelve rutas absolutas "
+                             "que el bot lee directamente (TELEGRAM_LOCAL_MODE y TELEGRAM_LOCAL_PATH_MAP)")
+    parser.add_argument('--env', action='append', default=[], metavar='CLAVE=VALOR',
+                        help="variable de entorno adicional para el bot (repetible)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=600.0)
+    parser.add_argument('--json', metavar='RUTA', help="guardar también el informe en JSON")
+    parser.add_argument('--keep', action='store_true',
+                        help="conservar el directorio de trabajo (registro, temporales y archivos simulados)")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix='telegram-webdav-bench-')
+    os.makedirs(os.path.join(workdir, 'tmp'))
+    local_volume = os.path.join(workdir, 'bot-api') if args.local else None
+    parent, child = multiprocessing.Pipe()
+    servers = multiprocessing.Process(target=serve_fake_servers, args=(child, local_volume), daemon=True)
+    servers.start()
+    api_port, dav_port = parent.recv()
+
+    channels = [-1001000000000 - i for i in range(args.channels)]
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': BOT_TOKEN,
+        'TELEGRAM_API_URL': f"http://127.0.0.1:{api_port}/bot",
+        'WEBDAV_HOSTNAME': f"http://127.0.0.1:{dav_port}{DAV_PREFIX}/files/{WEBDAV_USER}/",
+        'WEBDAV_USERNAME': WEBDAV_USER,
+        'WEBDAV_PASSWORD': 'bench',
+        'WEBDAV_CHUNKED_UPLOADS': 'true' if args.nextcloud else 'false',
+        'CHANNEL_MAPPINGS': ','.join(f"{channel}:/canal{i}" for i, channel in enumerate(channels)),
+        'AUTHORIZED_USERS': ','.join(str(1000 + i) for i in range(max(args.private_files, 1))),
+        'TRANSFER_MODE': args.transfer_mode,
+        'TEMP_DIR': os.path.join(workdir, 'tmp'),
+        'JOURNAL_PATH': os.path.join(workdir, 'journal.db'),
+    })
+    if args.local:
+        os.environ.update({
+            'TELEGRAM_LOCAL_MODE': 'true',
+            'TELEGRAM_LOCAL_PATH_MAP': f"{LOCAL_SERVER_ROOT}:{local_volume}",
+        })
+    for item in args.env:
+        key, value = item.split('=', 1)
+        os.environ[key] = value
+
+    try:
+        report = asyncio.run(run(args, api_port, dav_port, workdir))
+    finally:
+        servers.terminate()
+        servers.join()
+        if args.keep:
+            print(f"Directorio de trabajo: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(report, output, indent=2)
+    return 0 if not report['missing'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,40 @@
 # bot.py
 import os
+import re
+import json
+import time
+import socket
+import argparse
+import base64
+import contextlib
+import fcntl
+import hashlib
+import posixpath
+import random
+import shutil
+import struct
+import sqlite3
+import tempfile
+import tarfile
+import zipfile
+import zlib
+import asyncio
+import multiprocessing
+import concurrent.futures
+import fnmatch
+import heapq
 import logging
-import webdav3.client as wc
+import xml.etree.ElementTree as ET
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Optional
+from urllib.parse import quote, unquote, urlparse
+import httpx
+import prometheus_client as prometheus
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, ContextTypes, MessageHandler, CommandHandler, CallbackQueryHandler, ConversationHandler, filters
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.ext import ApplicationBuilder, BasePersistence, BaseRateLimiter, ExtBot, PersistenceInput, ContextTypes, MessageHandler, CommandHandler, CallbackQueryHandler, ConversationHandler, filters
 
 # Configuración de logging
 logging.basicConfig(
@@ -11,120 +42,3307 @@ logging.basicConfig(
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+# httpx registra cada petición a nivel INFO
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+# Tamaños en la configuración: bytes o con sufijo K, M o G
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+def parse_size(value):
+    """Tamaño en bytes a partir de un número o de un texto como '20M'"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = str(value).strip().upper().removesuffix('B')
+    if text and text[-1] in SIZE_UNITS:
+        return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    return int(text)
 
 # Obtener token del bot desde variables de entorno
 TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 
-# Configuración de WebDAV
-WEBDAV_HOSTNAME = os.environ.get('WEBDAV_HOSTNAME')
-WEBDAV_USERNAME = os.environ.get('WEBDAV_USERNAME')
-WEBDAV_PASSWORD = os.environ.get('WEBDAV_PASSWORD')
+# Servidor propio de la Bot API (telegram-bot-api). En modo local los archivos se leen
+# directamente del volumen compartido con el servidor en lugar de descargarlos por HTTP
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+TELEGRAM_FILE_URL = os.environ.get('TELEGRAM_FILE_URL')
+TELEGRAM_LOCAL_MODE = os.environ.get('TELEGRAM_LOCAL_MODE', 'false').strip().lower() in ('1', 'true', 'yes')
+# Traducción de rutas si el volumen está montado en otra ruta (formato RUTA_SERVIDOR:RUTA_LOCAL)
+TELEGRAM_LOCAL_PATH_MAP = os.environ.get('TELEGRAM_LOCAL_PATH_MAP', '')
+# Con el servidor local, getFile no responde hasta que el servidor ha descargado el archivo
+TELEGRAM_GET_FILE_TIMEOUT = float(os.environ.get('TELEGRAM_GET_FILE_TIMEOUT', '300'))
+# Límites de la Bot API: llamadas por segundo en total y mensajes por segundo a un mismo
+# chat (0 = sin límite), y reintentos de una llamada rechazada con RetryAfter (429)
+TELEGRAM_RATE_LIMIT = float(os.environ.get('TELEGRAM_RATE_LIMIT', '25'))
+TELEGRAM_CHAT_RATE_LIMIT = float(os.environ.get('TELEGRAM_CHAT_RATE_LIMIT', '1'))
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', '3'))
+
+# Configuración de WebDAV
+WEBDAV_HOSTNAME = os.environ.get('WEBDAV_HOSTNAME')
+WEBDAV_USERNAME = os.environ.get('WEBDAV_USERNAME')
+WEBDAV_PASSWORD = os.environ.get('WEBDAV_PASSWORD')
+# Segundos que se considera vigente el índice de directorios de la raíz del WebDAV
+DIRECTORY_INDEX_TTL = float(os.environ.get('DIRECTORY_INDEX_TTL', '60'))
+# Segundos que se da por buena la comprobación de que existe un directorio de destino
+# (se guarda en la base de datos local, así que sobrevive a los reinicios)
+DIRECTORY_CACHE_TTL = float(os.environ.get('DIRECTORY_CACHE_TTL', '86400'))
+# Conexiones simultáneas al servidor WebDAV y timeout (segundos) de cada petición
+WEBDAV_MAX_CONNECTIONS = int(os.environ.get('WEBDAV_MAX_CONNECTIONS', '10'))
+WEBDAV_TIMEOUT = float(os.environ.get('WEBDAV_TIMEOUT', '300'))
+# Subida por fragmentos de Nextcloud para archivos grandes: activación, tamaño mínimo
+# del archivo, tamaño de cada fragmento y fragmentos enviados en paralelo
+WEBDAV_CHUNKED_UPLOADS = os.environ.get('WEBDAV_CHUNKED_UPLOADS', 'true').strip().lower() in ('1', 'true', 'yes')
+WEBDAV_CHUNK_THRESHOLD = int(os.environ.get('WEBDAV_CHUNK_THRESHOLD', str(50 * 1024 * 1024)))
+WEBDAV_CHUNK_SIZE = int(os.environ.get('WEBDAV_CHUNK_SIZE', str(10 * 1024 * 1024)))
+WEBDAV_CHUNK_PARALLELISM = int(os.environ.get('WEBDAV_CHUNK_PARALLELISM', '3'))
+# Ancho de banda máximo de las subidas a WebDAV, en bytes por segundo (0 = sin límite)
+WEBDAV_MAX_BYTES_PER_SECOND = parse_size(os.environ.get('WEBDAV_MAX_BYTES_PER_SECOND', '0'))
+# Subir cada archivo a un nombre temporal y renombrarlo (MOVE) al terminar, para que
+# nunca quede a medias con su nombre definitivo
+WEBDAV_ATOMIC_UPLOADS = os.environ.get('WEBDAV_ATOMIC_UPLOADS', 'true').strip().lower() in ('1', 'true', 'yes')
+# Qué hacer si ya existe un archivo con el mismo nombre en el destino: 'suffix' guarda
+# el nuevo como "nombre (1).ext", 'skip' no lo sube si el existente tiene el mismo
+# tamaño o el ETag de una subida anterior del mismo archivo (si no, usa un sufijo) y
+# 'overwrite' lo sustituye
+CONFLICT_POLICY = os.environ.get('CONFLICT_POLICY', 'suffix').strip().lower()
+
+# Modo de transferencia de los archivos de canales:
+# 'stream' envía los bytes de Telegram directamente a WebDAV sin pasar por disco,
+# 'disk' descarga primero el archivo completo a TEMP_DIR
+TRANSFER_MODE = os.environ.get('TRANSFER_MODE', 'stream').strip().lower()
+# Directorio local para los archivos temporales
+TEMP_DIR = os.environ.get('TEMP_DIR', '/tmp')
+# Tamaño de cada bloque y número de bloques en el búfer de memoria del modo 'stream'
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', str(1024 * 1024)))
+STREAM_BUFFER_CHUNKS = int(os.environ.get('STREAM_BUFFER_CHUNKS', '8'))
+
+# Límites del planificador de transferencias de canales: transferencias simultáneas en
+# total, por directorio de destino y tamaño máximo de la cola de espera
+TRANSFER_MAX_CONCURRENT = int(os.environ.get('TRANSFER_MAX_CONCURRENT', '4'))
+TRANSFER_MAX_PER_DESTINATION = int(os.environ.get('TRANSFER_MAX_PER_DESTINATION', '2'))
+TRANSFER_QUEUE_SIZE = int(os.environ.get('TRANSFER_QUEUE_SIZE', '100'))
+
+# Registro persistente de transferencias pendientes y política de reintentos
+JOURNAL_PATH = os.environ.get('JOURNAL_PATH', 'data/telegram-webdav.db')
+TRANSFER_MAX_ATTEMPTS = int(os.environ.get('TRANSFER_MAX_ATTEMPTS', '8'))
+TRANSFER_RETRY_BASE_DELAY = float(os.environ.get('TRANSFER_RETRY_BASE_DELAY', '5'))
+TRANSFER_RETRY_MAX_DELAY = float(os.environ.get('TRANSFER_RETRY_MAX_DELAY', '600'))
+# Cola compartida con procesos trabajadores: si se indica una URL redis:// la cola se
+# guarda en Redis (trabajadores en varias máquinas); si no, en la base de datos SQLite
+JOB_QUEUE_URL = os.environ.get('JOB_QUEUE_URL')
+# Dónde se ejecutan las transferencias: 'local' (en el propio proceso del bot) o
+# 'external' (el bot solo las encola y las atienden procesos `worker`)
+TRANSFER_WORKERS = os.environ.get('TRANSFER_WORKERS', 'local').strip().lower()
+# Segundos que un trabajador reserva una transferencia antes de que otro pueda
+# retomarla, y espera entre consultas a la cola cuando está vacía
+WORKER_LEASE = float(os.environ.get('WORKER_LEASE', '120'))
+WORKER_POLL_INTERVAL = float(os.environ.get('WORKER_POLL_INTERVAL', '2'))
+
+# Recepción de actualizaciones: 'polling' o 'webhook'
+BOT_MODE = os.environ.get('BOT_MODE', 'polling').strip().lower()
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+
+# Álbumes publicados en canales: segundos que se espera a que lleguen todos sus archivos
+# y si cada álbum se guarda en su propia subcarpeta
+ALBUM_WINDOW = float(os.environ.get('ALBUM_WINDOW', '2'))
+ALBUM_SUBFOLDERS = os.environ.get('ALBUM_SUBFOLDERS', 'false').strip().lower() in ('1', 'true', 'yes')
+
+# Puerto del endpoint /metrics de Prometheus (sin definir, no se publica)
+METRICS_PORT = os.environ.get('METRICS_PORT')
+
+# Evitar volver a transferir archivos ya subidos (reenvíos entre canales, republicaciones)
+DEDUP_ENABLED = os.environ.get('DEDUP_ENABLED', 'true').strip().lower() in ('1', 'true', 'yes')
+
+# Importación del historial de canales con una sesión MTProto (Telethon): credenciales de
+# la aplicación (https://my.telegram.org), archivo de la sesión y transferencias simultáneas
+TELEGRAM_API_ID = os.environ.get('TELEGRAM_API_ID')
+TELEGRAM_API_HASH = os.environ.get('TELEGRAM_API_HASH')
+BACKFILL_SESSION = os.environ.get('BACKFILL_SESSION', 'data/backfill')
+BACKFILL_CONCURRENCY = int(os.environ.get('BACKFILL_CONCURRENCY', '8'))
+
+# Mapeo de canales a directorios (formato CHANNEL_ID:DIRECTORY)
+CHANNEL_MAPPING = {}
+for mapping in os.environ.get('CHANNEL_MAPPINGS', '').split(','):
+    if ':' in mapping:
+        channel_id, directory = mapping.split(':', 1)
+        CHANNEL_MAPPING[int(channel_id.strip())] = directory.strip()
+
+# Reglas de enrutado por archivo: lista JSON en ROUTING_RULES o en el archivo indicado en
+# ROUTING_RULES_FILE. Los archivos que no cumplen ninguna van al directorio de su canal
+ROUTING_RULES = os.environ.get('ROUTING_RULES', '')
+ROUTING_RULES_FILE = os.environ.get('ROUTING_RULES_FILE')
+
+# Transformaciones de los archivos de cada canal antes de guardarlos (formato
+# CHANNEL_ID:webp+thumbnail,CHANNEL_ID:zip): 'webp' o 'avif' vuelven a codificar las
+# imágenes en ese formato, 'thumbnail' guarda una miniatura junto a cada imagen y 'zip'
+# o 'tar' reúnen los documentos pequeños en un archivador por día
+CHANNEL_TRANSFORMS = {}
+for mapping in os.environ.get('CHANNEL_TRANSFORMS', '').split(','):
+    if ':' in mapping:
+        channel_id, names = mapping.split(':', 1)
+        CHANNEL_TRANSFORMS[int(channel_id.strip())] = {
+            name.strip().lower() for name in names.split('+') if name.strip()
+        }
+# Procesos que hacen las transformaciones, calidad de las imágenes recodificadas y lado
+# mayor de las miniaturas
+TRANSFORM_PROCESSES = int(os.environ.get('TRANSFORM_PROCESSES', str(os.cpu_count() or 1)))
+TRANSFORM_IMAGE_QUALITY = int(os.environ.get('TRANSFORM_IMAGE_QUALITY', '80'))
+TRANSFORM_THUMBNAIL_SIZE = int(os.environ.get('TRANSFORM_THUMBNAIL_SIZE', '320'))
+# Archivadores diarios: tamaño máximo de los documentos que se archivan, segundos entre
+# subidas de cada archivador y directorio local donde se van formando (por defecto junto
+# a JOURNAL_PATH, que es lo que se conserva entre reinicios)
+ARCHIVE_MAX_SIZE = parse_size(os.environ.get('ARCHIVE_MAX_SIZE', '1M'))
+ARCHIVE_FLUSH_INTERVAL = float(os.environ.get('ARCHIVE_FLUSH_INTERVAL', '300'))
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(os.path.dirname(JOURNAL_PATH), 'archives'))
+
+# Archivos enviados al bot por usuarios: se suben a esta carpeta de WebDAV en cuanto
+# llegan y se mueven al directorio elegido (vacío para subirlos solo tras la elección);
+# los que nadie reclama se borran pasados STAGING_TTL segundos
+STAGING_DIR = os.environ.get('STAGING_DIR', '/.telegram-webdav-staging').strip()
+STAGING_TTL = float(os.environ.get('STAGING_TTL', '3600'))
+
+# Datos de los usuarios y estado de las conversaciones (selecciones de directorio
+# pendientes): en la base de datos de JOURNAL_PATH o, con una URL redis://, en Redis
+# para compartirlos entre varios procesos del bot (por defecto, el de JOB_QUEUE_URL)
+PERSISTENCE_URL = os.environ.get('PERSISTENCE_URL', JOB_QUEUE_URL)
+
+# Mensajes de progreso de los archivos enviados al bot: segundos mínimos entre dos
+# ediciones del mensaje (0 las desactiva) y tamaño a partir del cual se muestran
+PROGRESS_INTERVAL = float(os.environ.get('PROGRESS_INTERVAL', '3'))
+PROGRESS_MIN_SIZE = parse_size(os.environ.get('PROGRESS_MIN_SIZE', '5M'))
+
+# Lista de usuarios autorizados
+AUTHORIZED_USERS = []
+for user_id in os.environ.get('AUTHORIZED_USERS', '').split(','):
+    if user_id.strip():
+        AUTHORIZED_USERS.append(int(user_id.strip()))
+
+# Estados para el conversation handler
+SELECTING_DIRECTORY = 1
+
+# Cliente WebDAV asíncrono
+DAV_NS = '{DAV:}'
+PROPFIND_BODY = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<d:propfind xmlns:d="DAV:"><d:prop>'
+    '<d:resourcetype/><d:getcontentlength/><d:getetag/><d:getlastmodified/>'
+    '</d:prop></d:propfind>'
+)
+UPLOAD_READ_SIZE = 1024 * 1024
+# Intentos de cada fragmento antes de abandonar la subida por fragmentos
+CHUNK_PUT_ATTEMPTS = 3
+# URL WebDAV de Nextcloud: .../remote.php/dav/files/<usuario>
+NEXTCLOUD_FILES_RE = re.compile(r'^(?P<root>.*/remote\.php/dav)/files/(?P<user>[^/]+)')
+
+class TokenBucket:
+    """Limitador de cubo de fichas: `rate` unidades por segundo con ráfagas de hasta
+    `capacity` (por defecto, un segundo de tasa).
+
+    Quien pide más unidades de las que caben en el cubo las obtiene en cuanto está
+    lleno, quedando en deuda, así que un bloque grande nunca se queda esperando para
+    siempre. Los peticionarios se atienden por orden de llegada. La tasa se puede
+    cambiar en cualquier momento con configure(); 0 desactiva el límite.
+    """
+
+    def __init__(self, name, rate, capacity=None):
+        self.name = name
+        self._lock = asyncio.Lock()
+        self._paused_until = 0.0
+        self.configure(rate, capacity)
+
+    def configure(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(self.rate, 1))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def pause(self, seconds):
+        """Detiene todas las peticiones durante `seconds` segundos"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, amount=1):
+        async with self._lock:
+            started = time.monotonic()
+            while True:
+                now = time.monotonic()
+                if self._paused_until > now:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                if not self.rate:
+                    break
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                needed = min(amount, self.capacity)
+                if self._tokens >= needed:
+                    self._tokens -= amount
+                    break
+                await asyncio.sleep((needed - self._tokens) / self.rate)
+            THROTTLED_SECONDS.labels(self.name).inc(time.monotonic() - started)
+
+async def shaped(chunks, bucket):
+    """Deja pasar los bloques de bytes al ritmo que permite `bucket`"""
+    async for chunk in chunks:
+        await bucket.acquire(len(chunk))
+        yield chunk
+
+webdav_bandwidth = TokenBucket('webdav', WEBDAV_MAX_BYTES_PER_SECOND)
+
+# Segundos sobre los que se mide la velocidad de una transferencia y ancho de la barra
+PROGRESS_WINDOW = 10
+PROGRESS_BAR_WIDTH = 12
+
+def format_size(size):
+    return f"{size / 1024 ** 2:.1f} MB"
+
+def format_duration(seconds):
+    seconds = round(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600} h {seconds % 3600 // 60} min"
+    if seconds >= 60:
+        return f"{seconds // 60} min {seconds % 60} s"
+    return f"{seconds} s"
+
+class TransferProgress:
+    """Progreso de una transferencia: bytes, velocidad y tiempo restante.
+
+    track() cuenta los bytes que pasan por un iterador de bloques; consultar el
+    progreso solo lee esos contadores, así que no añade trabajo a la transferencia.
+    Usado como gestor de contexto, la transferencia figura en active_transfers
+    (y en /status) mientras dura.
+    """
+
+    def __init__(self, name, total=None, stage='preparando', directory=None):
+        self.name = name
+        self.directory = directory
+        self.finished = False
+        self.error = None
+        self.begin(stage, total)
+
+    def begin(self, stage, total=None):
+        """Empieza una nueva fase (descarga, subida...) con el contador a cero"""
+        self.stage = stage
+        self.total = total
+        self.done = 0
+        self.started = self.updated = time.monotonic()
+        self._samples = deque([(self.started, 0)])
+
+    def advance(self, amount):
+        self.done += amount
+        now = self.updated = time.monotonic()
+        # Como mucho una muestra por segundo para medir la velocidad
+        if now - self._samples[-1][0] >= 1:
+            self._samples.append((now, self.done))
+            while len(self._samples) > 2 and now - self._samples[1][0] >= PROGRESS_WINDOW:
+                self._samples.popleft()
+
+    def finish(self, error=None):
+        self.finished = True
+        self.error = error
+        self.updated = time.monotonic()
+
+    async def track(self, chunks):
+        async for chunk in chunks:
+            self.advance(len(chunk))
+            yield chunk
+
+    @property
+    def speed(self):
+        """Bytes por segundo en los últimos PROGRESS_WINDOW segundos"""
+        started, done = self._samples[0]
+        elapsed = time.monotonic() - started
+        return (self.done - done) / elapsed if elapsed > 0 else 0
+
+    @property
+    def eta(self):
+        speed = self.speed
+        if not self.total or not speed:
+            return None
+        return max(self.total - self.done, 0) / speed
+
+    def describe(self):
+        if isinstance(self.error, asyncio.CancelledError):
+            return "🚫 Cancelado"
+        if self.error is not None:
+            return f"❌ Error: {str(self.error)}"
+        if self.finished:
+            return f"✅ {format_size(self.done)} en {format_duration(self.updated - self.started)}"
+        details = []
+        if self.total:
+            fraction = min(self.done / self.total, 1)
+            filled = round(fraction * PROGRESS_BAR_WIDTH)
+            bar = '█' * filled + '░' * (PROGRESS_BAR_WIDTH - filled)
+            summary = f"{self.stage.capitalize()} {bar} {fraction:.0%}"
+            details.append(f"{format_size(self.done)} de {format_size(self.total)}")
+        else:
+            summary = self.stage.capitalize()
+            details.append(format_size(self.done))
+        if self.speed:
+            details.append(f"{self.speed / 1024 ** 2:.1f} MB/s")
+        if self.eta is not None:
+            details.append(f"quedan {format_duration(self.eta)}")
+        return f"{summary}\n{' · '.join(details)}"
+
+    def __enter__(self):
+        active_transfers.add(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        active_transfers.discard(self)
+        self.finish(exc)
+        return False
+
+# Transferencias en curso en este proceso
+active_transfers = set()
+
+class ChunkingUnsupported(Exception):
+    """El servidor no admite la subida por fragmentos de Nextcloud"""
+
+async def read_file_chunks(local_path, chunk_size=UPLOAD_READ_SIZE):
+    """Lee un archivo local por bloques sin bloquear el bucle de eventos"""
+    with open(local_path, 'rb') as f:
+        while True:
+            chunk = await asyncio.to_thread(f.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+class AsyncWebDAVClient:
+    """Cliente WebDAV asíncrono con un pool de conexiones keep-alive.
+
+    Implementa directamente PUT, MKCOL y PROPFIND sobre httpx para que las
+    transferencias no bloqueen el bucle de eventos del bot.
+
+    Las operaciones que crean archivos aceptan `on_conflict`: si se indica, nunca
+    sobrescriben un archivo existente (Overwrite: F) y, cuando el destino ya existe,
+    se espera de `on_conflict(ruta)` otra ruta donde reintentarlo.
+    """
+
+    def __init__(self, hostname, username, password, max_connections=10, timeout=300.0,
+                 chunked_uploads=True, chunk_threshold=50 * 1024 * 1024,
+                 chunk_size=10 * 1024 * 1024, chunk_parallelism=3, atomic_uploads=True, bandwidth=None):
+        self.base_url = (hostname or '').rstrip('/')
+        parsed = urlparse(self.base_url)
+        self.origin = f"{parsed.scheme}://{parsed.netloc}"
+        self.base_path = unquote(parsed.path).rstrip('/')
+        # Colección de subidas por fragmentos (solo en servidores Nextcloud)
+        match = NEXTCLOUD_FILES_RE.match(self.base_path)
+        self.uploads_path = f"{match['root']}/uploads/{match['user']}" if match and chunked_uploads else None
+        self.chunk_threshold = chunk_threshold
+        self.chunk_size = chunk_size
+        self.chunk_parallelism = chunk_parallelism
+        self.atomic_uploads = atomic_uploads
+        self.bandwidth = bandwidth
+        self._auth = (username or '', password or '')
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections
+        )
+        self._timeout = httpx.Timeout(timeout, connect=30.0)
+        self._client = None
+
+    @property
+    def client(self):
+        # Se crea bajo demanda para que quede ligado al bucle de eventos activo
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                auth=self._auth,
+                limits=self._limits,
+                timeout=self._timeout,
+                follow_redirects=True
+            )
+        return self._client
+
+    def url(self, path):
+        return self.base_url + quote('/' + path.lstrip('/'))
+
+    def absolute_url(self, path):
+        """URL de una ruta absoluta del servidor, fuera del directorio base"""
+        return self.origin + quote(path)
+
+    async def send(self, method, url, expected=(), **kwargs):
+        """Lanza una petición y eleva httpx.HTTPStatusError si el estado no es válido"""
+        response = await self.client.request(method, url, **kwargs)
+        if response.status_code >= 400 and response.status_code not in expected:
+            response.raise_for_status()
+        return response
+
+    async def request(self, method, path, expected=(), **kwargs):
+        return await self.send(method, self.url(path), expected=expected, **kwargs)
+
+    def _parse_multistatus(self, content):
+        entries = []
+        for response in ET.fromstring(content).iter(f'{DAV_NS}response'):
+            href = unquote(urlparse(response.findtext(f'{DAV_NS}href', '')).path)
+            if href.startswith(self.base_path):
+                href = href[len(self.base_path):]
+            size = response.findtext(f'.//{DAV_NS}getcontentlength')
+            entries.append({
+                'path': '/' + href.strip('/'),
+                'is_dir': response.find(f'.//{DAV_NS}resourcetype/{DAV_NS}collection') is not None,
+                'size': int(size) if size and size.isdigit() else 0,
+                'etag': response.findtext(f'.//{DAV_NS}getetag'),
+            })
+        return entries
+
+    async def propfind(self, path, depth=1):
+        response = await self.request(
+            'PROPFIND', path,
+            content=PROPFIND_BODY,
+            headers={'Depth': str(depth), 'Content-Type': 'application/xml; charset=utf-8'}
+        )
+        return self._parse_multistatus(response.content)
+
+    async def check(self, path):
+        """Indica si existe el recurso remoto"""
+        response = await self.request('PROPFIND', path, expected=(404,), headers={'Depth': '0'})
+        return response.status_code != 404
+
+    async def info(self, path):
+        """Devuelve las propiedades del recurso remoto o None si no existe"""
+        response = await self.request(
+            'PROPFIND', path,
+            expected=(404,),
+            content=PROPFIND_BODY,
+            headers={'Depth': '0', 'Content-Type': 'application/xml; charset=utf-8'}
+        )
+        if response.status_code == 404:
+            return None
+        entries = self._parse_multistatus(response.content)
+        return entries[0] if entries else None
+
+    async def list(self, path='/'):
+        """Lista el contenido de un directorio con una única petición PROPFIND (Depth: 1)"""
+        own_path = '/' + path.strip('/')
+        return [entry for entry in await self.propfind(path, depth=1) if entry['path'] != own_path]
+
+    async def place(self, method, source_url, remote_path, on_conflict=None, headers=None):
+        """Copia o mueve (COPY/MOVE) un recurso a `remote_path`.
+
+        Devuelve las propiedades del archivo resultante con la ruta finalmente usada.
+        """
+        while True:
+            response = await self.send(
+                method, source_url,
+                expected=(412,) if on_conflict else (),
+                headers={
+                    **(headers or {}),
+                    'Destination': self.url(remote_path),
+                    'Overwrite': 'F' if on_conflict else 'T'
+                }
+            )
+            if response.status_code != 412:
+                return self._uploaded(response, remote_path)
+            remote_path = await on_conflict(remote_path)
+
+    def _uploaded(self, response, remote_path, size=None):
+        return {
+            'path': remote_path,
+            'is_dir': False,
+            'size': size,
+            'etag': response.headers.get('OC-ETag') or response.headers.get('ETag'),
+        }
+
+    async def copy(self, source_path, remote_path, on_conflict=None):
+        """Copia un recurso en el propio servidor, sin transferir su contenido"""
+        return await self.place('COPY', self.url(source_path), remote_path, on_conflict)
+
+    async def move(self, source_path, remote_path, on_conflict=None):
+        return await self.place('MOVE', self.url(source_path), remote_path, on_conflict)
+
+    async def delete(self, path):
+        await self.request('DELETE', path, expected=(404,))
+
+    async def mkdir(self, path):
+        """Crea un directorio; devuelve False si ya existía (405)"""
+        response = await self.request('MKCOL', path, expected=(405,))
+        return response.status_code != 405
+
+    async def upload_stream(self, chunks, remote_path, size=None, key=None, on_conflict=None, progress=None):
+        """Sube el contenido de un iterador asíncrono de bloques de bytes.
+
+        Los archivos grandes se suben por fragmentos si el servidor lo admite; el
+        resto con un único PUT, a un nombre temporal oculto que se renombra al
+        terminar si las subidas atómicas están activas. Si se conoce el tamaño se
+        envía como Content-Length; si no, la petición usa Transfer-Encoding: chunked.
+        `key` identifica el archivo de origen para poder retomar una subida por
+        fragmentos y `progress`, si se indica, un TransferProgress que lleva la cuenta
+        de los bytes enviados. Devuelve las propiedades del archivo subido.
+        """
+        if self.bandwidth is not None:
+            chunks = shaped(chunks, self.bandwidth)
+        if progress is not None:
+            progress.begin('subiendo', size)
+            chunks = progress.track(chunks)
+        if self.uploads_path and size is not None and size >= self.chunk_threshold:
+            try:
+                return await self.upload_chunked(chunks, remote_path, size, key, on_conflict)
+            except ChunkingUnsupported as e:
+                logger.warning(f"Subida por fragmentos no disponible, se usará PUT: {str(e)}")
+                self.uploads_path = None
+        headers = {'Content-Length': str(size)} if size is not None else {}
+        if not self.atomic_uploads:
+            response = await self.request('PUT', remote_path, content=chunks, headers=headers)
+            return self._uploaded(response, remote_path, size)
+        
+        directory, name = posixpath.split(remote_path)
+        temporary_path = f"{directory}/.{name}.{os.urandom(6).hex()}.part"
+        try:
+            await self.request('PUT', temporary_path, content=chunks, headers=headers)
+            entry = await self.move(temporary_path, remote_path, on_conflict)
+        except BaseException:
+            try:
+                await asyncio.shield(self.delete(temporary_path))
+            except Exception as e:
+                logger.warning(f"No se pudo eliminar el archivo temporal {temporary_path}: {str(e)}")
+            raise
+        entry['size'] = size
+        return entry
+
+    async def upload_chunked(self, chunks, remote_path, size, key=None, on_conflict=None):
+        """Sube un archivo con el protocolo de subida por fragmentos v2 de Nextcloud.
+
+        Los fragmentos se envían en paralelo a una colección temporal y al final se
+        ensamblan con un MOVE. El identificador de la subida se deriva del origen y
+        del tamaño, así que un reintento omite los fragmentos ya confirmados por el
+        servidor. Eleva ChunkingUnsupported antes de consumir `chunks` si el
+        servidor no admite el protocolo.
+        """
+        destination = self.url(remote_path)
+        transfer_id = hashlib.sha1(f"{key or remote_path}:{size}".encode()).hexdigest()
+        upload_dir = f"{self.uploads_path}/telegram-webdav-{transfer_id}"
+        headers = {'Destination': destination, 'OC-Total-Length': str(size)}
+        
+        # Fragmentos confirmados en un intento anterior
+        confirmed = {}
+        response = await self.send(
+            'PROPFIND', self.absolute_url(upload_dir),
+            expected=(403, 404, 405, 501),
+            content=PROPFIND_BODY,
+            headers={'Depth': '1', 'Content-Type': 'application/xml; charset=utf-8'}
+        )
+        if response.status_code == 207:
+            for entry in self._parse_multistatus(response.content):
+                if not entry['is_dir']:
+                    confirmed[posixpath.basename(entry['path'])] = entry['size']
+        else:
+            response = await self.send(
+                'MKCOL', self.absolute_url(upload_dir),
+                expected=(403, 404, 405, 409, 501),
+                headers={'Destination': destination}
+            )
+            if response.status_code >= 400:
+                raise ChunkingUnsupported(f"MKCOL {upload_dir}: {response.status_code}")
+        if confirmed:
+            logger.info(f"Retomando subida de {remote_path}: {len(confirmed)} fragmentos ya enviados")
+        
+        slots = asyncio.Semaphore(self.chunk_parallelism)
+        tasks = []
+
+        async def put_chunk(number, data):
+            try:
+                url = self.absolute_url(f"{upload_dir}/{number}")
+                for attempt in range(CHUNK_PUT_ATTEMPTS):
+                    try:
+                        await self.send('PUT', url, content=data, headers=headers)
+                        return
+                    except httpx.TransportError:
+                        if attempt == CHUNK_PUT_ATTEMPTS - 1:
+                            raise
+                        await asyncio.sleep(2 ** attempt)
+            finally:
+                slots.release()
+
+        async def dispatch(number, data):
+            if confirmed.get(str(number)) == len(data):
+                return
+            # Abandonar en cuanto falle un fragmento
+            for task in tasks:
+                if task.done() and task.exception():
+                    raise task.exception()
+            await slots.acquire()
+            tasks.append(asyncio.create_task(put_chunk(number, data)))
+
+        number = 0
+        buffer = bytearray()
+        try:
+            async for chunk in chunks:
+                buffer += chunk
+                while len(buffer) >= self.chunk_size:
+                    number += 1
+                    await dispatch(number, bytes(buffer[:self.chunk_size]))
+                    del buffer[:self.chunk_size]
+            if buffer or not number:
+                number += 1
+                await dispatch(number, bytes(buffer))
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        
+        # Ensamblar el archivo final
+        entry = await self.place(
+            'MOVE', self.absolute_url(f"{upload_dir}/.file"), remote_path, on_conflict,
+            headers={'OC-Total-Length': str(size)}
+        )
+        entry['size'] = size
+        return entry
+
+    async def upload(self, local_path, remote_path, key=None, on_conflict=None, progress=None):
+        """Sube un archivo local leyéndolo por bloques fuera del bucle de eventos"""
+        return await self.upload_stream(
+            read_file_chunks(local_path),
+            remote_path,
+            size=os.path.getsize(local_path),
+            key=key,
+            on_conflict=on_conflict,
+            progress=progress
+        )
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+webdav_client = AsyncWebDAVClient(
+    WEBDAV_HOSTNAME,
+    WEBDAV_USERNAME,
+    WEBDAV_PASSWORD,
+    max_connections=WEBDAV_MAX_CONNECTIONS,
+    timeout=WEBDAV_TIMEOUT,
+    chunked_uploads=WEBDAV_CHUNKED_UPLOADS,
+    chunk_threshold=WEBDAV_CHUNK_THRESHOLD,
+    chunk_size=WEBDAV_CHUNK_SIZE,
+    chunk_parallelism=WEBDAV_CHUNK_PARALLELISM,
+    atomic_uploads=WEBDAV_ATOMIC_UPLOADS,
+    bandwidth=webdav_bandwidth
+)
+
+# Métricas de Prometheus
+STAGE_SECONDS = prometheus.Histogram(
+    'telegram_webdav_stage_seconds',
+    'Duración de cada etapa de las transferencias de canales',
+    ['stage', 'media_type'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+)
+TRANSFERRED_BYTES = prometheus.Counter(
+    'telegram_webdav_transferred_bytes',
+    'Bytes transferidos de Telegram a WebDAV',
+    ['channel', 'media_type']
+)
+TRANSFERS = prometheus.Counter(
+    'telegram_webdav_transfers',
+    'Transferencias terminadas por resultado (uploaded, deduplicated, archived, skipped, error)',
+    ['channel', 'media_type', 'result']
+)
+TRANSFER_ERRORS = prometheus.Counter(
+    'telegram_webdav_errors',
+    'Errores de transferencia por servicio que los originó (webdav, telegram, other)',
+    ['channel', 'media_type', 'service']
+)
+TRANSFERS_IN_FLIGHT = prometheus.Gauge('telegram_webdav_transfers_in_flight', 'Transferencias en curso')
+TRANSFERS_QUEUED = prometheus.Gauge('telegram_webdav_transfers_queued', 'Transferencias en la cola del planificador')
+TRANSFERS_RETRYING = prometheus.Gauge('telegram_webdav_transfers_retrying', 'Transferencias esperando para reintentar')
+RATE_LIMITS = prometheus.Gauge(
+    'telegram_webdav_rate_limit',
+    'Límite configurado: llamadas/s a Telegram, mensajes/s por chat o bytes/s hacia WebDAV (0 = sin límite)',
+    ['limiter']
+)
+THROTTLED_SECONDS = prometheus.Counter(
+    'telegram_webdav_throttled_seconds',
+    'Tiempo de espera impuesto por los limitadores de Telegram y de WebDAV',
+    ['limiter']
+)
+TELEGRAM_RETRY_AFTER = prometheus.Counter(
+    'telegram_webdav_telegram_retry_after',
+    'Llamadas a la Bot API rechazadas por control de flujo (RetryAfter)',
+    ['endpoint']
+)
+
+def start_metrics_server():
+    if METRICS_PORT:
+        prometheus.start_http_server(int(METRICS_PORT))
+        logger.info(f"Métricas disponibles en el puerto {METRICS_PORT}")
+
+def error_service(error):
+    """Servicio que originó un error: 'webdav', 'telegram' u 'other'"""
+    if isinstance(error, httpx.HTTPError):
+        try:
+            host = error.request.url.host
+        except RuntimeError:
+            return 'other'
+        return 'webdav' if host == urlparse(webdav_client.base_url).hostname else 'telegram'
+    if isinstance(error, TelegramError):
+        return 'telegram'
+    return 'other'
+
+def transient_error(error):
+    """Si un error es pasajero (de red, 5xx o control de flujo) y merece reintentarse
+    sin límite; los errores de petición de Telegram (BadRequest) nunca lo son"""
+    if isinstance(error, BadRequest):
+        return False
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, (httpx.TransportError, NetworkError, RetryAfter, ConnectionError, TimeoutError))
+
+async def counted(chunks, counter):
+    """Suma al contador los bytes de cada bloque que pasa por el iterador"""
+    async for chunk in chunks:
+        counter.inc(len(chunk))
+        yield chunk
+
+class DirectoryIndex:
+    """Índice en memoria de los directorios de la raíz del WebDAV.
+
+    Se construye con un único PROPFIND (Depth: 1). Cuando caduca se comprueba
+    primero el ETag de la raíz y solo se vuelve a listar si ha cambiado; la
+    comprobación se hace en segundo plano mientras se sigue sirviendo el índice
+    existente, de modo que consultarlo no implica ninguna petición a WebDAV.
+    """
+
+    def __init__(self, client, ttl):
+        self.client = client
+        self.ttl = ttl
+        self._directories = set()
+        self._etag = None
+        self._loaded_at = None
+        self._refresh_task = None
+
+    @property
+    def expired(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    async def refresh(self):
+        # Si el ETag de la raíz no ha cambiado, el índice sigue siendo válido
+        if self._etag is not None:
+            root = await self.client.info('/')
+            if root and root['etag'] == self._etag:
+                self._loaded_at = time.monotonic()
+                return
+        directories = set()
+        etag = None
+        for entry in await self.client.propfind('/', depth=1):
+            if entry['path'] == '/':
+                etag = entry['etag']
+            elif entry['is_dir'] and not posixpath.basename(entry['path']).startswith('.'):
+                # Las carpetas ocultas (como la de STAGING_DIR) no se ofrecen como destino
+                directories.add(entry['path'])
+        self._directories = directories
+        self._etag = etag
+        self._loaded_at = time.monotonic()
+
+    async def _background_refresh(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            logger.error(f"Error al listar directorios: {str(e)}")
+
+    def schedule_refresh(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._background_refresh())
+        return self._refresh_task
+
+    async def get(self):
+        """Devuelve los directorios conocidos; solo espera a WebDAV si aún no hay índice"""
+        if self._loaded_at is None:
+            await self.schedule_refresh()
+        elif self.expired:
+            self.schedule_refresh()
+        return set(self._directories)
+
+    def add(self, directory):
+        """Registra un directorio creado por el propio bot sin volver a listar"""
+        if directory.count('/') == 1:
+            self._directories.add(directory)
+
+directory_index = DirectoryIndex(webdav_client, DIRECTORY_INDEX_TTL)
+
+class RemoteNames:
+    """Asigna a cada archivo una ruta remota sin pisar otros archivos.
+
+    Guarda en caché el listado de cada directorio de destino (un PROPFIND Depth: 1
+    que caduca a los `ttl` segundos) y las rutas reservadas por las transferencias en
+    curso, de modo que dos archivos con el mismo nombre nunca eligen el mismo
+    destino. La última palabra la tiene el servidor: las subidas terminan con un
+    MOVE/COPY sin sobrescribir y, si el destino apareció entretanto, se pasa al
+    siguiente nombre libre con next_free().
+    """
+
+    def __init__(self, client, policy, ttl):
+        self.client = client
+        self.policy = policy
+        self.ttl = ttl
+        self._listings = {}
+        self._locks = {}
+        self._reserved = set()
+
+    async def listing(self, directory):
+        """Archivos del directorio por nombre (vacío si el directorio aún no existe)"""
+        cached = self._listings.get(directory)
+        if cached and time.monotonic() - cached[0] <= self.ttl:
+            return cached[1]
+        async with self._locks.setdefault(directory, asyncio.Lock()):
+            cached = self._listings.get(directory)
+            if cached and time.monotonic() - cached[0] <= self.ttl:
+                return cached[1]
+            try:
+                entries = await self.client.list(directory)
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code != 404:
+                    raise
+                entries = []
+            names = {posixpath.basename(entry['path']): entry for entry in entries}
+            self._listings[directory] = (time.monotonic(), names)
+            return names
+
+    def _free(self, remote_path, names):
+        directory, name = posixpath.split(remote_path)
+        stem, extension = posixpath.splitext(name)
+        number = 0
+        while name in names or remote_path in self._reserved:
+            number += 1
+            name = f"{stem} ({number}){extension}"
+            remote_path = f"{directory}/{name}"
+        return remote_path
+
+    @staticmethod
+    def clean(file_name):
+        """Nombre válido como último componente de una ruta remota (sin barras ni
+        caracteres de control, y sin punto inicial para no chocar con los temporales)"""
+        return re.sub(r'[\x00-\x1f/\\]', '_', file_name).strip().lstrip('.') or '_'
+
+    async def claim(self, directory, file_name, size=None, etags=(), known=()):
+        """Reserva la ruta donde guardar un archivo.
+
+        Devuelve None si el archivo ya está en el servidor: el destino es una copia
+        conocida del mismo archivo (`known`) o, con la política 'skip', tiene el mismo
+        tamaño o un ETag de una subida anterior del mismo archivo (`etags`).
+        """
+        file_name = self.clean(file_name)
+        remote_path = f"{directory}/{file_name}"
+        if self.policy == 'overwrite':
+            return remote_path
+        names = await self.listing(directory)
+        existing = names.get(file_name)
+        if existing and (remote_path in known or self.policy == 'skip' and (
+            (size is not None and existing['size'] == size) or (existing['etag'] and existing['etag'] in etags)
+        )):
+            return None
+        remote_path = self._free(remote_path, names)
+        self._reserved.add(remote_path)
+        return remote_path
+
+    async def next_free(self, remote_path):
+        """Otra ruta para un archivo cuyo destino resultó estar ocupado en el servidor"""
+        directory, name = posixpath.split(remote_path)
+        names = await self.listing(directory)
+        names.setdefault(name, {'path': remote_path, 'is_dir': False, 'size': None, 'etag': None})
+        return self._free(remote_path, names)
+
+    @property
+    def on_conflict(self):
+        """Callback para el cliente WebDAV (None si se sobrescribe)"""
+        return None if self.policy == 'overwrite' else self.next_free
+
+    def release(self, remote_path, entry=None):
+        """Libera la reserva hecha con claim(); con `entry` (el archivo finalmente
+        creado) este queda anotado en el listado"""
+        self._reserved.discard(remote_path)
+        if entry:
+            cached = self._listings.get(posixpath.dirname(entry['path']))
+            if cached:
+                cached[1][posixpath.basename(entry['path'])] = entry
+
+remote_names = RemoteNames(webdav_client, CONFLICT_POLICY, DIRECTORY_INDEX_TTL)
+
+# Obtener lista de directorios disponibles
+async def get_available_directories():
+    directories = set(channel_router.static_directories())
+    directories.update(await directory_index.get())
+    return sorted(list(directories))
+
+# Cliente HTTP para descargar archivos de Telegram (separado del de WebDAV para
+# no enviar sus credenciales a otros servidores)
+_telegram_download_client = None
+
+def get_telegram_download_client():
+    global _telegram_download_client
+    if _telegram_download_client is None:
+        _telegram_download_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(WEBDAV_TIMEOUT, connect=30.0),
+            follow_redirects=True
+        )
+    return _telegram_download_client
+
+def bot_api_settings():
+    """Parámetros del Bot para usar un servidor propio de la Bot API"""
+    settings = {}
+    if TELEGRAM_API_URL:
+        settings['base_url'] = TELEGRAM_API_URL
+        settings['base_file_url'] = TELEGRAM_FILE_URL or re.sub(r'/bot$', '/file/bot', TELEGRAM_API_URL.rstrip('/'))
+    if TELEGRAM_LOCAL_MODE:
+        settings['local_mode'] = True
+    return settings
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """Limita las llamadas a la Bot API para no provocar errores de control de flujo.
+
+    Todas las llamadas pasan por un cubo global y los envíos y ediciones de mensajes,
+    además, por uno de su chat. Si Telegram responde con RetryAfter se detienen todas
+    las llamadas durante el tiempo indicado y se reintenta hasta `max_retries` veces.
+    """
+
+    MESSAGE_ENDPOINTS = ('send', 'edit', 'copy', 'forward', 'delete')
+
+    def __init__(self, rate, chat_rate, max_retries):
+        self.bucket = TokenBucket('telegram', rate)
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        self._chats = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def configure(self, rate=None, chat_rate=None):
+        if rate is not None:
+            self.bucket.configure(rate)
+        if chat_rate is not None:
+            self.chat_rate = chat_rate
+            for bucket in self._chats.values():
+                bucket.configure(chat_rate)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id') if endpoint.startswith(self.MESSAGE_ENDPOINTS) else None
+        attempts = 0
+        while True:
+            await self.bucket.acquire()
+            if chat_id is not None:
+                bucket = self._chats.get(chat_id)
+                if bucket is None:
+                    bucket = self._chats[chat_id] = TokenBucket('telegram_chat', self.chat_rate)
+                await bucket.acquire()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                attempts += 1
+                TELEGRAM_RETRY_AFTER.labels(endpoint).inc()
+                if attempts > self.max_retries:
+                    raise
+                logger.warning(f"Telegram pide esperar {e.retry_after} s antes de repetir {endpoint}")
+                self.bucket.pause(e.retry_after)
+
+telegram_rate_limiter = TelegramRateLimiter(TELEGRAM_RATE_LIMIT, TELEGRAM_CHAT_RATE_LIMIT, TELEGRAM_MAX_RETRIES)
+
+async def get_telegram_file(bot, file_id):
+    return await bot.get_file(file_id, read_timeout=TELEGRAM_GET_FILE_TIMEOUT)
+
+def telegram_local_path(file):
+    """Ruta del archivo en el volumen del servidor local de la Bot API, o None"""
+    if not TELEGRAM_LOCAL_MODE or not file.file_path:
+        return None
+    path = file.file_path
+    # python-telegram-bot antepone la URL de descarga a las rutas que no existen en
+    # esta máquina (volumen montado en otra ruta, ver TELEGRAM_LOCAL_PATH_MAP)
+    url_prefix = f"{file.get_bot().base_file_url}/"
+    if path.startswith(url_prefix) and os.path.isabs(path[len(url_prefix):]):
+        path = path[len(url_prefix):]
+    if not os.path.isabs(path):
+        return None
+    if ':' in TELEGRAM_LOCAL_PATH_MAP:
+        server_prefix, local_prefix = TELEGRAM_LOCAL_PATH_MAP.split(':', 1)
+        if path.startswith(server_prefix):
+            path = local_prefix + path[len(server_prefix):]
+    return path
+
+async def stream_telegram_file(file, chunk_size=STREAM_CHUNK_SIZE):
+    """Descarga un archivo de Telegram por bloques sin escribirlo en disco"""
+    async with get_telegram_download_client().stream('GET', file.file_path) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(chunk_size):
+            yield chunk
+
+async def save_chunks(chunks, local_path, size=None, progress=None):
+    """Escribe en disco los bloques de un archivo según se descargan"""
+    if progress is not None:
+        progress.begin('descargando', size)
+        chunks = progress.track(chunks)
+    with open(local_path, 'wb') as f:
+        async for chunk in chunks:
+            await asyncio.to_thread(f.write, chunk)
+
+async def download_telegram_file(file, local_path, progress=None):
+    """Descarga un archivo de Telegram a disco por bloques, sin cargarlo entero en memoria"""
+    await save_chunks(stream_telegram_file(file), local_path, file.file_size, progress)
+
+async def bot_api_source(bot, job):
+    """Contenido del archivo de un trabajo según la Bot API.
+
+    Devuelve los bloques del archivo, su tamaño y, si el archivo está en el volumen
+    del servidor local de la Bot API, su ruta (None si se descarga por HTTP).
+    """
+    file = await get_telegram_file(bot, job.file_id)
+    source_path = telegram_local_path(file)
+    if source_path:
+        return read_file_chunks(source_path), os.path.getsize(source_path), source_path
+    return stream_telegram_file(file), file.file_size, None
+
+async def buffered(chunks, max_chunks=STREAM_BUFFER_CHUNKS):
+    """Desacopla productor y consumidor de bloques mediante un búfer acotado.
+
+    La descarga avanza en paralelo a la subida hasta llenar el búfer, de modo que
+    la memoria usada no depende del tamaño del archivo.
+    """
+    queue = asyncio.Queue(maxsize=max_chunks)
+    done = object()
+
+    async def produce():
+        try:
+            async for chunk in chunks:
+                await queue.put(chunk)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(done)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        producer.cancel()
+
+# Etiquetas para los mensajes de log según el tipo de archivo
+MEDIA_LABELS = {
+    'document': ('archivo', 'Archivo', 'subido'),
+    'video': ('video', 'Video', 'subido'),
+    'photo': ('foto', 'Foto', 'subida'),
+    'audio': ('audio', 'Audio', 'subido'),
+}
+
+@dataclass
+class TransferJob:
+    """Archivo recibido de un canal pendiente de transferir a WebDAV.
+
+    Un álbum es un único trabajo (media_type 'album') cuyos archivos están en
+    `items`, cada uno con los campos de archivo de un TransferJob.
+    """
+    chat_id: int
+    media_type: str
+    file_id: str
+    file_name: str
+    directory: str
+    file_unique_id: Optional[str] = None
+    file_size: Optional[int] = None
+    job_id: Optional[int] = None
+    attempts: int = 0
+    items: Optional[list] = None
+
+    def __post_init__(self):
+        # En SQLite los archivos del álbum se guardan como JSON
+        if isinstance(self.items, str):
+            self.items = json.loads(self.items)
+
+def open_database(path):
+    """Abre (creándola si no existe) la base de datos SQLite local del bot"""
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path, isolation_level=None, timeout=30)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+JOB_FIELDS = (
+    'chat_id', 'media_type', 'file_id', 'file_name', 'directory', 'file_unique_id', 'file_size',
+    'job_id', 'attempts', 'items'
+)
+
+def encode_items(job):
+    return json.dumps(job.items) if job.items is not None else None
+
+class JobJournal:
+    """Registro persistente (SQLite) de las transferencias de canales.
+
+    Cada archivo recibido se anota antes de encolarlo y se borra al terminar su
+    transferencia, de modo que tras un reinicio se pueden retomar las pendientes.
+    Varios procesos trabajadores de la misma máquina pueden compartirlo como cola:
+    claim() reserva trabajos durante un tiempo limitado (lease) y, si el proceso
+    muere, otro los retoma al caducar la reserva.
+
+    Sus métodos son corrutinas, como los de RedisJobJournal, aunque SQLite se
+    consulta directamente: es un archivo local.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+
+    def open(self):
+        self._db = open_database(self.path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' job_id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' chat_id INTEGER NOT NULL,'
+            ' media_type TEXT NOT NULL,'
+            ' file_id TEXT NOT NULL,'
+            ' file_name TEXT NOT NULL,'
+            ' directory TEXT NOT NULL,'
+            ' file_unique_id TEXT,'
+            ' file_size INTEGER,'
+            " state TEXT NOT NULL DEFAULT 'pending',"
+            ' attempts INTEGER NOT NULL DEFAULT 0,'
+            ' last_error TEXT,'
+            ' available_at REAL NOT NULL DEFAULT 0,'
+            ' owner TEXT,'
+            ' lease_until REAL,'
+            ' items TEXT,'
+            ' updated_at REAL NOT NULL)'
+        )
+        # Registros creados por versiones anteriores
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(jobs)')}
+        for column, definition in (
+            ('file_unique_id', 'TEXT'),
+            ('file_size', 'INTEGER'),
+            ('available_at', 'REAL NOT NULL DEFAULT 0'),
+            ('owner', 'TEXT'),
+            ('lease_until', 'REAL'),
+            ('items', 'TEXT'),
+        ):
+            if column not in columns:
+                self._db.execute(f'ALTER TABLE jobs ADD COLUMN {column} {definition}')
+
+    async def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    async def add(self, job, state='pending'):
+        """Anota un trabajo; los álbumes que aún reciben archivos van como 'collecting'"""
+        cursor = self._db.execute(
+            'INSERT INTO jobs (chat_id, media_type, file_id, file_name, directory, file_unique_id, file_size,'
+            ' state, items, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (job.chat_id, job.media_type, job.file_id, job.file_name, job.directory,
+             job.file_unique_id, job.file_size, state, encode_items(job), time.time())
+        )
+        job.job_id = cursor.lastrowid
+
+    async def update(self, job, state, error=None, delay=0):
+        """Cambia el estado; un trabajo 'pending' no se entrega hasta pasados `delay` segundos"""
+        now = time.time()
+        self._db.execute(
+            'UPDATE jobs SET state = ?, directory = ?, file_size = ?, attempts = ?, items = ?, last_error = ?,'
+            ' available_at = ?, updated_at = ? WHERE job_id = ?',
+            (state, job.directory, job.file_size, job.attempts, encode_items(job), error, now + delay, now,
+             job.job_id)
+        )
+
+    async def close_albums(self, window):
+        """Entrega los álbumes que dejaron de recibir archivos hace más de `window` segundos
+        (su proceso se detuvo antes de cerrarlos)"""
+        self._db.execute(
+            "UPDATE jobs SET state = 'pending' WHERE state = 'collecting' AND updated_at < ?",
+            (time.time() - window,)
+        )
+
+    async def finish(self, job):
+        # Los documentos archivados siguen anotados hasta que se sube su archivador
+        self._db.execute("DELETE FROM jobs WHERE job_id = ? AND state != 'archived'", (job.job_id,))
+
+    async def finish_archived(self, job_ids):
+        """Borra los trabajos cuyo archivador diario ya se subió"""
+        self._db.executemany('DELETE FROM jobs WHERE job_id = ?', [(job_id,) for job_id in job_ids])
+
+    async def unfinished(self):
+        """Transferencias que no llegaron a completarse, en orden de llegada"""
+        rows = self._db.execute(
+            f"SELECT {', '.join(JOB_FIELDS)} FROM jobs"
+            " WHERE state IN ('pending', 'running') ORDER BY job_id"
+        )
+        return [TransferJob(*row) for row in rows]
+
+    async def claim(self, owner, limit, lease):
+        """Reserva hasta `limit` trabajos disponibles (o con la reserva caducada)"""
+        now = time.time()
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            rows = self._db.execute(
+                f"SELECT {', '.join(JOB_FIELDS)} FROM jobs"
+                " WHERE (state = 'pending' AND available_at <= ?)"
+                " OR (state = 'running' AND lease_until < ?)"
+                ' ORDER BY job_id LIMIT ?',
+                (now, now, limit)
+            ).fetchall()
+            self._db.executemany(
+                "UPDATE jobs SET state = 'running', owner = ?, lease_until = ? WHERE job_id = ?",
+                [(owner, now + lease, row[JOB_FIELDS.index('job_id')]) for row in rows]
+            )
+            self._db.execute('COMMIT')
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        return [TransferJob(*row) for row in rows]
+
+    async def renew(self, jobs, lease):
+        """Prolonga la reserva de trabajos que siguen en curso"""
+        self._db.executemany(
+            'UPDATE jobs SET lease_until = ? WHERE job_id = ?',
+            [(time.time() + lease, job.job_id) for job in jobs]
+        )
+
+class RedisJobJournal:
+    """Cola de transferencias compartida en Redis para trabajadores en varias máquinas.
+
+    Ofrece la misma interfaz que JobJournal y usa el cliente asíncrono de Redis, de
+    modo que una consulta a un Redis en otra máquina no detiene el bucle de eventos. Los trabajos pendientes están en un
+    conjunto ordenado por el instante en que pasan a estar disponibles y los
+    reservados en otro ordenado por el fin de su reserva.
+    """
+
+    # Devuelve a la cola las reservas caducadas y reserva hasta ARGV[2] trabajos
+    CLAIM_SCRIPT = """
+    local now = tonumber(ARGV[1])
+    for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)) do
+        redis.call('ZREM', KEYS[2], id)
+        redis.call('ZADD', KEYS[1], now, id)
+    end
+    local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, tonumber(ARGV[2]))
+    for _, id in ipairs(ids) do
+        redis.call('ZREM', KEYS[1], id)
+        redis.call('ZADD', KEYS[2], ARGV[3], id)
+    end
+    return ids
+    """
+
+    def __init__(self, url, prefix='telegram-webdav'):
+        self.url = url
+        self.prefix = prefix
+        self._redis = None
+        self._claim = None
+
+    def key(self, name):
+        return f"{self.prefix}:{name}"
+
+    def open(self):
+        try:
+            import redis.asyncio
+        except ImportError:
+            raise RuntimeError("JOB_QUEUE_URL requiere el paquete 'redis' (pip install redis)")
+        self._redis = redis.asyncio.Redis.from_url(self.url)
+        self._claim = self._redis.register_script(self.CLAIM_SCRIPT)
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+
+    async def _save(self, job, **extra):
+        data = {field: getattr(job, field) for field in JOB_FIELDS}
+        data.update(extra)
+        await self._redis.hset(self.key('jobs'), job.job_id, json.dumps(data))
+
+    async def _load(self, ids):
+        if not ids:
+            return []
+        jobs = []
+        for raw in await self._redis.hmget(self.key('jobs'), ids):
+            if raw is not None:
+                data = json.loads(raw)
+                jobs.append(TransferJob(*(data.get(field) for field in JOB_FIELDS)))
+        return jobs
+
+    async def add(self, job, state='pending'):
+        job.job_id = await self._redis.incr(self.key('next_id'))
+        await self._save(job, state=state)
+        if state == 'archived':
+            await self._redis.sadd(self.key('archived'), job.job_id)
+        else:
+            await self._redis.zadd(self.key(state), {job.job_id: time.time()})
+
+    async def update(self, job, state, error=None, delay=0):
+        await self._save(job, state=state, last_error=error)
+        if state == 'collecting':
+            await self._redis.zadd(self.key('collecting'), {job.job_id: time.time()})
+        elif state == 'pending':
+            pipe = self._redis.pipeline()
+            pipe.zrem(self.key('leased'), job.job_id)
+            pipe.zrem(self.key('collecting'), job.job_id)
+            pipe.zadd(self.key('pending'), {job.job_id: time.time() + delay})
+            await pipe.execute()
+        elif state in ('failed', 'archived'):
+            pipe = self._redis.pipeline()
+            pipe.zrem(self.key('leased'), job.job_id)
+            pipe.zrem(self.key('pending'), job.job_id)
+            pipe.sadd(self.key(state), job.job_id)
+            await pipe.execute()
+
+    async def finish(self, job):
+        if await self._redis.sismember(self.key('archived'), job.job_id):
+            return
+        pipe = self._redis.pipeline()
+        pipe.zrem(self.key('leased'), job.job_id)
+        pipe.zrem(self.key('pending'), job.job_id)
+        pipe.hdel(self.key('jobs'), job.job_id)
+        await pipe.execute()
+
+    async def finish_archived(self, job_ids):
+        if job_ids:
+            pipe = self._redis.pipeline()
+            pipe.srem(self.key('archived'), *job_ids)
+            pipe.hdel(self.key('jobs'), *job_ids)
+            await pipe.execute()
+
+    async def close_albums(self, window):
+        now = time.time()
+        ids = await self._redis.zrangebyscore(self.key('collecting'), '-inf', now - window)
+        if ids:
+            pipe = self._redis.pipeline()
+            pipe.zrem(self.key('collecting'), *ids)
+            pipe.zadd(self.key('pending'), {job_id: now for job_id in ids})
+            await pipe.execute()
+
+    async def unfinished(self):
+        ids = await self._redis.zrange(self.key('pending'), 0, -1)
+        ids += await self._redis.zrange(self.key('leased'), 0, -1)
+        return sorted(await self._load(ids), key=lambda job: job.job_id)
+
+    async def claim(self, owner, limit, lease):
+        now = time.time()
+        ids = await self._claim(keys=[self.key('pending'), self.key('leased')], args=[now, limit, now + lease])
+        return await self._load(ids)
+
+    async def renew(self, jobs, lease):
+        if jobs:
+            await self._redis.zadd(self.key('leased'), {job.job_id: time.time() + lease for job in jobs}, xx=True)
+
+job_journal = RedisJobJournal(JOB_QUEUE_URL) if JOB_QUEUE_URL else JobJournal(JOURNAL_PATH)
+
+class MediaIndex:
+    """Índice (SQLite) de los archivos ya subidos a WebDAV.
+
+    Relaciona el file_unique_id de Telegram y el SHA-256 del contenido con la
+    ruta remota donde se guardó, para no volver a descargar ni subir un archivo
+    que ya está en el servidor.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+
+    def open(self):
+        self._db = open_database(self.path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS media ('
+            ' remote_path TEXT PRIMARY KEY,'
+            ' file_unique_id TEXT,'
+            ' sha256 TEXT,'
+            ' size INTEGER,'
+            ' etag TEXT,'
+            ' updated_at REAL NOT NULL)'
+        )
+        # Índices creados por versiones anteriores, sin la columna etag
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(media)')}
+        if 'etag' not in columns:
+            self._db.execute('ALTER TABLE media ADD COLUMN etag TEXT')
+        self._db.execute('CREATE INDEX IF NOT EXISTS media_file_unique_id ON media (file_unique_id)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS media_sha256 ON media (sha256)')
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def find(self, file_unique_id=None, sha256=None):
+        """Rutas remotas conocidas del mismo archivo, la más reciente primero"""
+        column, value = ('file_unique_id', file_unique_id) if file_unique_id else ('sha256', sha256)
+        if not value:
+            return []
+        rows = self._db.execute(
+            f'SELECT remote_path FROM media WHERE {column} = ? ORDER BY updated_at DESC', (value,)
+        )
+        return [row[0] for row in rows]
+
+    def etags(self, file_unique_id):
+        """ETags que devolvió el servidor en las subidas anteriores del archivo"""
+        if not file_unique_id:
+            return set()
+        rows = self._db.execute(
+            'SELECT etag FROM media WHERE file_unique_id = ? AND etag IS NOT NULL', (file_unique_id,)
+        )
+        return {row[0] for row in rows}
+
+    def add(self, remote_path, file_unique_id=None, sha256=None, size=None, etag=None):
+        self._db.execute(
+            'INSERT OR REPLACE INTO media (remote_path, file_unique_id, sha256, size, etag, updated_at)'
+            ' VALUES (?, ?, ?, ?, ?, ?)',
+            (remote_path, file_unique_id, sha256, size, etag, time.time())
+        )
+
+    def remove(self, remote_path):
+        self._db.execute('DELETE FROM media WHERE remote_path = ?', (remote_path,))
+
+media_index = MediaIndex(JOURNAL_PATH)
+
+# Escrituras periódicas del estado de las conversaciones; los datos de usuario se
+# guardan además en cuanto cambian (save_user_data)
+PERSISTENCE_UPDATE_INTERVAL = 5
+
+def compact_json(value):
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+class StatePersistence(BasePersistence):
+    """Persistencia de user_data y del estado de las conversaciones.
+
+    Los registros se guardan como JSON compacto, así que user_data solo debe
+    contener valores JSON (textos, números, listas y diccionarios). Antes de atender
+    cada actualización se vuelven a leer los datos del usuario, de modo que una
+    selección de directorio pendiente sobrevive a un reinicio y la puede terminar
+    cualquier proceso del bot que comparta el almacén. Cada registro lleva un número
+    de revisión: un proceso solo sobrescribe la versión que leyó, nunca una más
+    reciente escrita por otro. Los datos de chat, del bot y de los botones no se
+    guardan. Las subclases implementan el almacén con corrutinas.
+    """
+
+    def __init__(self, update_interval=PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        # Revisión leída o escrita por última vez de los datos de cada usuario
+        self._revisions = {}
+
+    async def get_user_data(self):
+        users = {}
+        for user_id, (revision, data) in (await self.load_users()).items():
+            self._revisions[user_id] = revision
+            users[user_id] = data
+        return users
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {tuple(json.loads(key)): json.loads(state) for key, state in await self.load_conversations(name)}
+
+    async def update_conversation(self, name, key, new_state):
+        await self.store_conversation(name, compact_json(key), None if new_state is None else compact_json(new_state))
+
+    async def update_user_data(self, user_id, data):
+        revision = await self.store_user(user_id, self._revisions.get(user_id, 0), compact_json(data))
+        if revision is None:
+            logger.debug(f"Datos del usuario {user_id} modificados por otro proceso, no se sobrescriben")
+        else:
+            self._revisions[user_id] = revision
+
+    async def drop_user_data(self, user_id):
+        await self.update_user_data(user_id, {})
+
+    async def refresh_user_data(self, user_id, user_data):
+        revision, data = await self.load_user(user_id)
+        self._revisions[user_id] = revision
+        user_data.clear()
+        user_data.update(data)
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        await self.close()
+
+class SQLitePersistence(StatePersistence):
+    """Estado de las conversaciones en la base de datos SQLite local del bot"""
+
+    def __init__(self, path, update_interval=PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(update_interval)
+        self.path = path
+        self._db = None
+
+    @property
+    def db(self):
+        # La aplicación lee la persistencia al inicializarse, antes de post_init
+        if self._db is None:
+            self._db = open_database(self.path)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS user_state ('
+                ' user_id INTEGER PRIMARY KEY,'
+                ' revision INTEGER NOT NULL,'
+                ' data TEXT NOT NULL)'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS conversations ('
+                ' name TEXT NOT NULL,'
+                ' key TEXT NOT NULL,'
+                ' state TEXT NOT NULL,'
+                ' PRIMARY KEY (name, key))'
+            )
+        return self._db
+
+    async def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    async def load_users(self):
+        rows = self.db.execute('SELECT user_id, revision, data FROM user_state')
+        return {user_id: (revision, json.loads(data)) for user_id, revision, data in rows}
+
+    async def load_user(self, user_id):
+        row = self.db.execute('SELECT revision, data FROM user_state WHERE user_id = ?', (user_id,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else (0, {})
+
+    async def store_user(self, user_id, revision, data):
+        """Guarda los datos si la revisión guardada sigue siendo `revision`; devuelve la
+        nueva revisión o None si otro proceso los cambió entretanto"""
+        if revision:
+            cursor = self.db.execute(
+                'UPDATE user_state SET revision = revision + 1, data = ? WHERE user_id = ? AND revision = ?',
+                (data, user_id, revision)
+            )
+        else:
+            cursor = self.db.execute(
+                'INSERT OR IGNORE INTO user_state (user_id, revision, data) VALUES (?, 1, ?)', (user_id, data)
+            )
+        return revision + 1 if cursor.rowcount else None
+
+    async def load_conversations(self, name):
+        return self.db.execute('SELECT key, state FROM conversations WHERE name = ?', (name,)).fetchall()
+
+    async def store_conversation(self, name, key, state):
+        if state is None:
+            self.db.execute('DELETE FROM conversations WHERE name = ? AND key = ?', (name, key))
+        else:
+            self.db.execute(
+                'INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)', (name, key, state)
+            )
+
+class RedisPersistence(StatePersistence):
+    """Estado de las conversaciones en Redis, compartido por procesos en varias máquinas.
+
+    Los datos de los usuarios y sus revisiones están en dos hashes y el estado de
+    cada conversación en un hash por ConversationHandler. Usa el cliente asíncrono
+    de Redis: leer los datos del usuario antes de cada actualización no detiene el
+    bucle de eventos.
+    """
+
+    # Guarda ARGV[3] en el campo ARGV[1] si su revisión sigue siendo ARGV[2]
+    STORE_SCRIPT = """
+    local revision = tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or '0')
+    if revision ~= tonumber(ARGV[2]) then
+        return false
+    end
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+    return redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+    """
+
+    def __init__(self, url, prefix='telegram-webdav', update_interval=PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(update_interval)
+        self.url = url
+        self.prefix = prefix
+        self._redis = None
+
+    def key(self, name):
+        return f"{self.prefix}:{name}"
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            try:
+                import redis.asyncio
+            except ImportError:
+                raise RuntimeError("PERSISTENCE_URL requiere el paquete 'redis' (pip install redis)")
+            self._redis = redis.asyncio.Redis.from_url(self.url)
+        return self._redis
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+
+    async def load_users(self):
+        revisions = await self.redis.hgetall(self.key('user_revisions'))
+        return {
+            int(user_id): (int(revisions.get(user_id, 0)), json.loads(data))
+            for user_id, data in (await self.redis.hgetall(self.key('user_data'))).items()
+        }
+
+    async def load_user(self, user_id):
+        pipeline = self.redis.pipeline()
+        pipeline.hget(self.key('user_revisions'), user_id)
+        pipeline.hget(self.key('user_data'), user_id)
+        revision, data = await pipeline.execute()
+        return (int(revision), json.loads(data)) if data else (0, {})
+
+    async def store_user(self, user_id, revision, data):
+        store = self.redis.register_script(self.STORE_SCRIPT)
+        result = await store(keys=[self.key('user_data'), self.key('user_revisions')], args=[user_id, revision, data])
+        return int(result) if result is not None else None
+
+    async def load_conversations(self, name):
+        return [
+            (key.decode(), state.decode())
+            for key, state in (await self.redis.hgetall(self.key(f"conversations:{name}"))).items()
+        ]
+
+    async def store_conversation(self, name, key, state):
+        if state is None:
+            await self.redis.hdel(self.key(f"conversations:{name}"), key)
+        else:
+            await self.redis.hset(self.key(f"conversations:{name}"), key, state)
+
+state_persistence = RedisPersistence(PERSISTENCE_URL) if PERSISTENCE_URL else SQLitePersistence(JOURNAL_PATH)
+
+async def save_user_data(update, context):
+    """Guarda ya los datos del usuario, sin esperar a la escritura periódica, para que
+    otro proceso del bot los vea en la siguiente actualización del usuario"""
+    if context.application.persistence is not None:
+        await context.application.persistence.update_user_data(update.effective_user.id, context.user_data)
+
+class DirectoryProvisioner:
+    """Garantiza que existen los directorios de destino en WebDAV (como mkdir -p).
+
+    Cada directorio se crea directamente con MKCOL y, si falta su padre (409), se
+    crea antes el padre. Aunque varias transferencias pidan el mismo directorio a la
+    vez, solo se lanza una comprobación. Los directorios verificados se guardan en la
+    base de datos local, así que tras un reinicio no se vuelven a comprobar hasta
+    pasados `ttl` segundos; si una subida revela que alguno ya no existe, se olvida
+    con forget() y el reintento lo vuelve a crear.
+    """
+
+    def __init__(self, client, path, ttl):
+        self.client = client
+        self.path = path
+        self.ttl = ttl
+        self._db = None
+        self._verified = {}
+        self._tasks = {}
+        self._startup = None
+
+    def open(self):
+        self._db = open_database(self.path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS directories ('
+            ' path TEXT PRIMARY KEY,'
+            ' verified_at REAL NOT NULL)'
+        )
+        self._verified = dict(self._db.execute('SELECT path, verified_at FROM directories'))
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def verified(self, directory):
+        verified_at = self._verified.get(directory)
+        return verified_at is not None and time.time() - verified_at <= self.ttl
+
+    async def ensure(self, directory):
+        """Espera a que exista el directorio, creándolo con sus padres si hace falta"""
+        directory = '/' + directory.strip('/')
+        if directory == '/' or self.verified(directory):
+            return
+        task = self._tasks.get(directory)
+        if task is None:
+            task = self._tasks[directory] = asyncio.create_task(self._provision(directory))
+            task.add_done_callback(lambda _: self._tasks.pop(directory, None))
+        await asyncio.shield(task)
+
+    async def _provision(self, directory):
+        try:
+            created = await self.client.mkdir(directory)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 409:
+                raise
+            # Falta algún directorio intermedio
+            await self.ensure(posixpath.dirname(directory))
+            created = await self.client.mkdir(directory)
+        if created:
+            logger.info(f"Directorio creado: {directory}")
+        # Si existe el directorio, existen también todos sus padres
+        now = time.time()
+        paths = []
+        while directory != '/':
+            paths.append(directory)
+            self._verified[directory] = now
+            directory = posixpath.dirname(directory)
+        if self._db is not None:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO directories (path, verified_at) VALUES (?, ?)',
+                [(path, now) for path in paths]
+            )
+
+    def forget(self, directory):
+        directory = '/' + directory.strip('/')
+        self._verified.pop(directory, None)
+        if self._db is not None:
+            self._db.execute('DELETE FROM directories WHERE path = ?', (directory,))
+
+    async def ensure_all(self, directories):
+        """Verifica en paralelo todos los directorios y registra los que fallen"""
+        directories = sorted(set(directories))
+        pending = [directory for directory in directories if not self.verified('/' + directory.strip('/'))]
+        results = await asyncio.gather(*(self.ensure(directory) for directory in pending), return_exceptions=True)
+        for directory, result in zip(pending, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error al verificar directorio {directory}: {str(result)}")
+        failed = sum(isinstance(result, Exception) for result in results)
+        logger.info(
+            f"Directorios verificados: {len(directories) - failed}/{len(directories)} "
+            f"({len(directories) - len(pending)} ya comprobados anteriormente)"
+        )
+
+    def start(self, directories):
+        """Lanza ensure_all() en segundo plano"""
+        self._startup = asyncio.create_task(self.ensure_all(directories))
+
+    async def stop(self):
+        if self._startup is not None and not self._startup.done():
+            self._startup.cancel()
+            await asyncio.gather(self._startup, return_exceptions=True)
+
+directory_provisioner = DirectoryProvisioner(webdav_client, JOURNAL_PATH, DIRECTORY_CACHE_TTL)
+
+async def hashed(chunks, digest):
+    """Actualiza `digest` con cada bloque que pasa por el iterador"""
+    async for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+async def file_sha256(local_path):
+    digest = hashlib.sha256()
+    async for chunk in read_file_chunks(local_path):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+async def copy_known_file(candidates, remote_path):
+    """Copia en el servidor la primera copia conocida que siga existiendo.
+
+    Devuelve la ruta de la copia utilizada (que puede ser la propia `remote_path`
+    si el archivo ya estaba allí) y las propiedades del archivo resultante, o
+    (None, None) si no queda ninguna.
+    """
+    for source_path in candidates:
+        try:
+            if source_path == remote_path:
+                entry = await webdav_client.info(remote_path)
+                if entry:
+                    return source_path, entry
+            else:
+                return source_path, await webdav_client.copy(
+                    source_path, remote_path, on_conflict=remote_names.on_conflict
+                )
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 404:
+                raise
+        # La copia conocida ya no existe en el servidor
+        media_index.remove(source_path)
+    return None, None
+
+def log_known_file(title, file_name, source_path, remote_path):
+    if source_path == remote_path:
+        logger.info(f"{title} {file_name}: ya estaba en {remote_path}, no se vuelve a transferir")
+    else:
+        logger.info(f"{title} {file_name}: copia en el servidor desde {source_path} a {remote_path}")
+
+# Transformaciones de los archivos de canales
+IMAGE_FORMATS = {'webp': 'WEBP', 'avif': 'AVIF'}
+ARCHIVE_FORMATS = ('zip', 'tar')
+TRANSFORMS = {*IMAGE_FORMATS, 'thumbnail', *ARCHIVE_FORMATS}
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp', '.avif'}
+THUMBNAIL_SUFFIX = '.thumb.jpg'
+
+# Las funciones siguientes se ejecutan en los procesos de MediaTransformer
+def convert_image(source_path, target_path, image_format, quality):
+    """Vuelve a codificar una imagen en `image_format` (WEBP, AVIF...)"""
+    from PIL import Image, ImageOps
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            transparent = 'A' in image.getbands() or 'transparency' in image.info
+            image = image.convert('RGBA' if transparent else 'RGB')
+        image.save(target_path, image_format, quality=quality)
+
+def make_thumbnail(source_path, target_path, size, quality):
+    """Miniatura JPEG de una imagen con su lado mayor de `size` píxeles como mucho"""
+    from PIL import Image, ImageOps
+    with Image.open(source_path) as image:
+        # Con JPEG se decodifica directamente a una resolución reducida
+        image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        image.convert('RGB').save(target_path, 'JPEG', quality=quality)
+
+def numbered_name(name, taken, same=lambda name: False):
+    """Primer nombre libre de la serie nombre, nombre (1), nombre (2)... o, si lo hay
+    antes, el de un archivo de la serie con el mismo contenido (`same`)"""
+    stem, extension = posixpath.splitext(name)
+    number = 0
+    while name in taken and not same(name):
+        number += 1
+        name = f"{stem} ({number}){extension}"
+    return name
+
+def append_to_archive(archive_path, source_path, name):
+    """Añade un archivo a un zip o tar (que se crea si no existe) y devuelve el nombre
+    que recibió dentro, numerado si ya había otro con el mismo nombre. Si ya estaba
+    dentro con el mismo contenido (un trabajo repetido) no se añade otra vez"""
+    with open(source_path, 'rb') as f:
+        content = f.read()
+    if archive_path.endswith('.zip'):
+        with zipfile.ZipFile(archive_path, 'a', zipfile.ZIP_DEFLATED) as archive:
+            members = {info.filename: info for info in archive.infolist()}
+            crc = zlib.crc32(content)
+            name = numbered_name(
+                name, members,
+                lambda member: members[member].file_size == len(content) and members[member].CRC == crc
+            )
+            if name not in members:
+                archive.write(source_path, name)
+        return name
+    members = {}
+    if os.path.exists(archive_path):
+        with tarfile.open(archive_path) as archive:
+            members = {member.name: member for member in archive.getmembers()}
+            name = numbered_name(
+                name, members,
+                lambda member: members[member].size == len(content)
+                and archive.extractfile(members[member]).read() == content
+            )
+    if name not in members:
+        with tarfile.open(archive_path, 'a') as archive:
+            archive.add(source_path, name)
+    return name
+
+class MediaTransformer:
+    """Transformaciones configuradas para los archivos de cada canal.
+
+    Con 'webp' o 'avif' las imágenes se guardan recodificadas en ese formato, con
+    'thumbnail' se guarda además una miniatura <nombre>.thumb.jpg junto a cada una
+    y con 'zip' o 'tar' los documentos de hasta `archive_max_size` bytes se añaden
+    a un archivador diario (ver DailyArchives). El trabajo de CPU se hace en un
+    grupo de `processes` procesos, que aprovecha todos los núcleos sin bloquear el
+    bucle de eventos.
+    """
+
+    def __init__(self, transforms, processes, quality, thumbnail_size, archive_max_size):
+        for chat_id, names in transforms.items():
+            unknown = names - TRANSFORMS
+            if unknown:
+                raise ValueError(f"Transformaciones desconocidas para el canal {chat_id}: {', '.join(sorted(unknown))}")
+            if len(names & IMAGE_FORMATS.keys()) > 1 or len(names.intersection(ARCHIVE_FORMATS)) > 1:
+                raise ValueError(f"El canal {chat_id} admite un solo formato de imagen y un solo tipo de archivador")
+        self.transforms = transforms
+        self.processes = processes
+        self.quality = quality
+        self.thumbnail_size = thumbnail_size
+        self.archive_max_size = archive_max_size
+        self._executor = None
+
+    def open(self):
+        """Comprueba que Pillow admite los formatos pedidos y arranca los procesos"""
+        names = set().union(*self.transforms.values())
+        if not names or self._executor is not None:
+            return
+        if names.difference(ARCHIVE_FORMATS):
+            try:
+                from PIL import features
+            except ImportError:
+                raise RuntimeError("Las transformaciones de imágenes requieren el paquete 'Pillow' (pip install Pillow)")
+            for name in names & IMAGE_FORMATS.keys():
+                if not features.check(name):
+                    raise RuntimeError(f"Pillow no admite el formato {name} en este sistema")
+        # Con fork los procesos heredan el módulo ya cargado (el script no se puede
+        # importar por su nombre); se arrancan ya, antes de que el bot cree otros hilos
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            self.processes, mp_context=multiprocessing.get_context('fork')
+        )
+        self._executor.submit(os.getpid).result()
+        logger.info(f"Transformaciones de archivos activas con {self.processes} procesos")
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    async def run(self, function, *args):
+        """Ejecuta `function(*args)` en uno de los procesos"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def plan(self, job):
+        """Transformaciones que se aplican al archivo de una transferencia"""
+        names = self.transforms.get(job.chat_id)
+        if not names:
+            return frozenset()
+        extension = posixpath.splitext(job.file_name)[1].lower()
+        plan = set()
+        if extension in IMAGE_EXTENSIONS:
+            plan = {name for name in names if name == 'thumbnail' or name in IMAGE_FORMATS and extension != f".{name}"}
+        if not plan and job.media_type == 'document' and job.file_size is not None and job.file_size <= self.archive_max_size:
+            plan = names.intersection(ARCHIVE_FORMATS)
+        return frozenset(plan)
+
+    async def convert(self, source_path, target_path, image_format):
+        await self.run(convert_image, source_path, target_path, IMAGE_FORMATS[image_format], self.quality)
+
+    async def thumbnail(self, source_path, target_path):
+        await self.run(make_thumbnail, source_path, target_path, self.thumbnail_size, self.quality)
+
+media_transformer = MediaTransformer(
+    CHANNEL_TRANSFORMS,
+    TRANSFORM_PROCESSES,
+    TRANSFORM_IMAGE_QUALITY,
+    TRANSFORM_THUMBNAIL_SIZE,
+    ARCHIVE_MAX_SIZE
+)
+
+class DailyArchives:
+    """Archivadores diarios de documentos pequeños.
+
+    Cada documento se añade a <path>/<directorio>/<AAAA-MM-DD>.<zip|tar> y el
+    archivador se sube entero a <directorio>/<AAAA-MM-DD>.<zip|tar> como mucho cada
+    `flush_interval` segundos, de modo que muchos documentos pequeños suponen unas
+    pocas subidas en lugar de una por documento. Los archivadores de días anteriores
+    se borran en local una vez subidos.
+
+    Varios procesos de la misma máquina (el bot, los trabajadores y la importación
+    del historial) pueden compartir `path`: cada directorio tiene un cerrojo de
+    archivo (flock) que se mantiene al añadir un documento y al subir o borrar sus
+    archivadores, así que cada subida lleva todo lo añadido por cualquiera de ellos.
+
+    El trabajo de cada documento queda en el registro como 'archived' y sus
+    identificadores en <archivador>.jobs; se da por terminado cuando el archivador
+    se sube, de modo que un corte antes de la subida no lo da por guardado.
+    """
+
+    def __init__(self, client, names, transformer, journal, path, flush_interval):
+        self.client = client
+        self.names = names
+        self.transformer = transformer
+        self.journal = journal
+        self.path = path
+        self.flush_interval = flush_interval
+        self._locks = {}
+        self._pending = set()
+        self._flush_task = None
+
+    @contextlib.asynccontextmanager
+    async def _locked(self, directory):
+        """Cerrojo del directorio entre las tareas de este proceso y entre procesos; el
+        día se decide ya dentro, así que nadie añade nada a un archivador de ayer
+        mientras se sube por última vez. Devuelve la carpeta local del directorio"""
+        async with self._locks.setdefault(directory, asyncio.Lock()):
+            folder = os.path.join(self.path, quote(directory, safe=''))
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, '.lock'), 'a') as lock_file:
+                await asyncio.to_thread(fcntl.flock, lock_file, fcntl.LOCK_EX)
+                try:
+                    yield folder
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    async def add(self, directory, archive_format, local_path, file_name, job):
+        """Añade el documento de una transferencia al archivador de hoy; devuelve la ruta
+        remota del archivador y el nombre que recibió el documento dentro"""
+        async with self._locked(directory) as folder:
+            name = f"{time.strftime('%Y-%m-%d')}.{archive_format}"
+            archive_path = os.path.join(folder, name)
+            member = await self.transformer.run(append_to_archive, archive_path, local_path, file_name)
+            if job.job_id is None:
+                await self.journal.add(job, 'archived')
+            else:
+                await self.journal.update(job, 'archived')
+            with open(f"{archive_path}.jobs", 'a') as f:
+                f.write(f"{job.job_id}\n")
+            self._pending.add(archive_path)
+        self._schedule()
+        return f"{directory}/{name}", member
+
+    def start(self):
+        """Programa la subida de los archivadores que quedaron de la ejecución anterior"""
+        if os.path.isdir(self.path):
+            for folder in os.scandir(self.path):
+                if folder.is_dir():
+                    for name in os.listdir(folder.path):
+                        if name.endswith(tuple(f".{archive_format}" for archive_format in ARCHIVE_FORMATS)):
+                            self._pending.add(os.path.join(folder.path, name))
+        if self._pending:
+            self._schedule()
+
+    def _schedule(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        await self.flush()
+        if self._pending:
+            # Reintentar los que fallaron en la próxima ronda
+            self._schedule()
+
+    async def flush(self):
+        """Sube los archivadores modificados y borra en local los de días anteriores"""
+        today = time.strftime('%Y-%m-%d')
+        for archive_path in sorted(self._pending):
+            directory = unquote(os.path.basename(os.path.dirname(archive_path)))
+            name = os.path.basename(archive_path)
+            remote_path = f"{directory}/{name}"
+            try:
+                async with self._locked(directory):
+                    if not os.path.exists(archive_path):
+                        # Otro proceso ya lo subió por última vez y lo borró
+                        self._pending.discard(archive_path)
+                        continue
+                    await directory_provisioner.ensure(directory)
+                    remote_path = await self._upload(archive_path, directory, name)
+                    await self._finish_jobs(archive_path)
+                    self._pending.discard(archive_path)
+                    if not name.startswith(today):
+                        os.remove(archive_path)
+                        os.remove(f"{archive_path}.remote")
+                logger.info(f"Archivador {remote_path} subido")
+            except Exception as e:
+                logger.error(f"Error al subir el archivador {remote_path}: {str(e)}")
+
+    async def _upload(self, archive_path, directory, name):
+        """Sube el archivador y devuelve su ruta remota. La primera vez el nombre se
+        reserva en remote_names, según CONFLICT_POLICY, y se guarda en
+        <archivador>.remote; las siguientes se sustituye ese mismo archivo"""
+        remote_file = f"{archive_path}.remote"
+        if os.path.exists(remote_file):
+            with open(remote_file) as f:
+                remote_path = f.read().strip()
+            await self.client.upload(archive_path, remote_path)
+            return remote_path
+        remote_path = await self.names.claim(directory, name)
+        entry = None
+        try:
+            entry = await self.client.upload(archive_path, remote_path, on_conflict=self.names.on_conflict)
+        finally:
+            self.names.release(remote_path, entry)
+        with open(remote_file, 'w') as f:
+            f.write(entry['path'])
+        return entry['path']
+
+    async def _finish_jobs(self, archive_path):
+        jobs_path = f"{archive_path}.jobs"
+        if os.path.exists(jobs_path):
+            with open(jobs_path) as f:
+                job_ids = [int(line) for line in f if line.strip()]
+            await self.journal.finish_archived(job_ids)
+            os.remove(jobs_path)
+
+    async def stop(self):
+        """Sube lo pendiente antes de terminar"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        # Los que fallen se subirán en la próxima ejecución
+        await self.flush()
+
+daily_archives = DailyArchives(
+    webdav_client,
+    remote_names,
+    media_transformer,
+    job_journal,
+    ARCHIVE_DIR,
+    ARCHIVE_FLUSH_INTERVAL
+)
+
+async def upload_thumbnail(local_path, remote_path, temp_dir):
+    """Guarda junto a `remote_path` una miniatura de la imagen, con el nombre reservado
+    en remote_names (foto.jpg y foto.png no comparten miniatura); si falla solo se avisa"""
+    directory, name = posixpath.split(remote_path)
+    thumbnail_name = posixpath.splitext(name)[0] + THUMBNAIL_SUFFIX
+    thumbnail_path = os.path.join(temp_dir, thumbnail_name)
+    thumbnail_remote = None
+    try:
+        await media_transformer.thumbnail(local_path, thumbnail_path)
+        thumbnail_remote = await remote_names.claim(directory, thumbnail_name, os.path.getsize(thumbnail_path))
+        if thumbnail_remote is None:
+            return
+        entry = await webdav_client.upload(thumbnail_path, thumbnail_remote, on_conflict=remote_names.on_conflict)
+        remote_names.release(thumbnail_remote, entry)
+    except Exception as e:
+        logger.warning(f"No se pudo guardar la miniatura {thumbnail_name} en {directory}: {str(e)}")
+    finally:
+        if thumbnail_remote:
+            remote_names.release(thumbnail_remote)
+
+async def transfer_to_webdav(bot, job, progress=None, source=bot_api_source):
+    """Transfiere un archivo de Telegram al directorio WebDAV indicado.
+
+    La ruta de destino se reserva en remote_names según CONFLICT_POLICY, así que
+    dos archivos con el mismo nombre no se pisan. Si el archivo ya se subió antes
+    (mismo file_unique_id o mismo contenido) se copia en el servidor en lugar de
+    volver a transferirlo. El contenido se obtiene con `source(bot, job)` (por
+    defecto, de la Bot API) y los bytes descargados y subidos se cuentan en
+    `progress`. Si el canal tiene transformaciones (CHANNEL_TRANSFORMS) el archivo
+    se descarga siempre a disco para aplicarlas antes de subirlo. Los errores se
+    registran y se propagan para que el planificador pueda reintentar.
+    """
+    label, title, uploaded = MEDIA_LABELS[job.media_type]
+    file_name, directory = job.file_name, job.directory
+    channel, media_type = str(job.chat_id), job.media_type
+    plan = media_transformer.plan(job)
+    image_format = next((name for name in plan if name in IMAGE_FORMATS), None)
+    archive_format = next((name for name in plan if name in ARCHIVE_FORMATS), None)
+    remote_path = None
+    temp_dir = None
+    
+    try:
+        with STAGE_SECONDS.labels('total', media_type).time():
+            await directory_provisioner.ensure(directory)
+            if archive_format:
+                # Los documentos pequeños van al archivador del día, que se sube aparte
+                with STAGE_SECONDS.labels('get_file', media_type).time():
+                    chunks, size, local_path = await source(bot, job)
+                if not local_path:
+                    temp_dir = tempfile.mkdtemp(prefix='telegram-webdav-', dir=TEMP_DIR)
+                    local_path = os.path.join(temp_dir, RemoteNames.clean(file_name))
+                    with STAGE_SECONDS.labels('download', media_type).time():
+                        await save_chunks(chunks, local_path, size, progress)
+                with STAGE_SECONDS.labels('transform', media_type).time():
+                    archive_path, member = await daily_archives.add(
+                        directory, archive_format, local_path, RemoteNames.clean(file_name), job
+                    )
+                TRANSFERS.labels(channel, media_type, 'archived').inc()
+                logger.info(f"{title} {file_name} añadido como {member} al archivador {archive_path}")
+                return
+            
+            known = media_index.find(file_unique_id=job.file_unique_id) if DEDUP_ENABLED else []
+            etags = media_index.etags(job.file_unique_id)
+            if image_format:
+                # El tamaño del archivo convertido no se conoce hasta convertirlo
+                remote_path = await remote_names.claim(
+                    directory, f"{posixpath.splitext(file_name)[0]}.{image_format}", None, etags, known
+                )
+            else:
+                remote_path = await remote_names.claim(directory, file_name, job.file_size, etags, known)
+            if remote_path is None:
+                logger.info(f"{title} {file_name}: ya existe en {directory}, no se vuelve a transferir")
+                TRANSFERS.labels(channel, media_type, 'skipped').inc()
+                return
+            
+            if known:
+                with STAGE_SECONDS.labels('dedup', media_type).time():
+                    source_path, entry = await copy_known_file(known, remote_path)
+                if source_path:
+                    log_known_file(title, file_name, source_path, entry['path'])
+                    media_index.add(entry['path'], file_unique_id=job.file_unique_id, etag=entry['etag'])
+                    remote_names.release(remote_path, entry)
+                    TRANSFERS.labels(channel, media_type, 'deduplicated').inc()
+                    return
+            
+            with STAGE_SECONDS.labels('get_file', media_type).time():
+                chunks, size, source_path = await source(bot, job)
+            digest = hashlib.sha256()
+            transferred = TRANSFERRED_BYTES.labels(channel, media_type)
+            logger.info(f"Subiendo {label} {file_name} al directorio {directory}")
+            
+            if (TRANSFER_MODE == 'stream' or source_path) and not plan:
+                # Con el servidor local de la Bot API el archivo se lee directamente de su
+                # volumen; si no, se descarga mientras se sube
+                if not source_path:
+                    chunks = buffered(chunks)
+                with STAGE_SECONDS.labels('upload', media_type).time():
+                    entry = await webdav_client.upload_stream(
+                        counted(hashed(chunks, digest), transferred),
+                        remote_path,
+                        size=size,
+                        key=job.file_id,
+                        on_conflict=remote_names.on_conflict,
+                        progress=progress
+                    )
+                sha256 = digest.hexdigest()
+                result = 'uploaded'
+            else:
+                # Descargar el archivo (si no está ya en el volumen del servidor local de la
+                # Bot API) en un directorio temporal propio de esta transferencia y subirlo a
+                # WebDAV salvo que su contenido ya esté allí
+                temp_dir = tempfile.mkdtemp(prefix='telegram-webdav-', dir=TEMP_DIR)
+                local_path = source_path or os.path.join(temp_dir, RemoteNames.clean(file_name))
+                if not source_path:
+                    with STAGE_SECONDS.labels('download', media_type).time():
+                        await save_chunks(chunks, local_path, size, progress)
+                sha256 = await file_sha256(local_path)
+                known_path = None
+                if DEDUP_ENABLED:
+                    with STAGE_SECONDS.labels('dedup', media_type).time():
+                        known_path, entry = await copy_known_file(media_index.find(sha256=sha256), remote_path)
+                if known_path:
+                    log_known_file(title, file_name, known_path, entry['path'])
+                    result = 'deduplicated'
+                else:
+                    upload_path = local_path
+                    if image_format:
+                        upload_path = os.path.join(temp_dir, posixpath.basename(remote_path))
+                        if progress:
+                            progress.begin('convirtiendo')
+                        try:
+                            with STAGE_SECONDS.labels('transform', media_type).time():
+                                await media_transformer.convert(local_path, upload_path, image_format)
+                        except Exception as e:
+                            # Guardar la imagen tal cual, con su nombre original
+                            logger.warning(f"No se pudo convertir {file_name} a {image_format}, se guarda sin convertir: {str(e)}")
+                            upload_path = local_path
+                            remote_names.release(remote_path)
+                            remote_path = await remote_names.claim(directory, file_name, size, etags)
+                            if remote_path is None:
+                                logger.info(f"{title} {file_name}: ya existe en {directory}, no se vuelve a transferir")
+                                TRANSFERS.labels(channel, media_type, 'skipped').inc()
+                                return
+                    with STAGE_SECONDS.labels('upload', media_type).time():
+                        entry = await webdav_client.upload(
+                            upload_path, remote_path, key=job.file_id, on_conflict=remote_names.on_conflict,
+                            progress=progress
+                        )
+                    transferred.inc(os.path.getsize(upload_path))
+                    result = 'uploaded'
+                if 'thumbnail' in plan:
+                    with STAGE_SECONDS.labels('transform', media_type).time():
+                        await upload_thumbnail(local_path, entry['path'], temp_dir)
+            media_index.add(
+                entry['path'], file_unique_id=job.file_unique_id, sha256=sha256, size=size,
+                etag=entry['etag']
+            )
+            remote_names.release(remote_path, entry)
+            TRANSFERS.labels(channel, media_type, result).inc()
+            logger.info(f"{title} {file_name} {uploaded} correctamente a {entry['path']}")
+    except Exception as e:
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code in (404, 409):
+            # El directorio de destino pudo borrarse en el servidor: volver a comprobarlo
+            directory_provisioner.forget(directory)
+        TRANSFERS.labels(channel, media_type, 'error').inc()
+        TRANSFER_ERRORS.labels(channel, media_type, error_service(e)).inc()
+        logger.error(f"Error al subir {label} {file_name}: {str(e)}")
+        raise
+    finally:
+        if remote_path:
+            remote_names.release(remote_path)
+        # Eliminar el directorio temporal
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+async def album_folder(directory):
+    """Crea la subcarpeta de un álbum; si no se puede, el álbum va a su directorio padre"""
+    try:
+        await directory_provisioner.ensure(directory)
+        return directory
+    except Exception as e:
+        parent = posixpath.dirname(directory)
+        logger.error(f"Error al crear directorio {directory}, el álbum se guardará en {parent}: {str(e)}")
+        return parent
+
+async def transfer_album(bot, job):
+    """Transfiere los archivos de un álbum como una sola unidad del planificador.
+
+    Cada archivo va al directorio que le asignaron las reglas; con ALBUM_SUBFOLDERS,
+    a una subcarpeta album_<id> de ese directorio, creada una sola vez. Los archivos
+    se suben en paralelo, cada uno en su propio hueco del planificador (dentro de
+    los límites en total y por destino), y los que terminan se quitan del trabajo,
+    de modo que un reintento solo repite el resto.
+    """
+    folders = {}
+    if ALBUM_SUBFOLDERS:
+        for directory in {item['directory'] for item in job.items}:
+            folders[directory] = await album_folder(f"{directory}/{job.file_name}")
+    
+    async def transfer(item):
+        item_job = TransferJob(job.chat_id, **item)
+        item_job.directory = folders.get(item_job.directory, item_job.directory)
+        async with transfer_scheduler.slot(item['directory']):
+            with TransferProgress(item_job.file_name, item_job.file_size, directory=item_job.directory) as progress:
+                await transfer_to_webdav(bot, item_job, progress)
+        job.items.remove(item)
+        await job_journal.update(job, 'running')
+    
+    results = await asyncio.gather(*(transfer(item) for item in list(job.items)), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+def retry_delay(attempts):
+    """Espera antes del siguiente intento: exponencial con algo de aleatoriedad"""
+    # El exponente se acota: los errores pasajeros se reintentan sin límite de intentos
+    delay = min(TRANSFER_RETRY_BASE_DELAY * 2 ** min(attempts - 1, 30), TRANSFER_RETRY_MAX_DELAY)
+    return delay * random.uniform(0.8, 1.2)
+
+class TransferScheduler:
+    """Planificador de transferencias con concurrencia acotada.
+
+    Mantiene una cola FIFO por canal y las atiende por turnos (round-robin), de
+    modo que un canal con una ráfaga de archivos no acapara a los demás. Limita
+    las transferencias simultáneas en total y por directorio de destino, y la
+    cola tiene un tamaño máximo: al llenarse, submit() espera a que haya hueco.
+    Un álbum no ocupa hueco por sí mismo: cada uno de sus archivos pide el suyo
+    con slot(), hacia su propio directorio.
+
+    Los trabajos se anotan en el registro persistente antes de encolarse. Las
+    transferencias fallidas vuelven a la cola tras una espera exponencial sin
+    ocupar mientras tanto ni un hueco de la cola ni una transferencia activa.
+    """
+
+    def __init__(self, journal, max_concurrent, max_per_destination, queue_size):
+        self.journal = journal
+        # Con trabajadores externos los reintentos los recoge cualquier trabajador de la cola
+        # compartida en lugar de programarse en este proceso
+        self.local_retries = True
+        self.max_concurrent = max_concurrent
+        self.max_per_destination = max_per_destination
+        self.queue_size = queue_size
+        self._queues = {}
+        self._turns = deque()
+        self._active = Counter()
+        self._running = {}
+        self._queued = 0
+        self._condition = asyncio.Condition()
+        self._workers = []
+        self._retries = set()
+        self._bot = None
+
+    @property
+    def queued(self):
+        return self._queued
+
+    @property
+    def in_flight(self):
+        return sum(self._active.values())
+
+    @property
+    def retrying(self):
+        return len(self._retries)
+
+    def jobs(self):
+        """Trabajos en curso y en cola en este proceso"""
+        return list(self._running.values()) + self.waiting()
+
+    def waiting(self):
+        """Trabajos en cola, canal a canal"""
+        return [job for queue in self._queues.values() for job in queue]
+
+    def start(self, bot, resume=True):
+        self._bot = bot
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrent)]
+        # Retomar en segundo plano las transferencias que quedaron sin terminar
+        if resume:
+            self._workers.append(asyncio.create_task(self._resume()))
+
+    async def stop(self):
+        tasks = self._workers + list(self._retries)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._retries.clear()
+
+    async def _resume(self):
+        jobs = await self.journal.unfinished()
+        if jobs:
+            logger.info(f"Retomando {len(jobs)} transferencias pendientes")
+        for job in jobs:
+            await self.submit(job)
+
+    async def submit(self, job):
+        """Encola una transferencia; espera si la cola está llena"""
+        if job.job_id is None:
+            await self.journal.add(job)
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._queued < self.queue_size)
+            if job.chat_id not in self._queues:
+                self._queues[job.chat_id] = deque()
+                self._turns.append(job.chat_id)
+            self._queues[job.chat_id].append(job)
+            self._queued += 1
+            self._condition.notify_all()
+
+    def _has_room(self, directory):
+        return self.in_flight < self.max_concurrent and self._active[directory] < self.max_per_destination
+
+    def _release(self, directory):
+        self._active[directory] -= 1
+        if not self._active[directory]:
+            del self._active[directory]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, directory):
+        """Ocupa un hueco de transferencia hacia `directory` mientras dura el bloque"""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._has_room(directory))
+            self._active[directory] += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._release(directory)
+                self._condition.notify_all()
+
+    def _next_job(self):
+        # Primer canal por turno cuyo siguiente archivo tenga hueco en su destino
+        for _ in range(len(self._turns)):
+            chat_id = self._turns[0]
+            self._turns.rotate(-1)
+            queue = self._queues[chat_id]
+            if queue[0].items is not None or self._has_room(queue[0].directory):
+                job = queue.popleft()
+                if not queue:
+                    del self._queues[chat_id]
+                    self._turns.remove(chat_id)
+                return job
+        return None
+
+    async def _worker(self):
+        while True:
+            async with self._condition:
+                job = None
+                while job is None:
+                    job = self._next_job()
+                    if job is None:
+                        await self._condition.wait()
+                self._queued -= 1
+                if job.items is None:
+                    self._active[job.directory] += 1
+                self._running[id(job)] = job
+                self._condition.notify_all()
+            await self.journal.update(job, 'running')
+            try:
+                if job.items is not None:
+                    await transfer_album(self._bot, job)
+                else:
+                    with TransferProgress(job.file_name, job.file_size, directory=job.directory) as progress:
+                        await transfer_to_webdav(self._bot, job, progress)
+                await self.journal.finish(job)
+            except Exception as e:
+                await self._failed(job, e)
+            finally:
+                async with self._condition:
+                    del self._running[id(job)]
+                    if job.items is None:
+                        self._release(job.directory)
+                    self._condition.notify_all()
+
+    async def _failed(self, job, error):
+        job.attempts += 1
+        # Los errores de petición de Telegram (p. ej. archivo demasiado grande) no se reintentan;
+        # los pasajeros (una caída de WebDAV o de la red) se reintentan sin límite, con la
+        # espera acotada por TRANSFER_RETRY_MAX_DELAY
+        if isinstance(error, BadRequest) or (
+            not transient_error(error) and job.attempts >= TRANSFER_MAX_ATTEMPTS
+        ):
+            logger.error(f"Transferencia de {job.file_name} descartada tras {job.attempts} intentos")
+            await self.journal.update(job, 'failed', str(error))
+            return
+        delay = retry_delay(job.attempts)
+        logger.warning(f"Reintentando {job.file_name} en {delay:.0f} s (intento {job.attempts + 1})")
+        await self.journal.update(job, 'pending', str(error), delay=delay)
+        if not self.local_retries:
+            return
+        task = asyncio.create_task(self._retry_later(job, delay))
+        self._retries.add(task)
+        task.add_done_callback(self._retries.discard)
+
+    async def _retry_later(self, job, delay):
+        await asyncio.sleep(delay)
+        await self.submit(job)
+
+transfer_scheduler = TransferScheduler(
+    job_journal,
+    TRANSFER_MAX_CONCURRENT,
+    TRANSFER_MAX_PER_DESTINATION,
+    TRANSFER_QUEUE_SIZE
+)
+TRANSFERS_IN_FLIGHT.set_function(lambda: transfer_scheduler.in_flight)
+TRANSFERS_QUEUED.set_function(lambda: transfer_scheduler.queued)
+TRANSFERS_RETRYING.set_function(lambda: transfer_scheduler.retrying)
+RATE_LIMITS.labels('telegram').set_function(lambda: telegram_rate_limiter.bucket.rate)
+RATE_LIMITS.labels('telegram_chat').set_function(lambda: telegram_rate_limiter.chat_rate)
+RATE_LIMITS.labels('webdav').set_function(lambda: webdav_bandwidth.rate)
+
+async def enqueue_transfer(job):
+    """Entrega una transferencia al planificador local o a la cola de los trabajadores"""
+    if TRANSFER_WORKERS == 'external':
+        await job_journal.add(job)
+    else:
+        await transfer_scheduler.submit(job)
+
+class AlbumCollector:
+    """Agrupa los archivos de un álbum publicado en un canal (mismo media_group_id).
+
+    Telegram entrega cada archivo del álbum como una actualización distinta. El
+    álbum se anota en el registro persistente como un solo trabajo ('collecting')
+    al que se van sumando los archivos según llegan; cuando pasan ALBUM_WINDOW
+    segundos sin recibir más, se entrega entero, como una única transferencia, al
+    planificador local o a la cola de los trabajadores (ver transfer_album).
+
+    Solo uno de los mensajes del álbum suele llevar el texto, así que todos sus
+    archivos se enrutan con el primer texto recibido del álbum: al llegar este se
+    vuelven a enrutar los anteriores.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._albums = {}
+
+    async def add(self, message, job, mime_type=None):
+        key = (job.chat_id, message.media_group_id)
+        album = self._albums.get(key)
+        if album is None:
+            album_job = TransferJob(
+                job.chat_id, 'album', f"album:{message.media_group_id}", f"album_{message.media_group_id}", None,
+                items=[]
+            )
+            album = self._albums[key] = {'job': album_job, 'files': [], 'caption': None, 'timer': None}
+        album_job = album['job']
+        album['files'].append((job, mime_type, message.date))
+        if album['caption'] is None and message.caption:
+            album['caption'] = message.caption
+        
+        # Enrutar con el texto del álbum; los archivos sin directorio no se guardan
+        album_job.items = []
+        for file_job, file_mime_type, date in album['files']:
+            post = ChannelPost(job.chat_id, album['caption'], date)
+            directory = channel_router.route(
+                post, file_job.media_type, file_job.file_name, file_mime_type, file_job.file_size
+            )
+            if directory is not None:
+                item = {field: getattr(file_job, field) for field in ALBUM_ITEM_FIELDS}
+                album_job.items.append(dict(item, directory=directory))
+        if album_job.items:
+            album_job.directory = album_job.items[0]['directory']
+            sizes = [item['file_size'] for item in album_job.items]
+            album_job.file_size = sum(sizes) if None not in sizes else None
+            # Anotado ya, por si el proceso se reinicia antes de cerrar el álbum
+            if album_job.job_id is None:
+                await job_journal.add(album_job, 'collecting')
+            else:
+                await job_journal.update(album_job, 'collecting')
+        if album['timer'] is not None:
+            album['timer'].cancel()
+        album['timer'] = asyncio.create_task(self._close_later(key))
+
+    def cancel(self):
+        """Descarta los temporizadores pendientes (los álbumes ya están anotados y se
+        entregan al volver a arrancar)"""
+        for album in self._albums.values():
+            if album['timer'] is not None:
+                album['timer'].cancel()
+        self._albums.clear()
+
+    async def _close_later(self, key):
+        await asyncio.sleep(self.window)
+        job = self._albums.pop(key)['job']
+        if not job.items:
+            logger.warning(f"Canal no configurado: {key[0]}")
+            return
+        logger.info(f"Álbum {key[1]} del canal {key[0]}: {len(job.items)} archivos hacia {job.directory}")
+        if TRANSFER_WORKERS == 'external':
+            await job_journal.update(job, 'pending')
+        else:
+            await transfer_scheduler.submit(job)
+
+# Campos de un TransferJob que se guardan por cada archivo de un álbum
+ALBUM_ITEM_FIELDS = ('media_type', 'file_id', 'file_name', 'directory', 'file_unique_id', 'file_size')
+
+album_collector = AlbumCollector(ALBUM_WINDOW)
+
+async def submit_channel_file(message, job, mime_type=None):
+    """Enruta y encola un archivo de canal, agrupándolo con el resto de su álbum si lo tiene"""
+    if message.media_group_id:
+        await album_collector.add(message, job, mime_type)
+        return
+    job.directory = channel_router.route(message, job.media_type, job.file_name, mime_type, job.file_size)
+    if job.directory is None:
+        logger.warning(f"Canal no configurado: {job.chat_id}")
+        return
+    await enqueue_transfer(job)
+
+async def run_worker():
+    """Proceso trabajador: atiende transferencias de la cola compartida"""
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    media_transformer.open()
+    async with ExtBot(TELEGRAM_BOT_TOKEN, rate_limiter=telegram_rate_limiter, **bot_api_settings()) as bot:
+        job_journal.open()
+        media_index.open()
+        directory_provisioner.open()
+        start_metrics_server()
+        daily_archives.start()
+        transfer_scheduler.local_retries = False
+        transfer_scheduler.start(bot, resume=False)
+        logger.info(f"Trabajador {owner} iniciado")
+        last_renewal = time.monotonic()
+        try:
+            while True:
+                # Pedir solo los trabajos que se pueden empezar pronto, para no acapararlos
+                capacity = transfer_scheduler.max_concurrent * 2 - len(transfer_scheduler.jobs())
+                jobs = await job_journal.claim(owner, capacity, WORKER_LEASE) if capacity > 0 else []
+                for job in jobs:
+                    await transfer_scheduler.submit(job)
+                if time.monotonic() - last_renewal > WORKER_LEASE / 3:
+                    await job_journal.renew(transfer_scheduler.jobs(), WORKER_LEASE)
+                    last_renewal = time.monotonic()
+                if not jobs:
+                    await asyncio.sleep(WORKER_POLL_INTERVAL)
+        finally:
+            await transfer_scheduler.stop()
+            await daily_archives.stop()
+            media_transformer.close()
+            await webdav_client.close()
+            if _telegram_download_client is not None:
+                await _telegram_download_client.aclose()
+            await job_journal.close()
+            media_index.close()
+            directory_provisioner.close()
+
+# Enrutado de archivos de canales
+MEDIA_TYPES = ('document', 'video', 'photo', 'audio')
+RULE_FIELDS = {'channel', 'media', 'mime', 'extension', 'min_size', 'max_size', 'hashtag', 'directory'}
+HASHTAG_RE = re.compile(r'#(\w+)')
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+@dataclass
+class RoutingRule:
+    """Regla de enrutado ya compilada; `order` es su posición en la configuración"""
+    order: int
+    directory: str
+    mime: Optional[re.Pattern] = None
+    extensions: Optional[frozenset] = None
+    min_size: Optional[int] = None
+    max_size: Optional[int] = None
+    hashtags: Optional[frozenset] = None
+
+    @property
+    def templated(self):
+        return '{' in self.directory
+
+    def matches(self, mime_type, extension, size, hashtags):
+        if self.mime is not None and not self.mime.match(mime_type or ''):
+            return False
+        if self.extensions is not None and extension not in self.extensions:
+            return False
+        if self.min_size is not None and (size is None or size < self.min_size):
+            return False
+        if self.max_size is not None and (size is None or size > self.max_size):
+            return False
+        if self.hashtags is not None and not self.hashtags & hashtags:
+            return False
+        return True
+
+    def render(self, values):
+        return self.directory.format_map(values) if self.templated else self.directory
+
+TEMPLATE_SAMPLE = {
+    'yyyy': '2024', 'yy': '24', 'mm': '01', 'dd': '01', 'channel': '-100', 'media': 'photo', 'ext': 'jpg'
+}
+
+def compile_rule(order, spec):
+    """Valida una regla de la configuración y precompila sus condiciones"""
+    if not isinstance(spec, dict) or 'directory' not in spec:
+        raise ValueError(f"Regla de enrutado {order + 1}: falta 'directory'")
+    unknown = set(spec) - RULE_FIELDS
+    if unknown:
+        raise ValueError(f"Regla de enrutado {order + 1}: campos desconocidos {', '.join(sorted(unknown))}")
+    for media_type in as_list(spec.get('media')):
+        if media_type not in MEDIA_TYPES:
+            raise ValueError(f"Regla de enrutado {order + 1}: tipo de archivo no válido {media_type}")
+    directory = '/' + str(spec['directory']).strip().strip('/')
+    try:
+        directory.format_map(TEMPLATE_SAMPLE)
+    except (KeyError, ValueError, IndexError) as e:
+        raise ValueError(f"Regla de enrutado {order + 1}: plantilla no válida {directory} ({str(e)})")
+    mimes = as_list(spec.get('mime'))
+    extensions = as_list(spec.get('extension'))
+    hashtags = as_list(spec.get('hashtag'))
+    return RoutingRule(
+        order,
+        directory,
+        mime=re.compile('|'.join(fnmatch.translate(m.lower()) for m in mimes), re.IGNORECASE) if mimes else None,
+        extensions=frozenset(e.lower().lstrip('.') for e in extensions) if extensions else None,
+        min_size=parse_size(spec['min_size']) if spec.get('min_size') is not None else None,
+        max_size=parse_size(spec['max_size']) if spec.get('max_size') is not None else None,
+        hashtags=frozenset(h.lower().lstrip('#') for h in hashtags) if hashtags else None
+    )
+
+class ChannelRouter:
+    """Decide el directorio de destino de cada archivo recibido de un canal.
+
+    Las reglas se prueban en el orden de la configuración y gana la primera que
+    coincide; si ninguna lo hace se usa el directorio del canal en CHANNEL_MAPPING.
+    Solo se atienden los canales de CHANNEL_MAPPING y los nombrados en el campo
+    `channel` de alguna regla: las reglas sin `channel` no abren la puerta a
+    cualquier otro chat en el que esté el bot.
+    Al cargarlas se agrupan por (canal, tipo de archivo), de modo que para cada
+    archivo solo se prueban las que pueden aplicarle. La lista de candidatas de
+    cada combinación se calcula una sola vez. Los directorios admiten plantillas
+    ({yyyy}, {yy}, {mm}, {dd} con la fecha del mensaje, {channel}, {media} y
+    {ext}); los resultantes se crean al subir el primer archivo.
+    """
+
+    def __init__(self, rules, mapping):
+        self.mapping = {
+            chat_id: compile_rule(len(rules), {'directory': directory}) for chat_id, directory in mapping.items()
+        }
+        self.rules = [compile_rule(order, spec) for order, spec in enumerate(rules)]
+        self.channels = set(self.mapping)
+        self._buckets = {}
+        self._candidates = {}
+        for rule, spec in zip(self.rules, rules):
+            self.channels.update(int(chat_id) for chat_id in as_list(spec.get('channel')))
+            for chat_id in as_list(spec.get('channel')) or [None]:
+                for media_type in as_list(spec.get('media')) or [None]:
+                    key = (int(chat_id) if chat_id is not None else None, media_type)
+                    self._buckets.setdefault(key, []).append(rule)
+
+    def candidates(self, chat_id, media_type):
+        key = (chat_id, media_type)
+        if key not in self._candidates:
+            self._candidates[key] = list(heapq.merge(
+                *(self._buckets.get(bucket, []) for bucket in
+                  ((chat_id, media_type), (chat_id, None), (None, media_type), (None, None))),
+                key=lambda rule: rule.order
+            ))
+        return self._candidates[key]
+
+    def route(self, message, media_type, file_name, mime_type=None, size=None):
+        """Directorio de destino del archivo o None si su canal no está configurado"""
+        chat_id = message.chat_id
+        if chat_id not in self.channels:
+            return None
+        extension = posixpath.splitext(file_name)[1].lstrip('.').lower()
+        hashtags = None
+        for rule in self.candidates(chat_id, media_type):
+            if rule.hashtags is not None and hashtags is None:
+                hashtags = {tag.lower() for tag in HASHTAG_RE.findall(message.caption or '')}
+            if rule.matches(mime_type, extension, size, hashtags):
+                break
+        else:
+            rule = self.mapping.get(chat_id)
+            if rule is None:
+                return None
+        if not rule.templated:
+            return rule.directory
+        date = message.date.astimezone()
+        return rule.render({
+            'yyyy': f"{date.year:04d}", 'yy': f"{date.year % 100:02d}", 'mm': f"{date.month:02d}",
+            'dd': f"{date.day:02d}", 'channel': str(chat_id), 'media': media_type, 'ext': extension or 'bin'
+        })
+
+    def static_directories(self):
+        """Directorios de destino fijos (sin plantilla), que se pueden crear al arrancar"""
+        rules = self.rules + list(self.mapping.values())
+        return sorted({rule.directory for rule in rules if not rule.templated})
+
+def load_routing_rules():
+    """Reglas de enrutado de ROUTING_RULES_FILE o de ROUTING_RULES"""
+    if ROUTING_RULES_FILE:
+        with open(ROUTING_RULES_FILE) as f:
+            return json.load(f)
+    return json.loads(ROUTING_RULES) if ROUTING_RULES.strip() else []
+
+channel_router = ChannelRouter(load_routing_rules(), CHANNEL_MAPPING)
+
+# Importación del historial de canales
+@dataclass
+class ChannelPost:
+    """Datos de un mensaje de canal obtenido por MTProto que usa el enrutador"""
+    chat_id: int
+    caption: Optional[str]
+    date: datetime
+
+@dataclass
+class BackfillRun:
+    """Estado de la importación de un rango de mensajes de un canal"""
+    chat_id: int
+    first_id: int
+    last_id: int
+    next_id: int
+    transferred: int = 0
+    skipped: int = 0
+    # Mensajes cuyo archivo falló, que se reintentan al final
+    failed_ids: list = field(default_factory=list)
+
+    def __post_init__(self):
+        if isinstance(self.failed_ids, str):
+            self.failed_ids = json.loads(self.failed_ids)
+
+    @property
+    def failed(self):
+        return len(self.failed_ids)
+
+    @property
+    def scanned(self):
+        return self.next_id > self.last_id
+
+    @property
+    def finished(self):
+        return self.scanned and not self.failed_ids
+
+    def describe(self):
+        return (
+            f"Canal {self.chat_id}, mensajes {self.first_id}-{self.last_id}: "
+            f"{'terminada' if self.scanned else f'por el mensaje {self.next_id}'} · "
+            f"{self.transferred} transferidos, {self.skipped} ya estaban, {self.failed} con error"
+        )
+
+def backfill_media(message):
+    """Tipo de archivo de un mensaje de Telethon, con el mismo criterio que los
+    manejadores de la Bot API, y el objeto a descargar (None si no se guarda)"""
+    if message.photo:
+        return 'photo', message.photo
+    if message.sticker or message.voice or message.video_note:
+        return None, None
+    # Los GIF llegan por la Bot API como documentos
+    if message.gif:
+        return 'document', message.document
+    if message.video:
+        return 'video', message.document
+    if message.audio:
+        return 'audio', message.document
+    if message.document:
+        return 'document', message.document
+    return None, None
+
+def bot_api_file_unique_id(document):
+    """file_unique_id que da la Bot API a un documento de MTProto (también vídeos y
+    audios): el tipo de archivo (2) y su id con las series de ceros comprimidas, en
+    base64url. Las fotos llevan más datos, así que se reconocen por su contenido"""
+    raw = struct.pack('<iq', 2, document.id)
+    encoded = re.sub(rb'\x00+', lambda match: b'\x00' + bytes([len(match.group())]), raw)
+    return base64.urlsafe_b64encode(encoded).rstrip(b'=').decode()
+
+def parse_channel(text):
+    """Canal por su identificador (-100...) o por su nombre (@canal)"""
+    text = str(text).strip()
+    return int(text) if re.fullmatch(r'-?\d+', text) else text
+
+class ChannelBackfill:
+    """Importa a WebDAV los archivos que ya estaban publicados en un canal.
+
+    La Bot API solo entrega los mensajes nuevos, así que los antiguos se piden por
+    su identificador, en lotes de BATCH_SIZE, con una sesión MTProto de Telethon
+    (si la sesión no tiene ya una cuenta, entra como el propio bot). Sus archivos
+    siguen el mismo camino que los recibidos en directo: el enrutado de canales y
+    transfer_to_webdav, con el contenido descargado por MTProto, a razón de
+    `concurrency` transferencias simultáneas. Con DEDUP_ENABLED los archivos que ya
+    guardó la recepción en directo (con otro nombre) se reconocen por su
+    file_unique_id de la Bot API o, antes de subirlos, por su SHA-256.
+
+    El punto de control de cada rango (el primer mensaje aún sin terminar) se
+    guarda en la base de datos: repetir una importación interrumpida continúa
+    donde se quedó y repetir una terminada la recorre de nuevo. El punto de control
+    se identifica por el canal y el primer mensaje, no por el último: sin indicar
+    el final del rango, una publicación nueva no hace empezar de cero. Los mensajes
+    que fallan se guardan y se reintentan en una última pasada (también al repetir
+    la importación). Los archivos ya importados, o que ya están en su directorio con
+    el mismo nombre y tamaño, no se vuelven a transferir.
+    """
+
+    BATCH_SIZE = 100
+    ATTEMPTS = 3
+
+    def __init__(self, path, session, concurrency):
+        self.path = path
+        self.session = session
+        self.concurrency = concurrency
+        self.runs = {}
+        self._tasks = {}
+        self._background = set()
+        self._db = None
+        self._client = None
+        self._connecting = asyncio.Lock()
+
+    def open(self):
+        self._db = open_database(self.path)
+        # Las tablas de versiones anteriores llevaban el último mensaje en la clave
+        columns = {row[1]: row[5] for row in self._db.execute('PRAGMA table_info(backfills)')}
+        if columns.get('last_id'):
+            self._db.execute('BEGIN IMMEDIATE')
+            self._db.execute('ALTER TABLE backfills RENAME TO backfills_old')
+            self._create_table()
+            self._db.execute(
+                'INSERT OR IGNORE INTO backfills (chat_id, first_id, last_id, next_id, transferred, skipped,'
+                ' updated_at) SELECT chat_id, first_id, last_id, next_id, transferred, skipped, updated_at'
+                ' FROM backfills_old ORDER BY updated_at DESC'
+            )
+            self._db.execute('DROP TABLE backfills_old')
+            self._db.execute('COMMIT')
+        else:
+            self._create_table()
+
+    def _create_table(self):
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS backfills ('
+            ' chat_id INTEGER NOT NULL,'
+            ' first_id INTEGER NOT NULL,'
+            ' last_id INTEGER NOT NULL,'
+            ' next_id INTEGER NOT NULL,'
+            ' transferred INTEGER NOT NULL DEFAULT 0,'
+            ' skipped INTEGER NOT NULL DEFAULT 0,'
+            " failed_ids TEXT NOT NULL DEFAULT '[]',"
+            ' updated_at REAL NOT NULL,'
+            ' PRIMARY KEY (chat_id, first_id))'
+        )
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.disconnect()
+            self._client = None
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    async def connect(self):
+        """Cliente de Telethon conectado (se crea la primera vez)"""
+        async with self._connecting:
+            if self._client is None:
+                try:
+                    from telethon import TelegramClient
+                except ImportError:
+                    raise RuntimeError("La importación del historial requiere el paquete 'telethon' (pip install telethon)")
+                if not TELEGRAM_API_ID or not TELEGRAM_API_HASH:
+                    raise RuntimeError("La importación del historial requiere TELEGRAM_API_ID y TELEGRAM_API_HASH")
+                if os.path.dirname(self.session):
+                    os.makedirs(os.path.dirname(self.session), exist_ok=True)
+                # Esperar lo que pida Telegram en lugar de fallar por control de flujo
+                client = TelegramClient(
+                    self.session, int(TELEGRAM_API_ID), TELEGRAM_API_HASH, flood_sleep_threshold=3600
+                )
+                await client.start(bot_token=TELEGRAM_BOT_TOKEN)
+                self._client = client
+        return self._client
+
+    async def resolve(self, channel):
+        """Canal de Telethon y su identificador en la Bot API (-100...)"""
+        from telethon.utils import get_peer_id
+        client = await self.connect()
+        entity = await client.get_input_entity(channel)
+        return entity, get_peer_id(entity)
+
+    def saved(self):
+        """Importaciones guardadas en la base de datos, la más reciente primero"""
+        rows = self._db.execute(
+            'SELECT chat_id, first_id, last_id, next_id, transferred, skipped, failed_ids FROM backfills'
+            ' ORDER BY updated_at DESC'
+        )
+        return [BackfillRun(*row) for row in rows]
+
+    def _load(self, chat_id, first_id):
+        row = self._db.execute(
+            'SELECT chat_id, first_id, last_id, next_id, transferred, skipped, failed_ids FROM backfills'
+            ' WHERE chat_id = ? AND first_id = ?',
+            (chat_id, first_id)
+        ).fetchone()
+        return BackfillRun(*row) if row else None
+
+    def _save(self, run):
+        self._db.execute(
+            'INSERT OR REPLACE INTO backfills (chat_id, first_id, last_id, next_id, transferred, skipped,'
+            ' failed_ids, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (run.chat_id, run.first_id, run.last_id, run.next_id, run.transferred, run.skipped,
+             json.dumps(run.failed_ids), time.time())
+        )
+
+    async def run(self, channel, first_id=1, last_id=None):
+        """Importa los mensajes `first_id`..`last_id` (por defecto, hasta el último) del canal"""
+        client = await self.connect()
+        entity, chat_id = await self.resolve(channel)
+        if chat_id in self.runs:
+            raise RuntimeError(f"Ya hay una importación en curso del canal {chat_id}")
+        self.runs[chat_id] = run = BackfillRun(chat_id, first_id, last_id or 0, first_id)
+        self._tasks[chat_id] = asyncio.current_task()
+        try:
+            if last_id is None:
+                # Las cuentas de bot no pueden consultar el historial: entonces hay que indicar el rango
+                try:
+                    latest = await client.get_messages(entity, limit=1)
+                except Exception as e:
+                    raise RuntimeError(f"No se pudo obtener el último mensaje del canal, indica el rango: {str(e)}")
+                run.last_id = latest[0].id if latest else 0
+            saved = self._load(chat_id, first_id)
+            # Se retoma aunque el rango termine ahora más allá (un mensaje nuevo en el canal)
+            if saved and not saved.finished:
+                saved.last_id = max(saved.last_id, run.last_id)
+                run = self.runs[chat_id] = saved
+                if run.scanned:
+                    logger.info(f"Reintentando los mensajes con error de la importación del canal {chat_id}")
+                else:
+                    logger.info(f"Retomando la importación del canal {chat_id} en el mensaje {run.next_id}")
+            else:
+                logger.info(f"Importando los mensajes {first_id}-{run.last_id} del canal {chat_id}")
+            try:
+                await self._process(client, entity, run)
+            finally:
+                self._save(run)
+            logger.info(f"Importación terminada. {run.describe()}")
+            return run
+        finally:
+            del self.runs[chat_id]
+            del self._tasks[chat_id]
+
+    async def _process(self, client, entity, run):
+        slots = asyncio.Semaphore(self.concurrency)
+        in_flight = set()
+        tasks = set()
+        # Primer mensaje aún sin pedir a Telegram
+        scanned = run.next_id
+        # Texto de cada álbum (grouped_id), que suele llevar solo uno de sus mensajes
+        captions = {}
+
+        def checkpoint():
+            run.next_id = min(in_flight, default=scanned)
+            self._save(run)
+
+        async def transfer(message, job):
+            try:
+                transferred = await self._transfer(client, entity, message, job)
+            except asyncio.CancelledError:
+                # Sin terminar: el punto de control no puede pasar de este mensaje
+                raise
+            except Exception as e:
+                if message.id not in run.failed_ids:
+                    run.failed_ids.append(message.id)
+                logger.error(f"Importación del canal {run.chat_id}: error en el mensaje {message.id}: {str(e)}")
+            else:
+                if message.id in run.failed_ids:
+                    run.failed_ids.remove(message.id)
+                if transferred:
+                    run.transferred += 1
+                else:
+                    run.skipped += 1
+            in_flight.discard(message.id)
+            slots.release()
+            checkpoint()
+
+        async def submit(ids, retrying=False):
+            messages = [message for message in await client.get_messages(entity, ids=ids) if message is not None]
+            for message in messages:
+                if message.grouped_id and message.message:
+                    captions.setdefault(message.grouped_id, message.message)
+            jobs = {
+                message.id: self._job(run.chat_id, message, captions.get(message.grouped_id)) for message in messages
+            }
+            if retrying:
+                # Los mensajes borrados o ya sin archivo no se reintentan
+                run.failed_ids = [
+                    message_id for message_id in run.failed_ids if message_id not in ids or jobs.get(message_id)
+                ]
+            for message in messages:
+                job = jobs[message.id]
+                if job is None:
+                    continue
+                await slots.acquire()
+                # Los reintentos no mueven el punto de control: siguen en failed_ids
+                if not retrying:
+                    in_flight.add(message.id)
+                task = asyncio.create_task(transfer(message, job))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        try:
+            for start in range(run.next_id, run.last_id + 1, self.BATCH_SIZE):
+                ids = list(range(start, min(start + self.BATCH_SIZE, run.last_id + 1)))
+                await submit(ids)
+                scanned = ids[-1] + 1
+                checkpoint()
+                logger.info(run.describe())
+            await asyncio.gather(*tasks)
+            # Última pasada por los mensajes que fallaron
+            retry = sorted(run.failed_ids)
+            if retry:
+                logger.info(f"Importación del canal {run.chat_id}: reintentando {len(retry)} mensajes con error")
+            for start in range(0, len(retry), self.BATCH_SIZE):
+                await submit(retry[start:start + self.BATCH_SIZE], retrying=True)
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        run.next_id = scanned
+
+    def _job(self, chat_id, message, caption=None):
+        """Transferencia del archivo del mensaje, o None si no tiene o no hay dónde guardarlo.
+        Los archivos de un álbum se enrutan con el texto del álbum (`caption`)."""
+        media_type, media = backfill_media(message)
+        if media is None:
+            return None
+        file = message.file
+        if media_type == 'photo':
+            file_name, mime_type = f"photo_{message.id}.jpg", 'image/jpeg'
+        else:
+            default_name = {
+                'video': f"video_{message.id}.mp4",
+                'audio': f"audio_{message.id}.mp3",
+                'document': f"document_{message.id}",
+            }[media_type]
+            file_name, mime_type = file.name or default_name, file.mime_type
+        post = ChannelPost(chat_id, caption or message.message, message.date)
+        directory = channel_router.route(post, media_type, file_name, mime_type, file.size)
+        if directory is None:
+            return None
+        file_unique_id = f"mtproto:{media.id}" if media_type == 'photo' else bot_api_file_unique_id(media)
+        return TransferJob(
+            chat_id, media_type, f"mtproto:{chat_id}:{message.id}", file_name, directory,
+            file_unique_id=file_unique_id, file_size=file.size
+        )
+
+    @staticmethod
+    async def _stored(directory, known):
+        """Si alguna de las copias conocidas de un archivo sigue en `directory`"""
+        for remote_path in known:
+            if posixpath.dirname(remote_path) == directory and await webdav_client.info(remote_path):
+                return True
+        return False
+
+    async def _transfer(self, client, entity, message, job):
+        """Transfiere el archivo de un mensaje; devuelve False si ya estaba en su directorio"""
+        # Se consulta al servidor y no al listado en caché: una importación cancelada puede
+        # haber dejado subido el archivo sin llegar a anotarlo
+        existing = await webdav_client.info(f"{job.directory}/{RemoteNames.clean(job.file_name)}")
+        if existing and existing['size'] == job.file_size:
+            return False
+        if DEDUP_ENABLED and await self._stored(job.directory, media_index.find(file_unique_id=job.file_unique_id)):
+            return False
+
+        def chunks():
+            async def download():
+                async for chunk in client.iter_download(backfill_media(message)[1], file_size=job.file_size):
+                    yield bytes(chunk)
+            return download()
 
-# Mapeo de canales a directorios (formato CHANNEL_ID:DIRECTORY)
-CHANNEL_MAPPING = {}
-for mapping in os.environ.get('CHANNEL_MAPPINGS', '').split(','):
-    if ':' in mapping:
-        channel_id, directory = mapping.split(':', 1)
-        CHANNEL_MAPPING[int(channel_id.strip())] = directory.strip()
+        async def source(bot, job):
+            if local_path:
+                return read_file_chunks(local_path), job.file_size, local_path
+            return chunks(), job.file_size, None
 
-# Lista de usuarios autorizados
-AUTHORIZED_USERS = []
-for user_id in os.environ.get('AUTHORIZED_USERS', '').split(','):
-    if user_id.strip():
-        AUTHORIZED_USERS.append(int(user_id.strip()))
+        for attempt in range(1, self.ATTEMPTS + 1):
+            temp_dir = local_path = None
+            try:
+                with TransferProgress(job.file_name, job.file_size, directory=job.directory) as progress:
+                    if DEDUP_ENABLED:
+                        # Descargar antes para comparar el contenido con lo ya subido
+                        temp_dir = tempfile.mkdtemp(prefix='telegram-webdav-', dir=TEMP_DIR)
+                        local_path = os.path.join(temp_dir, RemoteNames.clean(job.file_name))
+                        await save_chunks(chunks(), local_path, job.file_size, progress)
+                        known = media_index.find(sha256=await file_sha256(local_path))
+                        if await self._stored(job.directory, known):
+                            return False
+                    await transfer_to_webdav(None, job, progress, source)
+                return True
+            except Exception:
+                if attempt == self.ATTEMPTS:
+                    raise
+                await asyncio.sleep(retry_delay(attempt))
+                # La referencia del archivo del mensaje puede haber caducado
+                message = await client.get_messages(entity, ids=message.id) or message
+            finally:
+                if temp_dir:
+                    shutil.rmtree(temp_dir, ignore_errors=True)
 
-# Estados para el conversation handler
-SELECTING_DIRECTORY = 1
+    def start(self, channel, first_id=1, last_id=None, on_done=None):
+        """Lanza la importación en segundo plano; `on_done(run, error)` recibe el resultado"""
+        async def background():
+            try:
+                run, error = await self.run(channel, first_id, last_id), None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error al importar el historial del canal {channel}: {str(e)}")
+                run, error = None, e
+            if on_done is not None:
+                await on_done(run, error)
+        task = asyncio.create_task(background())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
 
-# Almacenamiento temporal de archivos enviados por usuarios
-user_files = {}
+    async def cancel(self, channel):
+        """Detiene la importación en curso del canal; devuelve su estado o None"""
+        _, chat_id = await self.resolve(channel)
+        task = self._tasks.get(chat_id)
+        if task is None:
+            return None
+        run = self.runs[chat_id]
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return run
 
-# Cliente WebDAV
-webdav_options = {
-    'webdav_hostname': WEBDAV_HOSTNAME,
-    'webdav_login': WEBDAV_USERNAME,
-    'webdav_password': WEBDAV_PASSWORD,
-    'disable_check': True
-}
-webdav_client = wc.Client(webdav_options)
-
-# Verificar que los directorios existan, crearlos si no existen
-def ensure_directories():
-    for directory in CHANNEL_MAPPING.values():
-        if not webdav_client.check(directory):
-            logger.info(f"Creando directorio: {directory}")
-            webdav_client.mkdir(directory)
-            
-# Obtener lista de directorios disponibles
-def get_available_directories():
-    directories = set(CHANNEL_MAPPING.values())
-    # Listar directorios en la raíz del WebDAV
-    try:
-        root_dirs = webdav_client.list()
-        for dir_path in root_dirs:
-            # Eliminar la barra final si existe
-            dir_path = dir_path.rstrip('/')
-            if dir_path and webdav_client.is_dir(dir_path):
-                directories.add(f"/{dir_path}")
-    except Exception as e:
-        logger.error(f"Error al listar directorios: {str(e)}")
-    
-    return sorted(list(directories))
+    async def stop(self):
+        tasks = list(self._tasks.values()) + list(self._background)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+channel_backfill = ChannelBackfill(JOURNAL_PATH, BACKFILL_SESSION, BACKFILL_CONCURRENCY)
 
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Maneja los documentos recibidos de diferentes canales"""
     
     # Obtener el ID del chat (canal) y usuario
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
+    # Las publicaciones de canales no tienen usuario asociado
+    user_id = update.effective_user.id if update.effective_user else None
+    message = update.effective_message
     
     # Si es un chat privado y el usuario está autorizado, iniciar el flujo de selección de directorio
     if update.effective_chat.type == 'private' and user_id in AUTHORIZED_USERS:
         return await handle_direct_file(update, context)
     
-    # Verificar si el canal está en nuestro mapeo
-    if chat_id not in CHANNEL_MAPPING:
-        logger.warning(f"Canal no configurado: {chat_id}")
-        return
-    
-    directory = CHANNEL_MAPPING[chat_id]
-    document = update.message.document
-    file_name = document.file_name
+    document = message.document
+    file_name = document.file_name or f"document_{document.file_id}"
     
-    # Descargar el archivo
-    file = await context.bot.get_file(document.file_id)
-    local_path = f"/tmp/{file_name}"
-    await file.download_to_drive(local_path)
-    
-    # Subir a WebDAV
-    remote_path = f"{directory}/{file_name}"
-    logger.info(f"Subiendo archivo {file_name} al directorio {directory}")
-    
-    try:
-        webdav_client.upload_sync(local_path, remote_path)
-        logger.info(f"Archivo {file_name} subido correctamente a {remote_path}")
-    except Exception as e:
-        logger.error(f"Error al subir archivo {file_name}: {str(e)}")
-    finally:
-        # Eliminar archivo temporal
-        os.remove(local_path)
+    # El directorio lo eligen las reglas de enrutado o el mapeo del canal
+    await submit_channel_file(message, TransferJob(
+        chat_id, 'document', document.file_id, file_name, None,
+        file_unique_id=document.file_unique_id, file_size=document.file_size
+    ), document.mime_type)
 
 async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Maneja los videos recibidos de diferentes canales"""
     
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
+    # Las publicaciones de canales no tienen usuario asociado
+    user_id = update.effective_user.id if update.effective_user else None
+    message = update.effective_message
     
     # Si es un chat privado y el usuario está autorizado, iniciar el flujo de selección de directorio
     if update.effective_chat.type == 'private' and user_id in AUTHORIZED_USERS:
         return await handle_direct_file(update, context)
     
-    if chat_id not in CHANNEL_MAPPING:
-        logger.warning(f"Canal no configurado: {chat_id}")
-        return
-    
-    directory = CHANNEL_MAPPING[chat_id]
-    video = update.message.video
+    video = message.video
     
     # Generar nombre de archivo si no está disponible
     if hasattr(video, 'file_name') and video.file_name:
@@ -132,80 +3350,47 @@ async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     else:
         file_name = f"video_{video.file_id}.mp4"
     
-    # Descargar el archivo
-    file = await context.bot.get_file(video.file_id)
-    local_path = f"/tmp/{file_name}"
-    await file.download_to_drive(local_path)
-    
-    # Subir a WebDAV
-    remote_path = f"{directory}/{file_name}"
-    logger.info(f"Subiendo video {file_name} al directorio {directory}")
-    
-    try:
-        webdav_client.upload_sync(local_path, remote_path)
-        logger.info(f"Video {file_name} subido correctamente a {remote_path}")
-    except Exception as e:
-        logger.error(f"Error al subir video {file_name}: {str(e)}")
-    finally:
-        # Eliminar archivo temporal
-        os.remove(local_path)
+    await submit_channel_file(message, TransferJob(
+        chat_id, 'video', video.file_id, file_name, None,
+        file_unique_id=video.file_unique_id, file_size=video.file_size
+    ), video.mime_type)
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Maneja las fotos recibidas de diferentes canales"""
     
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
+    # Las publicaciones de canales no tienen usuario asociado
+    user_id = update.effective_user.id if update.effective_user else None
+    message = update.effective_message
     
     # Si es un chat privado y el usuario está autorizado, iniciar el flujo de selección de directorio
     if update.effective_chat.type == 'private' and user_id in AUTHORIZED_USERS:
         return await handle_direct_file(update, context)
     
-    if chat_id not in CHANNEL_MAPPING:
-        logger.warning(f"Canal no configurado: {chat_id}")
-        return
-    
-    directory = CHANNEL_MAPPING[chat_id]
-    
     # Obtener la foto de mayor resolución
-    photo = update.message.photo[-1]
+    photo = message.photo[-1]
     
     # Generar nombre de archivo
     file_name = f"photo_{photo.file_id}.jpg"
     
-    # Descargar el archivo
-    file = await context.bot.get_file(photo.file_id)
-    local_path = f"/tmp/{file_name}"
-    await file.download_to_drive(local_path)
-    
-    # Subir a WebDAV
-    remote_path = f"{directory}/{file_name}"
-    logger.info(f"Subiendo foto {file_name} al directorio {directory}")
-    
-    try:
-        webdav_client.upload_sync(local_path, remote_path)
-        logger.info(f"Foto {file_name} subida correctamente a {remote_path}")
-    except Exception as e:
-        logger.error(f"Error al subir foto {file_name}: {str(e)}")
-    finally:
-        # Eliminar archivo temporal
-        os.remove(local_path)
+    await submit_channel_file(message, TransferJob(
+        chat_id, 'photo', photo.file_id, file_name, None,
+        file_unique_id=photo.file_unique_id, file_size=photo.file_size
+    ), 'image/jpeg')
 
 async def handle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Maneja los archivos de audio recibidos de diferentes canales"""
     
     chat_id = update.effective_chat.id
-    user_id = update.effective_user.id
+    # Las publicaciones de canales no tienen usuario asociado
+    user_id = update.effective_user.id if update.effective_user else None
+    message = update.effective_message
     
     # Si es un chat privado y el usuario está autorizado, iniciar el flujo de selección de directorio
     if update.effective_chat.type == 'private' and user_id in AUTHORIZED_USERS:
         return await handle_direct_file(update, context)
     
-    if chat_id not in CHANNEL_MAPPING:
-        logger.warning(f"Canal no configurado: {chat_id}")
-        return
-    
-    directory = CHANNEL_MAPPING[chat_id]
-    audio = update.message.audio
+    audio = message.audio
     
     # Generar nombre de archivo
     if hasattr(audio, 'file_name') and audio.file_name:
@@ -213,23 +3398,417 @@ async def handle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     else:
         file_name = f"audio_{audio.file_id}.mp3"
     
-    # Descargar el archivo
-    file = await context.bot.get_file(audio.file_id)
-    local_path = f"/tmp/{file_name}"
-    await file.download_to_drive(local_path)
-    
-    # Subir a WebDAV
-    remote_path = f"{directory}/{file_name}"
-    logger.info(f"Subiendo audio {file_name} al directorio {directory}")
-    
+    await submit_channel_file(message, TransferJob(
+        chat_id, 'audio', audio.file_id, file_name, None,
+        file_unique_id=audio.file_unique_id, file_size=audio.file_size
+    ), audio.mime_type)
+
+class ProgressReporter:
+    """Mensajes de Telegram que muestran el progreso de una transferencia.
+
+    Cada mensaje lo actualiza una única tarea que, como mucho una vez cada
+    `interval` segundos, lee el progreso y edita el texto si ha cambiado; así el
+    número de ediciones no depende del tamaño del archivo ni de la velocidad, y
+    además pasan por el límite por chat de TelegramRateLimiter. La tarea termina
+    sola cuando acaba la transferencia.
+    """
+
+    def __init__(self, interval, min_size):
+        self.interval = interval
+        self.min_size = min_size
+        self._messages = {}
+
+    def wanted(self, progress):
+        """Indica si merece la pena mostrar el progreso de la transferencia"""
+        return bool(self.interval) and (progress.total is None or progress.total >= self.min_size)
+
+    def show(self, message, progress, header, reply_markup=None):
+        """Muestra `progress` en `message` bajo el texto `header`, o cambia lo que ya mostraba"""
+        key = (message.chat_id, message.message_id)
+        state = self._messages.get(key)
+        if state is None:
+            state = self._messages[key] = {'text': None, 'wake': asyncio.Event()}
+            state['task'] = asyncio.create_task(self._refresh(key, state))
+        state.update(message=message, progress=progress, header=header, reply_markup=reply_markup)
+        state['wake'].set()
+
+    async def _refresh(self, key, state):
+        try:
+            while True:
+                state['wake'].clear()
+                finished = state['progress'].finished
+                text = f"{state['header']}\n\n{state['progress'].describe()}"
+                if text != state['text']:
+                    try:
+                        await state['message'].edit_text(text, reply_markup=state['reply_markup'])
+                        state['text'] = text
+                    except BadRequest as e:
+                        # El mensaje ya no existe o no se puede editar
+                        logger.warning(f"No se pudo actualizar el mensaje de progreso: {str(e)}")
+                        return
+                    except Exception as e:
+                        logger.warning(f"No se pudo actualizar el mensaje de progreso: {str(e)}")
+                # Si entretanto ha cambiado lo que se muestra, volver a dibujarlo
+                if finished and not state['wake'].is_set():
+                    return
+                try:
+                    await asyncio.wait_for(state['wake'].wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if self._messages.get(key) is state:
+                del self._messages[key]
+
+    async def stop(self, message):
+        """Deja de actualizar `message` (antes de editarlo con otro contenido)"""
+        state = self._messages.pop((message.chat_id, message.message_id), None)
+        if state is not None:
+            state['task'].cancel()
+            await asyncio.gather(state['task'], return_exceptions=True)
+
+    async def stop_all(self):
+        tasks = [state['task'] for state in self._messages.values()]
+        self._messages.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+progress_reporter = ProgressReporter(PROGRESS_INTERVAL, PROGRESS_MIN_SIZE)
+
+def discard_local_file(user_data):
+    """Elimina el archivo temporal del usuario (nunca los del servidor local de la Bot API)"""
+    local_path = user_data.get('local_path')
+    if local_path and user_data.get('temporary_file', True):
+        # Cada archivo temporal está en su propio directorio
+        shutil.rmtree(os.path.dirname(local_path), ignore_errors=True)
+
+def telegram_file_chunks(file):
+    """Bloques y tamaño de un archivo de Telegram, leído del volumen del servidor local
+    de la Bot API si está allí o descargado por HTTP mientras se consume"""
+    source_path = telegram_local_path(file)
+    if source_path:
+        return read_file_chunks(source_path), os.path.getsize(source_path)
+    return buffered(stream_telegram_file(file)), file.file_size
+
+async def store_user_file(local_path, file_name, directory, progress=None):
+    """Sube el archivo de un usuario al directorio elegido.
+
+    Devuelve la ruta remota con la que se guardó o None si ya estaba en el servidor.
+    """
+    remote_path = await remote_names.claim(directory, file_name, os.path.getsize(local_path))
+    if remote_path is None:
+        return None
+    try:
+        entry = await webdav_client.upload(
+            local_path, remote_path, on_conflict=remote_names.on_conflict, progress=progress
+        )
+        remote_names.release(remote_path, entry)
+        return entry['path']
+    finally:
+        remote_names.release(remote_path)
+
+class StagingArea:
+    """Subidas especulativas de los archivos que los usuarios envían al bot.
+
+    En cuanto llega un archivo se empieza a subir, directamente desde Telegram, a
+    una carpeta de preparación en WebDAV mientras el usuario elige el directorio;
+    al elegirlo basta con un MOVE en el servidor. Los archivos que nadie reclama
+    (o se cancelan con /cancel) se borran. El nombre de cada archivo preparado
+    empieza por el instante de su creación, así que también se borran los que
+    quedaron de una ejecución anterior.
+    """
+
+    def __init__(self, client, directory, ttl):
+        self.client = client
+        self.directory = '/' + directory.strip('/')
+        self.ttl = ttl
+        self._uploads = {}
+        self._cleaner = None
+
+    def start(self, file, file_name):
+        """Empieza a subir el archivo de Telegram; devuelve el identificador de la subida"""
+        staging_id = os.urandom(8).hex()
+        staged_path = f"{self.directory}/{int(time.time())}-{staging_id}-{RemoteNames.clean(file_name)}"
+        progress = TransferProgress(file_name, file.file_size, 'subiendo')
+        self._uploads[staging_id] = {
+            'path': staged_path,
+            'created': time.monotonic(),
+            'progress': progress,
+            'task': asyncio.create_task(self._upload(file, staged_path, progress)),
+        }
+        return staging_id
+
+    async def _upload(self, file, staged_path, progress):
+        with progress:
+            chunks, size = telegram_file_chunks(file)
+            await directory_provisioner.ensure(self.directory)
+            return await self.client.upload_stream(
+                chunks, staged_path, size=size, key=file.file_id, progress=progress
+            )
+
+    def has(self, staging_id):
+        return staging_id in self._uploads
+
+    def path(self, staging_id):
+        return self._uploads[staging_id]['path']
+
+    def progress(self, staging_id):
+        return self._uploads[staging_id]['progress']
+
+    def ready(self, staging_id):
+        upload = self._uploads.get(staging_id)
+        return upload is None or upload['task'].done()
+
+    async def claim(self, staging_id, directory, file_name):
+        """Espera a que termine la subida y mueve el archivo a `directory`.
+
+        Devuelve la ruta final o None si el archivo ya estaba en el servidor.
+        """
+        upload = self._uploads.pop(staging_id)
+        try:
+            return await self.place(await upload['task'], directory, file_name)
+        except Exception:
+            await self._remove(upload)
+            raise
+
+    async def find(self, staged_path, size=None):
+        """Archivo preparado por otra ejecución o por otro proceso del bot, si existe y
+        está completo"""
+        entry = await self.client.info(staged_path)
+        if entry and (size is None or entry['size'] == size):
+            return entry
+        return None
+
+    async def place(self, entry, directory, file_name):
+        """Mueve el archivo preparado `entry` a `directory` (lo borra si ya estaba allí)"""
+        await directory_provisioner.ensure(directory)
+        remote_path = await remote_names.claim(directory, file_name, entry['size'])
+        if remote_path is None:
+            await self.client.delete(entry['path'])
+            return None
+        try:
+            entry = await self.client.move(entry['path'], remote_path, on_conflict=remote_names.on_conflict)
+            remote_names.release(remote_path, entry)
+            return entry['path']
+        finally:
+            remote_names.release(remote_path)
+
+    async def discard(self, staging_id):
+        upload = self._uploads.pop(staging_id, None)
+        if upload is not None:
+            await self._remove(upload)
+
+    async def _remove(self, upload):
+        """Cancela la subida si sigue en curso y borra el archivo preparado"""
+        upload['task'].cancel()
+        await asyncio.gather(upload['task'], return_exceptions=True)
+        try:
+            await self.client.delete(upload['path'])
+        except Exception as e:
+            logger.warning(f"No se pudo eliminar el archivo preparado {upload['path']}: {str(e)}")
+
+    async def _expire(self):
+        while True:
+            await asyncio.sleep(max(self.ttl / 4, 30))
+            try:
+                now = time.monotonic()
+                for staging_id, upload in list(self._uploads.items()):
+                    if now - upload['created'] > self.ttl:
+                        logger.info(f"Eliminando archivo preparado sin reclamar: {upload['path']}")
+                        await self.discard(staging_id)
+                # Restos de ejecuciones anteriores
+                active = {upload['path'] for upload in self._uploads.values()}
+                if not await self.client.check(self.directory):
+                    continue
+                for entry in await self.client.list(self.directory):
+                    created = posixpath.basename(entry['path']).split('-', 1)[0]
+                    if entry['path'] not in active and created.isdigit() and time.time() - int(created) > self.ttl:
+                        logger.info(f"Eliminando archivo preparado sin reclamar: {entry['path']}")
+                        await self.client.delete(entry['path'])
+            except Exception as e:
+                logger.error(f"Error al limpiar la carpeta de preparación: {str(e)}")
+
+    def start_cleanup(self):
+        self._cleaner = asyncio.create_task(self._expire())
+
+    async def stop(self):
+        """Detiene la limpieza y las subidas en curso (sus restos se borran en el próximo arranque)"""
+        tasks = [upload['task'] for upload in self._uploads.values()]
+        if self._cleaner is not None:
+            tasks.append(self._cleaner)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._uploads.clear()
+
+staging_area = StagingArea(webdav_client, STAGING_DIR or '/', STAGING_TTL)
+
+class PendingDownloads:
+    """Descargas de los archivos que los usuarios envían al bot cuando no hay carpeta de
+    preparación: el archivo se descarga mientras el usuario elige el directorio"""
+
+    def __init__(self):
+        self._downloads = {}
+
+    def start(self, file, file_name, local_path):
+        progress = TransferProgress(file_name, file.file_size, 'descargando')
+        self._downloads[local_path] = {
+            'progress': progress,
+            'task': asyncio.create_task(self._download(file, local_path, progress)),
+        }
+
+    async def _download(self, file, local_path, progress):
+        with progress:
+            await download_telegram_file(file, local_path, progress)
+
+    def progress(self, local_path):
+        download = self._downloads.get(local_path)
+        return download['progress'] if download else None
+
+    def ready(self, local_path):
+        download = self._downloads.get(local_path)
+        return download is None or download['task'].done()
+
+    async def wait(self, local_path):
+        """Espera a que termine la descarga de `local_path`, si sigue pendiente"""
+        download = self._downloads.pop(local_path, None)
+        if download is not None:
+            await download['task']
+
+    async def discard(self, local_path):
+        download = self._downloads.pop(local_path, None)
+        if download is not None:
+            download['task'].cancel()
+            await asyncio.gather(download['task'], return_exceptions=True)
+
+    async def stop(self):
+        tasks = [download['task'] for download in self._downloads.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._downloads.clear()
+
+pending_downloads = PendingDownloads()
+
+async def refetch_user_file(bot, file_info, directory, progress=None):
+    """Sube a `directory` un archivo pendiente pidiéndolo de nuevo a Telegram"""
+    file = await get_telegram_file(bot, file_info['file_id'])
+    remote_path = await remote_names.claim(directory, file_info['file_name'], file.file_size)
+    if remote_path is None:
+        return None
+    try:
+        chunks, size = telegram_file_chunks(file)
+        entry = await webdav_client.upload_stream(
+            chunks, remote_path, size=size, key=file.file_id, on_conflict=remote_names.on_conflict,
+            progress=progress
+        )
+        remote_names.release(remote_path, entry)
+        return entry['path']
+    finally:
+        remote_names.release(remote_path)
+
+async def save_user_file(bot, user_data, directory, progress=None):
+    """Guarda en `directory` el archivo pendiente del usuario, preparado o descargado.
+
+    Si el archivo se recibió en una ejecución anterior o en otro proceso del bot y no
+    queda ninguna copia a mano, se vuelve a pedir a Telegram. Devuelve la ruta remota
+    con la que se guardó o None si ya estaba en el servidor.
+    """
+    file_info = user_data['file_info']
+    file_name = file_info['file_name']
+    staging_id = user_data.get('staging_id')
+    local_path = user_data.get('local_path')
+    if staging_area.has(staging_id):
+        return await staging_area.claim(staging_id, directory, file_name)
+    if staging_id:
+        entry = await staging_area.find(user_data['staged_path'], file_info.get('file_size'))
+        if entry:
+            return await staging_area.place(entry, directory, file_name)
+    elif local_path:
+        await pending_downloads.wait(local_path)
+        if os.path.exists(local_path):
+            return await store_user_file(local_path, file_name, directory, progress)
+    logger.info(f"Archivo {file_name}: no queda ninguna copia preparada, se vuelve a obtener de Telegram")
+    return await refetch_user_file(bot, file_info, directory, progress)
+
+def has_user_file(user_data):
+    # Con su file_id el archivo siempre se puede volver a pedir a Telegram
+    return bool(user_data.get('file_info'))
+
+async def discard_user_file(user_data):
+    """Elimina lo que quede del archivo pendiente del usuario (los preparados por otro
+    proceso los borra su limpieza periódica)"""
+    await pending_downloads.discard(user_data.get('local_path'))
+    discard_local_file(user_data)
+    if user_data.get('staging_id'):
+        await staging_area.discard(user_data['staging_id'])
+
+def stored_file_text(file_name, directory, remote_path):
+    if remote_path is None:
+        return f"ℹ️ El archivo {file_name} ya existe en {directory}, no se ha vuelto a subir"
+    stored_name = posixpath.basename(remote_path)
+    if stored_name != file_name:
+        return f"✅ Archivo {file_name} subido correctamente a {directory} como {stored_name}"
+    return f"✅ Archivo {file_name} subido correctamente a {directory}"
+
+async def upload_user_file(bot, user_data, directory, message, user_id):
+    """Guarda el archivo pendiente del usuario y deja el resultado en `message`.
+
+    Mientras se sube, si el archivo es grande, el mensaje muestra el progreso. Al
+    terminar se eliminan los datos temporales del usuario.
+    """
+    file_info = user_data['file_info']
+    file_name = file_info['file_name']
+    staging_id = user_data.get('staging_id')
+    local_path = user_data.get('local_path')
+    downloaded = pending_downloads.ready(local_path)
+    if staging_area.has(staging_id):
+        progress = staging_area.progress(staging_id)
+    else:
+        if downloaded and local_path and os.path.exists(local_path):
+            size = os.path.getsize(local_path)
+        else:
+            size = file_info.get('file_size')
+        progress = TransferProgress(file_name, size, 'subiendo', directory)
     try:
-        webdav_client.upload_sync(local_path, remote_path)
-        logger.info(f"Audio {file_name} subido correctamente a {remote_path}")
+        if progress_reporter.wanted(progress) and not progress.finished:
+            progress_reporter.show(message, progress, f"⏳ Guardando {file_name} en {directory}...")
+        elif not staging_area.ready(staging_id):
+            await message.edit_text(f"⏳ Terminando de subir {file_name}...")
+        elif not downloaded:
+            await message.edit_text(f"⏳ Terminando de descargar {file_name}...")
+        if staging_area.has(staging_id):
+            remote_path = await save_user_file(bot, user_data, directory)
+        else:
+            with progress:
+                remote_path = await save_user_file(bot, user_data, directory, progress)
+        await progress_reporter.stop(message)
+        await message.edit_text(stored_file_text(file_name, directory, remote_path))
+        logger.info(f"Archivo {file_name} subido por usuario {user_id} a {directory}")
     except Exception as e:
-        logger.error(f"Error al subir audio {file_name}: {str(e)}")
+        await progress_reporter.stop(message)
+        await message.edit_text(f"❌ Error al subir el archivo: {str(e)}")
+        logger.error(f"Error al subir archivo {file_name}: {str(e)}")
     finally:
-        # Eliminar archivo temporal
-        os.remove(local_path)
+        # Limpiar datos temporales
+        await progress_reporter.stop(message)
+        await discard_user_file(user_data)
+        user_data.clear()
+
+def start_user_upload(update, context, directory, message):
+    """Guarda el archivo pendiente del usuario en una tarea aparte.
+
+    El manejador vuelve enseguida y el resultado se muestra después en `message`, así
+    que una subida grande no retiene las actualizaciones de otros usuarios ni de los
+    canales. Los datos del archivo pasan a la tarea: si el usuario envía otro archivo
+    mientras tanto, no interrumpe esta subida.
+    """
+    user_data = dict(context.user_data)
+    context.user_data.clear()
+    context.application.create_task(
+        upload_user_file(context.bot, user_data, directory, message, update.effective_user.id),
+        update=update,
+    )
 
 async def handle_direct_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Maneja archivos enviados directamente al bot por usuarios autorizados"""
@@ -247,7 +3826,7 @@ async def handle_direct_file(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if message.document:
         file_info = {
             'file_id': message.document.file_id,
-            'file_name': message.document.file_name,
+            'file_name': message.document.file_name or f"document_{message.document.file_id}",
             'file_type': 'document'
         }
     elif message.photo:
@@ -278,19 +3857,35 @@ async def handle_direct_file(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("Tipo de archivo no soportado.")
         return ConversationHandler.END
     
+    # Un archivo nuevo sustituye al que estuviera pendiente
+    await discard_user_file(context.user_data)
+    context.user_data.clear()
+    
     # Guardar información del archivo para su procesamiento posterior
     context.user_data['file_info'] = file_info
     
-    # Descargar el archivo
-    file = await context.bot.get_file(file_info['file_id'])
-    local_path = f"/tmp/{file_info['file_name']}"
-    await file.download_to_drive(local_path)
-    
-    # Guardar la ruta temporal
-    context.user_data['local_path'] = local_path
+    file = await get_telegram_file(context.bot, file_info['file_id'])
+    file_info['file_size'] = file.file_size
+    if STAGING_DIR:
+        # Empezar a subirlo a WebDAV mientras el usuario elige el directorio
+        staging_id = staging_area.start(file, file_info['file_name'])
+        context.user_data['staging_id'] = staging_id
+        context.user_data['staged_path'] = staging_area.path(staging_id)
+    else:
+        # Descargar el archivo mientras el usuario elige el directorio (con el servidor
+        # local de la Bot API ya está en disco)
+        local_path = telegram_local_path(file)
+        context.user_data['temporary_file'] = local_path is None
+        if local_path is None:
+            temp_dir = tempfile.mkdtemp(prefix='telegram-webdav-', dir=TEMP_DIR)
+            local_path = os.path.join(temp_dir, RemoteNames.clean(file_info['file_name']))
+            pending_downloads.start(file, file_info['file_name'], local_path)
+        
+        # Guardar la ruta temporal
+        context.user_data['local_path'] = local_path
     
     # Obtener directorios disponibles
-    directories = get_available_directories()
+    directories = await get_available_directories()
     
     # Crear botones para cada directorio
     keyboard = []
@@ -306,11 +3901,24 @@ async def handle_direct_file(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await update.message.reply_text(
+    # La selección pendiente queda guardada antes de mostrar el teclado
+    await save_user_data(update, context)
+    
+    text = (
         f"He recibido tu archivo: {file_info['file_name']}.\n"
-        f"Por favor, selecciona el directorio donde quieres guardarlo:",
-        reply_markup=reply_markup
+        f"Por favor, selecciona el directorio donde quieres guardarlo:"
     )
+    reply = await update.message.reply_text(text, reply_markup=reply_markup)
+    
+    # Mostrar el progreso de la subida a la carpeta de preparación (o de la descarga)
+    # mientras se elige
+    staging_id = context.user_data.get('staging_id')
+    if staging_id:
+        progress = staging_area.progress(staging_id)
+    else:
+        progress = pending_downloads.progress(context.user_data.get('local_path'))
+    if progress is not None and progress_reporter.wanted(progress):
+        progress_reporter.show(reply, progress, text, reply_markup)
     
     return SELECTING_DIRECTORY
 
@@ -322,39 +3930,24 @@ async def handle_directory_selection(update: Update, context: ContextTypes.DEFAU
     callback_data = query.data
     
     if callback_data == "new_dir":
+        await progress_reporter.stop(query.message)
         await query.message.edit_text(
             "Por favor, envía el nombre del nuevo directorio que quieres crear (sin barras):"
         )
         context.user_data['awaiting_new_dir'] = True
+        await save_user_data(update, context)
         return SELECTING_DIRECTORY
     
     if callback_data.startswith("dir:"):
         directory = callback_data[4:]  # Extraer el directorio de "dir:/directorio"
         
-        # Obtener información del archivo y ruta local
-        file_info = context.user_data.get('file_info')
-        local_path = context.user_data.get('local_path')
-        
-        if not file_info or not local_path:
+        if not has_user_file(context.user_data):
             await query.message.edit_text("Hubo un error al procesar tu archivo. Por favor, inténtalo de nuevo.")
             return ConversationHandler.END
         
-        # Subir a WebDAV
-        remote_path = f"{directory}/{file_info['file_name']}"
-        
-        try:
-            webdav_client.upload_sync(local_path, remote_path)
-            await query.message.edit_text(f"✅ Archivo {file_info['file_name']} subido correctamente a {directory}")
-            logger.info(f"Archivo {file_info['file_name']} subido por usuario {update.effective_user.id} a {directory}")
-        except Exception as e:
-            await query.message.edit_text(f"❌ Error al subir el archivo: {str(e)}")
-            logger.error(f"Error al subir archivo {file_info['file_name']}: {str(e)}")
-        finally:
-            # Limpiar datos temporales
-            if os.path.exists(local_path):
-                os.remove(local_path)
-            context.user_data.clear()
-        
+        # Subir a WebDAV (o mover el archivo ya preparado)
+        start_user_upload(update, context, directory, query.message)
+        await save_user_data(update, context)
         return ConversationHandler.END
     
     await query.message.edit_text("Opción no válida. Por favor, inténtalo de nuevo.")
@@ -380,37 +3973,25 @@ async def handle_new_directory(update: Update, context: ContextTypes.DEFAULT_TYP
     
     # Crear el directorio
     try:
-        webdav_client.mkdir(directory)
+        await directory_provisioner.ensure(directory)
+        directory_index.add(directory)
         logger.info(f"Directorio {directory} creado por usuario {update.effective_user.id}")
     except Exception as e:
         await update.message.reply_text(f"Error al crear el directorio: {str(e)}")
         logger.error(f"Error al crear directorio {directory}: {str(e)}")
         return ConversationHandler.END
     
-    # Obtener información del archivo y ruta local
+    # Obtener información del archivo
     file_info = context.user_data.get('file_info')
-    local_path = context.user_data.get('local_path')
     
-    if not file_info or not local_path:
+    if not has_user_file(context.user_data):
         await update.message.reply_text("Hubo un error al procesar tu archivo. Por favor, inténtalo de nuevo.")
         return ConversationHandler.END
     
-    # Subir a WebDAV
-    remote_path = f"{directory}/{file_info['file_name']}"
-    
-    try:
-        webdav_client.upload_sync(local_path, remote_path)
-        await update.message.reply_text(f"✅ Archivo {file_info['file_name']} subido correctamente a {directory}")
-        logger.info(f"Archivo {file_info['file_name']} subido por usuario {update.effective_user.id} a {directory}")
-    except Exception as e:
-        await update.message.reply_text(f"❌ Error al subir el archivo: {str(e)}")
-        logger.error(f"Error al subir archivo {file_info['file_name']}: {str(e)}")
-    finally:
-        # Limpiar datos temporales
-        if os.path.exists(local_path):
-            os.remove(local_path)
-        context.user_data.clear()
-    
+    # Subir a WebDAV (o mover el archivo ya preparado)
+    message = await update.message.reply_text(f"⏳ Guardando {file_info['file_name']} en {directory}...")
+    start_user_upload(update, context, directory, message)
+    await save_user_data(update, context)
     return ConversationHandler.END
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -444,7 +4025,10 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             "\n\n📝 *Comandos disponibles:*\n"
             "• /start - Inicia el bot\n"
             "• /help - Muestra este mensaje de ayuda\n"
-            "• /list - Listar directorios disponibles",
+            "• /list - Listar directorios disponibles\n"
+            "• /limits - Ver o cambiar los límites de Telegram y WebDAV\n"
+            "• /status - Ver las transferencias en curso y en cola\n"
+            "• /backfill - Importar el historial de un canal",
             parse_mode='Markdown'
         )
     else:
@@ -458,7 +4042,7 @@ async def list_directories(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         await update.message.reply_text("Lo siento, no estás autorizado para usar este bot.")
         return
     
-    directories = get_available_directories()
+    directories = await get_available_directories()
     
     if not directories:
         await update.message.reply_text("No hay directorios disponibles.")
@@ -470,37 +4054,233 @@ async def list_directories(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     
     await update.message.reply_text(message, parse_mode='Markdown')
 
-async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Cancela la conversación actual"""
-    # Limpiar datos temporales
-    if 'local_path' in context.user_data and os.path.exists(context.user_data['local_path']):
-        os.remove(context.user_data['local_path'])
-    context.user_data.clear()
+def describe_rate(rate, unit):
+    return "sin límite" if not rate else f"{rate:g} {unit}"
+
+async def limits_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Muestra o cambia los límites de Telegram y WebDAV: /limits [telegram|chat|webdav VALOR]"""
+    user_id = update.effective_user.id
     
-    await update.message.reply_text("Operación cancelada.")
-    return ConversationHandler.END
+    if user_id not in AUTHORIZED_USERS:
+        await update.message.reply_text("Lo siento, no estás autorizado para usar este bot.")
+        return
+    
+    usage = (
+        "Uso: /limits telegram|chat|webdav VALOR\n"
+        "• telegram: llamadas por segundo a la Bot API\n"
+        "• chat: mensajes por segundo a un mismo chat\n"
+        "• webdav: bytes por segundo hacia WebDAV (admite K, M y G)\n"
+        "Con 0 se quita el límite."
+    )
+    if context.args:
+        if len(context.args) != 2:
+            await update.message.reply_text(usage)
+            return
+        name, value = context.args[0].lower(), context.args[1]
+        try:
+            rate = parse_size(value) if name == 'webdav' else float(value)
+            if rate < 0:
+                raise ValueError(value)
+        except ValueError:
+            await update.message.reply_text(usage)
+            return
+        if name == 'telegram':
+            telegram_rate_limiter.configure(rate=rate)
+        elif name == 'chat':
+            telegram_rate_limiter.configure(chat_rate=rate)
+        elif name == 'webdav':
+            webdav_bandwidth.configure(rate)
+        else:
+            await update.message.reply_text(usage)
+            return
+        logger.info(f"Límite {name} cambiado a {value} por usuario {user_id}")
+    
+    webdav_rate = webdav_bandwidth.rate
+    await update.message.reply_text(
+        "⚙️ Límites actuales:\n"
+        f"• Telegram: {describe_rate(telegram_rate_limiter.bucket.rate, 'llamadas/s')}\n"
+        f"• Por chat: {describe_rate(telegram_rate_limiter.chat_rate, 'mensajes/s')}\n"
+        f"• WebDAV: {describe_rate(webdav_rate / 1024 ** 2, 'MB/s') if webdav_rate else 'sin límite'}\n\n"
+        + usage
+    )
 
-def main() -> None:
-    """Inicia el bot"""
+# Transferencias que se detallan en /status en cada apartado
+STATUS_MAX_ITEMS = 10
+
+def describe_job(job):
+    return f"• {job.file_name} → {job.directory}"
+
+async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Muestra las transferencias en curso y en cola"""
+    user_id = update.effective_user.id
     
-    # Verificar configuración
-    if not TELEGRAM_BOT_TOKEN:
-        logger.error("ERROR: Token de Telegram no configurado")
+    if user_id not in AUTHORIZED_USERS:
+        await update.message.reply_text("Lo siento, no estás autorizado para usar este bot.")
         return
     
-    if not WEBDAV_HOSTNAME or not WEBDAV_USERNAME or not WEBDAV_PASSWORD:
-        logger.error("ERROR: Configuración de WebDAV incompleta")
+    running = sorted(active_transfers, key=lambda progress: progress.started)
+    lines = [f"📤 En curso: {len(running)}"]
+    for progress in running[:STATUS_MAX_ITEMS]:
+        target = f" → {progress.directory}" if progress.directory else ""
+        lines.append(f"• {progress.name}{target}\n{progress.describe()}")
+    if len(running) > STATUS_MAX_ITEMS:
+        lines.append(f"… y {len(running) - STATUS_MAX_ITEMS} más")
+    
+    if TRANSFER_WORKERS == 'external':
+        # Los archivos de canales los transfieren los trabajadores: mostrar la cola compartida
+        title, waiting = "En la cola de los trabajadores", await job_journal.unfinished()
+    else:
+        title, waiting = "En cola", transfer_scheduler.waiting()
+    lines.append(f"\n🕒 {title}: {len(waiting)}")
+    lines.extend(describe_job(job) for job in waiting[:STATUS_MAX_ITEMS])
+    if len(waiting) > STATUS_MAX_ITEMS:
+        lines.append(f"… y {len(waiting) - STATUS_MAX_ITEMS} más")
+    if transfer_scheduler.retrying:
+        lines.append(f"\n🔁 Esperando para reintentar: {transfer_scheduler.retrying}")
+    
+    await update.message.reply_text("\n".join(lines))
+
+async def backfill_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Importa el historial de un canal: /backfill CANAL [DESDE] [HASTA]"""
+    user_id = update.effective_user.id
+    
+    if user_id not in AUTHORIZED_USERS:
+        await update.message.reply_text("Lo siento, no estás autorizado para usar este bot.")
+        return
+    
+    usage = (
+        "Uso: /backfill CANAL [DESDE] [HASTA]\n"
+        "• CANAL: identificador (-100...) o @nombre del canal\n"
+        "• DESDE, HASTA: primer y último mensaje a importar (por defecto, todo el historial)\n"
+        "Repetir una importación interrumpida la continúa donde se quedó y reintenta los mensajes con error. "
+        "/backfill cancel CANAL la detiene y /backfill sin argumentos muestra su estado."
+    )
+    args = context.args
+    if not args:
+        running = list(channel_backfill.runs.values())
+        interrupted = [
+            run for run in channel_backfill.saved() if not run.finished and run.chat_id not in channel_backfill.runs
+        ]
+        lines = [f"📥 Importaciones en curso: {len(running)}"]
+        lines.extend(f"• {run.describe()}" for run in running)
+        if interrupted:
+            lines.append(f"\n⏸ Interrumpidas: {len(interrupted)}")
+            lines.extend(f"• {run.describe()}" for run in interrupted[:STATUS_MAX_ITEMS])
+        await update.message.reply_text("\n".join(lines) + "\n\n" + usage)
         return
     
-    # Verificar/crear directorios en WebDAV
     try:
-        ensure_directories()
-    except Exception as e:
-        logger.error(f"Error al verificar directorios: {str(e)}")
+        if args[0].lower() == 'cancel':
+            if len(args) != 2:
+                raise ValueError(args)
+            channel = parse_channel(args[1])
+        else:
+            if len(args) > 3:
+                raise ValueError(args)
+            channel = parse_channel(args[0])
+            first_id = int(args[1]) if len(args) > 1 else 1
+            last_id = int(args[2]) if len(args) > 2 else None
+    except ValueError:
+        await update.message.reply_text(usage)
         return
     
-    # Iniciar bot
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    if args[0].lower() == 'cancel':
+        try:
+            run = await channel_backfill.cancel(channel)
+        except Exception as e:
+            await update.message.reply_text(f"❌ Error al cancelar la importación: {str(e)}")
+            return
+        if run is None:
+            await update.message.reply_text("No hay ninguna importación en curso de ese canal.")
+        else:
+            logger.info(f"Importación del canal {run.chat_id} cancelada por usuario {user_id}")
+            await update.message.reply_text(f"🚫 Importación cancelada. {run.describe()}")
+        return
+    
+    chat_id = update.effective_chat.id
+    
+    async def report(run, error):
+        if error is None:
+            text = f"✅ Importación terminada. {run.describe()}"
+        else:
+            text = f"❌ Error al importar el historial del canal {channel}: {str(error)}"
+        try:
+            await context.bot.send_message(chat_id, text)
+        except Exception as e:
+            logger.error(f"No se pudo enviar el resultado de la importación: {str(e)}")
+    
+    channel_backfill.start(channel, first_id, last_id, on_done=report)
+    logger.info(f"Importación del historial del canal {channel} iniciada por usuario {user_id}")
+    await update.message.reply_text(
+        f"📥 Importando el historial del canal {channel}. Te avisaré al terminar; "
+        "mientras tanto, /backfill muestra su avance y /status las transferencias en curso."
+    )
+
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Cancela la conversación actual"""
+    # Limpiar datos temporales
+    await discard_user_file(context.user_data)
+    context.user_data.clear()
+    await save_user_data(update, context)
+    
+    await update.message.reply_text("Operación cancelada.")
+    return ConversationHandler.END
+
+async def post_init(application) -> None:
+    """Abre los registros locales y arranca las transferencias.
+
+    Los directorios fijos de destino se verifican (o crean) en segundo plano, sin
+    retrasar la recepción de actualizaciones: cada transferencia espera solo a que
+    esté listo su propio directorio.
+    """
+    media_transformer.open()
+    job_journal.open()
+    media_index.open()
+    directory_provisioner.open()
+    channel_backfill.open()
+    start_metrics_server()
+    directory_provisioner.start(channel_router.static_directories())
+    daily_archives.start()
+    # Álbumes que se estaban reuniendo cuando se detuvo el bot
+    await job_journal.close_albums(ALBUM_WINDOW)
+    if STAGING_DIR:
+        staging_area.start_cleanup()
+    if TRANSFER_WORKERS != 'external':
+        transfer_scheduler.start(application.bot)
+    directory_index.schedule_refresh()
+
+async def post_shutdown(application) -> None:
+    """Detiene las transferencias y cierra las conexiones con WebDAV y con Telegram"""
+    album_collector.cancel()
+    await progress_reporter.stop_all()
+    await staging_area.stop()
+    await pending_downloads.stop()
+    await channel_backfill.stop()
+    await directory_provisioner.stop()
+    await transfer_scheduler.stop()
+    await daily_archives.stop()
+    media_transformer.close()
+    await job_journal.close()
+    media_index.close()
+    directory_provisioner.close()
+    await channel_backfill.close()
+    await webdav_client.close()
+    if _telegram_download_client is not None:
+        await _telegram_download_client.aclose()
+
+def build_application():
+    """Crea la aplicación de Telegram con todos sus manejadores"""
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .persistence(state_persistence)
+    )
+    for name, value in bot_api_settings().items():
+        getattr(builder, name)(value)
+    builder.rate_limiter(telegram_rate_limiter)
+    application = builder.build()
     
     # Crear manejador de conversación para la selección de directorio
     conv_handler = ConversationHandler(
@@ -517,23 +4297,128 @@ def main() -> None:
             ],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        # Enviar otro archivo sustituye al pendiente
+        allow_reentry=True,
+        name='directory_selection',
+        persistent=True,
     )
     
     # Añadir manejadores
     application.add_handler(conv_handler)
+    # Selecciones empezadas en otro proceso del bot: el estado de la conversación solo
+    # lo conoce ese proceso, pero los datos del usuario se leen de la persistencia
+    application.add_handler(CallbackQueryHandler(handle_directory_selection, pattern=r'^(dir:|new_dir$)'))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, handle_new_directory))
+    application.add_handler(CommandHandler("cancel", cancel, filters.ChatType.PRIVATE))
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("list", list_directories))
+    application.add_handler(CommandHandler("limits", limits_command))
+    application.add_handler(CommandHandler("status", status_command))
+    application.add_handler(CommandHandler("backfill", backfill_command))
     
-    # Añadir manejadores para archivos de canales
+    # Añadir manejadores para archivos de canales. Solo encolan la transferencia en el
+    # planificador; si la cola está llena esperan, frenando la recepción de actualizaciones
     application.add_handler(MessageHandler(filters.Document.ALL & ~filters.ChatType.PRIVATE, handle_document))
     application.add_handler(MessageHandler(filters.VIDEO & ~filters.ChatType.PRIVATE, handle_video))
     application.add_handler(MessageHandler(filters.PHOTO & ~filters.ChatType.PRIVATE, handle_photo))
     application.add_handler(MessageHandler(filters.AUDIO & ~filters.ChatType.PRIVATE, handle_audio))
     
+    return application
+
+def main() -> None:
+    """Inicia el bot"""
+    
+    # Verificar configuración
+    if not TELEGRAM_BOT_TOKEN:
+        logger.error("ERROR: Token de Telegram no configurado")
+        return
+    
+    if not WEBDAV_HOSTNAME or not WEBDAV_USERNAME or not WEBDAV_PASSWORD:
+        logger.error("ERROR: Configuración de WebDAV incompleta")
+        return
+    
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        logger.error("ERROR: BOT_MODE=webhook requiere WEBHOOK_URL")
+        return
+    
     # Iniciar bot
+    application = build_application()
     logger.info("Bot iniciado...")
-    application.run_polling()
+    if BOT_MODE == 'webhook':
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET
+        )
+    else:
+        application.run_polling()
+
+def worker() -> None:
+    """Inicia un proceso trabajador de transferencias"""
+    if not TELEGRAM_BOT_TOKEN:
+        logger.error("ERROR: Token de Telegram no configurado")
+        return
+    
+    if not WEBDAV_HOSTNAME or not WEBDAV_USERNAME or not WEBDAV_PASSWORD:
+        logger.error("ERROR: Configuración de WebDAV incompleta")
+        return
+    
+    try:
+        asyncio.run(run_worker())
+    except KeyboardInterrupt:
+        pass
+
+def backfill(channel, first_id, last_id) -> None:
+    """Importa el historial de un canal y termina"""
+    if not WEBDAV_HOSTNAME or not WEBDAV_USERNAME or not WEBDAV_PASSWORD:
+        logger.error("ERROR: Configuración de WebDAV incompleta")
+        return
+    
+    async def run():
+        media_transformer.open()
+        # Los documentos archivados se anotan en el registro hasta que se sube su archivador
+        job_journal.open()
+        media_index.open()
+        directory_provisioner.open()
+        channel_backfill.open()
+        daily_archives.start()
+        try:
+            await channel_backfill.run(parse_channel(channel), first_id, last_id)
+        finally:
+            await daily_archives.stop()
+            media_transformer.close()
+            await job_journal.close()
+            await channel_backfill.close()
+            await webdav_client.close()
+            media_index.close()
+            directory_provisioner.close()
+    
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        logger.info("Importación interrumpida: repite la misma orden para continuarla")
+    except Exception as e:
+        logger.error(f"Error al importar el historial del canal {channel}: {str(e)}")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Bot de Telegram para WebDAV")
+    parser.add_argument(
+        'command', nargs='?', default='bot', choices=['bot', 'worker', 'backfill'],
+        help="'bot' recibe las actualizaciones de Telegram; 'worker' atiende transferencias de la cola "
+             "compartida; 'backfill' importa el historial de un canal"
+    )
+    parser.add_argument('channel', nargs='?', help="Canal a importar con 'backfill' (-100... o @nombre)")
+    parser.add_argument('--from', dest='first_id', type=int, default=1, help="Primer mensaje a importar")
+    parser.add_argument('--to', dest='last_id', type=int, help="Último mensaje a importar (por defecto, el último)")
+    args = parser.parse_args()
+    if args.command == 'backfill' and not args.channel:
+        parser.error("'backfill' necesita el canal")
+    if args.command == 'worker':
+        worker()
+    elif args.command == 'backfill':
+        backfill(args.channel, args.first_id, args.last_id)
+    else:
+        main()